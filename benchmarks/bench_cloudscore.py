@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the cloud score join against per-image TOA lookups
+
+Builds the cloud masked surface reflectance collection of one sensor and
+year with cdd.join_cloudscore (one join between the SR and TOA
+collections) and with the previous per-image lookup (a filtered TOA
+collection and simpleCloudScore inside map), and reports the size of the
+serialized request and the time to evaluate the count of clear
+observations over the scene.
+
+Usage: bench_cloudscore.py [options]
+
+  --path=PATH       path (default: 225)
+  --row=ROW         row (default: 68)
+  --sensor=SENSOR   LT5, LE7 or LC8 (default: LE7)
+  --year=YEAR       year (default: 2005)
+  --scale=SCALE     scale of the evaluation in meters (default: 900)
+
+"""
+
+from docopt import docopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ee
+import cdd
+
+
+def lookup_cloudscore(toa_id):
+    # The previous implementation: one TOA query per SR image
+    def add_cloudscore(image):
+        thedate = image.date()
+        toa = ee.ImageCollection(toa_id
+            ).filterDate(thedate.advance(-1, 'day'), thedate.advance(1, 'day')
+            ).filter(ee.Filter.eq('WRS_PATH', cdd.path)
+            ).filter(ee.Filter.eq('WRS_ROW', cdd.row)
+            ).first()
+        cs = ee.Algorithms.If(
+            ee.Image(toa),
+            ee.Image(ee.Algorithms.Landsat.simpleCloudScore(ee.Image(toa))).select('cloud'),
+            ee.Image(0).rename(['cloud']))
+        mask = ee.Image(cs).lt(ee.Image(cdd.cloud_score))
+        return image.updateMask(mask).select(['B1', 'B2', 'B3', 'B4', 'B5', 'B7'])
+    return add_cloudscore
+
+
+def build(sensor, year, join):
+    collection_id, toa_id, mask_func = cdd.SENSORS[sensor]
+    collection = cdd.filter_footprint(ee.ImageCollection(collection_id
+        ).filterDate(str(year) + '-01-01', str(year + 1) + '-01-01'))
+    if join:
+        toa = cdd.filter_footprint(ee.ImageCollection(toa_id
+            ).filterDate(str(year - 1) + '-12-31', str(year + 1) + '-01-02'))
+        return cdd.join_cloudscore(collection, toa).map(mask_func).map(cdd.add_cloudscore)
+    return collection.map(mask_func).map(lookup_cloudscore(toa_id))
+
+
+def clear_count(collection, region, scale):
+    count = ee.ImageCollection(collection).select('B1').count()
+    return count.reduceRegion(ee.Reducer.mean(), region, scale, maxPixels=1e9)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    cdd.initialize()
+    cdd.set_params({'--path': args['--path'] or '225',
+                    '--row': args['--row'] or '68',
+                    '--consec': None, '--thresh': None, '--forest': None,
+                    '--cloud': None, '--cf': None, '--window': None,
+                    '--aoi': False, '--start': None, '--end': None,
+                    '--stride': None, '--checkpoint': None})
+    sensor = args['--sensor'] or 'LE7'
+    year = int(args['--year']) if args['--year'] else 2005
+    scale = float(args['--scale']) if args['--scale'] else 900
+
+    region = cdd.filter_footprint(ee.ImageCollection(cdd.SENSORS[sensor][0])
+        ).filterDate(str(year) + '-01-01', str(year + 1) + '-01-01').first().geometry()
+
+    for name, join in (('lookup', False), ('join', True)):
+        request = clear_count(build(sensor, year, join), region, scale)
+        size = len(ee.serializer.toJSON(request))
+        start = time.time()
+        result = request.getInfo()
+        elapsed = time.time() - start
+        print('{0:>7}: {1:8d} bytes serialized, {2:7.2f} s evaluation, '
+              'mean clear count {3}'.format(name, size, elapsed, result))
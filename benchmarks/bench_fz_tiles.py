@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the tiled Felzenszwalb segmentation of postprocess.segment_fz
+
+Segments a synthetic CDD raster of random disturbance patches over the
+whole raster at once, as segment_fz does without --tile, and in
+overlapping tiles with postprocess.fz_tiles for every number of
+processes. Reports the times, the seam boundary ratio (1 when the tile
+edges do not show) and the fraction of neighbouring pixel pairs on which
+the tiled and whole segmentations agree about a segment boundary.
+
+Usage: bench_fz_tiles.py [options]
+
+  --size=SIZE             raster side in pixels (default: 4000)
+  --tile=TILE             tile size in pixels (default: 1024)
+  --halo=HALO             halo in pixels (default: 32)
+  --processes=PROCESSES   comma separated numbers of processes
+                          (default: 1,2,4,8)
+
+"""
+
+from docopt import docopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import postprocess
+
+
+def synthetic(filename, size, seed=0):
+    """ 5 band raster of rectangular patches with a change date, magnitude
+    and NFDI, and noise """
+    rng = np.random.RandomState(seed)
+    image = np.zeros((5, size, size), dtype=np.float32)
+    for _ in range(size * size // 2000):
+        y, x = rng.randint(0, size, 2)
+        h, w = rng.randint(5, 60, 2)
+        image[0, y:y + h, x:x + w] = rng.uniform(30, 44)
+        image[1, y:y + h, x:x + w] = rng.uniform(3, 20)
+        image[3, y:y + h, x:x + w] = rng.uniform(50, 200)
+    image = np.abs(image + rng.normal(0, .5, image.shape).astype(np.float32))
+
+    dataset = gdal.GetDriverByName('GTiff').Create(filename, size, size, 5,
+                                                  gdal.GDT_Float32)
+    for b in range(5):
+        dataset.GetRasterBand(b + 1).WriteArray(image[b])
+    dataset.FlushCache()
+    return image
+
+
+def boundary_agreement(a, b):
+    agree = [((np.diff(a, axis=axis) != 0) == (np.diff(b, axis=axis) != 0)).mean()
+             for axis in (0, 1)]
+    return np.mean(agree)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    size = int(args['--size']) if args['--size'] else 4000
+    tile = int(args['--tile']) if args['--tile'] else 1024
+    halo = int(args['--halo']) if args['--halo'] else 32
+    processes = [int(p) for p in (args['--processes'] or '1,2,4,8').split(',')]
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'cdd.tif')
+    image = synthetic(filename, size)
+
+    start = time.time()
+    whole = postprocess.felzenszwalb(postprocess.fz_image(image), scale=20,
+                                     sigma=.8, min_size=4)
+    whole_time = time.time() - start
+    print('whole: {0:.2f} s, {1} segments, seam boundary ratio {2:.2f}'.format(
+        whole_time, whole.max() + 1, postprocess.seam_ratio(whole, tile)))
+
+    for n in processes:
+        start = time.time()
+        segments = postprocess.fz_tiles(filename, 20, .8, 4, tile, halo, n)
+        elapsed = time.time() - start
+        print('{0} processes: {1:.2f} s ({2:.1f}x), {3} segments, seam boundary '
+              'ratio {4:.2f}, boundary agreement {5:.4f}'.format(
+                  n, elapsed, whole_time / elapsed, segments.max() + 1,
+                  postprocess.seam_ratio(segments, tile),
+                  boundary_agreement(segments, whole)))
+    shutil.rmtree(directory)
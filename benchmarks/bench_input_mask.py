@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the forest mask of the inputs against masking the output
+
+Builds the CDD output of one scene twice: with the forest (and AOI) mask
+applied to every input image by cdd.mask_forest, so cloud scores,
+unmixing and the regressions skip the non-forest pixels, and as before,
+with unmasked inputs and the forest mask applied to the output only.
+Reports the size of the serialized request, the time to evaluate the
+mean of every output band over the scene, masked pixels counted as 0 as
+in the exported file, and the means, which should be the same. The two
+requests differ, so Earth Engine does not serve one from the cache of the
+other, but rerunning the benchmark may be faster.
+
+Usage: bench_input_mask.py [options]
+
+  --path=PATH       path (default: 225)
+  --row=ROW         row (default: 68)
+  --forest=FOREST   forest % cover threshold (default: 30)
+  --start=START     first monitoring year (default: 2000)
+  --end=END         last monitoring year (default: 2001)
+  --scale=SCALE     scale of the evaluation in meters (default: 900)
+
+"""
+
+from docopt import docopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ee
+import cdd
+
+
+def build(mask_inputs):
+    mask_forest = cdd.mask_forest
+    if not mask_inputs:
+        # The previous implementation: unmasked inputs
+        cdd.mask_forest = lambda image: image
+    cdd._collections.clear()
+    try:
+        return cdd.run_cdd()
+    finally:
+        cdd.mask_forest = mask_forest
+
+
+def band_means(output, region, scale):
+    return output.unmask(0).reduceRegion(ee.Reducer.mean(), region, scale, maxPixels=1e9)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    cdd.initialize()
+    cdd.set_params({'--path': args['--path'] or '225',
+                    '--row': args['--row'] or '68',
+                    '--consec': None, '--thresh': None,
+                    '--forest': args['--forest'], '--cloud': None, '--cf': None,
+                    '--window': None, '--aoi': False,
+                    '--start': args['--start'] or '2000',
+                    '--end': args['--end'] or '2001',
+                    '--stride': None, '--checkpoint': None})
+    scale = float(args['--scale']) if args['--scale'] else 900
+
+    region = cdd.get_region()
+    for name, mask_inputs in (('output', False), ('inputs', True)):
+        request = band_means(build(mask_inputs), region, scale)
+        size = len(ee.serializer.toJSON(request))
+        start = time.time()
+        result = request.getInfo()
+        elapsed = time.time() - start
+        print('{0:>7}: {1:8d} bytes serialized, {2:7.2f} s evaluation, '
+              'band means {3}'.format(name, size, elapsed, result))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the monitoring scan of cdd_local.monitor_series
+
+Compares the numba and NumPy scans of monitor_series with monitor_func
+applied one acquisition at a time, as it was before the scan, in pixel
+observations per second, and checks that they give the same status.
+
+Usage: bench_monitor_scan.py [options]
+
+  --pixels=PIXELS   number of pixels (default: 200000)
+  --dates=DATES     number of acquisitions (default: 400)
+  --cloud=CLOUD     fraction of masked observations (default: .3)
+
+"""
+
+from docopt import docopt
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cdd_local
+
+
+def monitor_func_series(status, coefs, tmean, t, nfdi, consec, thresh):
+    pred = cdd_local.predict_nfdi(t, coefs)
+    for i in range(len(t)):
+        status = cdd_local.monitor_func(status, t[i], nfdi[i], pred[i], tmean,
+                                        consec, thresh)
+    status[:, ~np.isfinite(tmean) | (tmean == 0)] = np.nan
+    return status
+
+
+def same_status(a, b):
+    # The magnitude sums predictions, which BLAS may round differently
+    return (np.array_equal(a[[0, 1, 2, 4]], b[[0, 1, 2, 4]], equal_nan=True) and
+            np.allclose(a[3], b[3], rtol=1e-12, atol=0, equal_nan=True))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    pixels = int(args['--pixels']) if args['--pixels'] else 200000
+    dates = int(args['--dates']) if args['--dates'] else 400
+    cloud = float(args['--cloud']) if args['--cloud'] else .3
+
+    rng = np.random.RandomState(0)
+    t = np.sort(rng.uniform(30, 38, dates))
+    coefs = np.column_stack([rng.uniform(.6, .8, pixels), rng.normal(0, .002, pixels),
+                             rng.uniform(0, .05, pixels), rng.uniform(0, .05, pixels)])
+    nfdi = cdd_local.predict_nfdi(t, coefs) + rng.normal(0, .03, (dates, pixels))
+    # A fifth of the pixels degrade half way
+    nfdi[dates // 2:, :pixels // 5] -= .3
+    nfdi[rng.uniform(size=nfdi.shape) < cloud] = np.nan
+    nfdi = nfdi.astype(np.float32)
+    tmean = np.full(pixels, .03)
+    observations = float(pixels * dates)
+
+    start = time.time()
+    reference = monitor_func_series(cdd_local.init_status(pixels), coefs, tmean,
+                                    t, nfdi, 5, 3.5)
+    elapsed = time.time() - start
+    print('monitor_func: {0:.2f} s, {1:.0f} M pixel observations/s'.format(
+        elapsed, observations / elapsed / 1e6))
+
+    for name, use_numba in (('numpy scan', False), ('numba scan', True)):
+        cdd_local.USE_NUMBA = use_numba
+        if use_numba and cdd_local.numba_scan() is None:
+            print('{0}: numba is not installed'.format(name))
+            continue
+        # Compile before timing
+        cdd_local.monitor_series(cdd_local.init_status(1), coefs[:1], tmean[:1],
+                                 t[:1], nfdi[:1, :1], 5, 3.5)
+        start = time.time()
+        status = cdd_local.monitor_series(cdd_local.init_status(pixels), coefs,
+                                          tmean, t, nfdi, 5, 3.5)
+        elapsed = time.time() - start
+        print('{0}: {1:.2f} s, {2:.0f} M pixel observations/s, same status: '
+              '{3}'.format(name, elapsed, observations / elapsed / 1e6,
+                           same_status(status, reference)))
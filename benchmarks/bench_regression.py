@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the batched harmonic regression against the pseudo-inverse
+
+Compares cdd_local.get_regression_coefs (normal equations solved for every
+pixel at once) with a per-pixel pseudo-inverse, the local equivalent of
+matrixPseudoInverse().matrixMultiply() on the array image.
+
+Usage: bench_regression.py [options]
+
+  --pixels=PIXELS   number of pixels (default: 100000)
+  --dates=DATES     number of acquisitions (default: 400)
+  --cloud=CLOUD     fraction of masked observations (default: .3)
+
+"""
+
+from docopt import docopt
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cdd_local
+
+
+def pinv_coefs(t, nfdi):
+    predictors = cdd_local.make_variables(t)
+    coefs = np.full((nfdi.shape[1], 4), np.nan)
+    for p in range(nfdi.shape[1]):
+        valid = ~np.isnan(nfdi[:, p])
+        if valid.sum() > 4:
+            coefs[p] = np.linalg.pinv(predictors[valid]).dot(nfdi[valid, p])
+    return coefs
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    pixels = int(args['--pixels']) if args['--pixels'] else 100000
+    dates = int(args['--dates']) if args['--dates'] else 400
+    cloud = float(args['--cloud']) if args['--cloud'] else .3
+
+    rng = np.random.RandomState(0)
+    t = np.sort(rng.uniform(24, 46, dates))
+    season = 2 * np.pi * t
+    nfdi = (0.8 + 0.002 * (t - 24) + 0.05 * np.sin(season))[:, np.newaxis] + \
+        rng.normal(0, 0.03, (dates, pixels))
+    nfdi[rng.uniform(size=nfdi.shape) < cloud] = np.nan
+    nfdi = nfdi.astype(np.float32)
+
+    start = time.time()
+    batched = cdd_local.get_regression_coefs(t, nfdi)
+    batched_time = time.time() - start
+
+    # The pseudo-inverse loop is timed on a subset and scaled
+    subset = min(pixels, 10000)
+    start = time.time()
+    reference = pinv_coefs(t, nfdi[:, :subset])
+    pinv_time = (time.time() - start) * pixels / subset
+
+    print('pixels x dates:     {0} x {1}'.format(pixels, dates))
+    print('pseudo-inverse:     {0:.2f} s'.format(pinv_time))
+    print('normal equations:   {0:.2f} s ({1:.0f} pixels/s)'.format(
+        batched_time, pixels / batched_time))
+    print('speedup:            {0:.1f}x'.format(pinv_time / batched_time))
+    print('max abs difference: {0:.2e}'.format(
+        np.nanmax(np.abs(batched[:subset] - reference))))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the per-segment medians of postprocess.segment_fz
+
+Times postprocess.segment_medians (one sort by label per band) on a
+synthetic 4 band CDD raster with random rectangular segments, and the
+previous loop over segments with a full-image mask per segment on a
+smaller raster, which is also used to check that both give the same
+medians. The loop time is extrapolated to the full raster by the number
+of segments times pixels.
+
+Usage: bench_segment_fz.py [options]
+
+  --size=SIZE           raster side in pixels (default: 8000)
+  --segment=SEGMENT     mean segment side in pixels (default: 20)
+  --loop-size=LOOP      raster side for the segment loop (default: 500)
+  --nan=NAN             fraction of NaN pixels (default: .01)
+
+"""
+
+from docopt import docopt
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import postprocess
+
+
+def synthetic(size, segment, nan_fraction, seed=0):
+    """ (image (size, size, 4), labels (size, size)) """
+    rng = np.random.RandomState(seed)
+    # Rectangular segments from random row and column cuts
+    rows = np.cumsum(rng.uniform(size=size) < 1. / segment)
+    cols = np.cumsum(rng.uniform(size=size) < 1. / segment)
+    labels = rows[:, np.newaxis] * (cols[-1] + 1) + cols[np.newaxis, :]
+    labels = np.unique(labels, return_inverse=True)[1].reshape(size, size)
+
+    # Change date, magnitude and two positive or zero bands, zero outside
+    # changed segments
+    changed = rng.uniform(size=labels.max() + 1) < .3
+    image = rng.normal(1, 1, (size, size, 4)).astype(np.float32)
+    image[~changed[labels]] = 0
+    image[rng.uniform(size=(size, size, 4)) < nan_fraction] = np.nan
+    return image, labels
+
+
+def loop_medians(full_image, segments_fz):
+    # The previous segment_fz loop
+    median_image = np.zeros_like(full_image).astype(np.float32)
+    for band in range(4):
+        for seg in np.unique(segments_fz):
+            values = full_image[:,:,band][segments_fz == seg]
+            if band >= 2:
+                values[np.isnan(values)] = 0
+            if np.median(values) > 0:
+                med = np.median(values[values>0])
+            else:
+                med = 0
+            median_image[:,:,band][segments_fz == seg] = med
+    return median_image
+
+
+def vectorized_medians(full_image, segments_fz):
+    median_image = np.zeros_like(full_image).astype(np.float32)
+    for band in range(4):
+        medians = postprocess.segment_medians(full_image[:,:,band], segments_fz,
+                                              nan_to_zero=band >= 2)
+        median_image[:,:,band] = medians[segments_fz]
+    return median_image
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    size = int(args['--size']) if args['--size'] else 8000
+    segment = float(args['--segment']) if args['--segment'] else 20
+    loop_size = int(args['--loop-size']) if args['--loop-size'] else 500
+    nan_fraction = float(args['--nan']) if args['--nan'] else .01
+
+    image, labels = synthetic(loop_size, segment, nan_fraction)
+    loop_segments = labels.max() + 1
+    start = time.time()
+    expected = loop_medians(image, labels)
+    loop_time = time.time() - start
+    start = time.time()
+    result = vectorized_medians(image, labels)
+    small_time = time.time() - start
+    print('{0}x{0}, {1} segments: loop {2:.2f} s, vectorized {3:.2f} s, '
+          'max difference {4}'.format(loop_size, loop_segments, loop_time,
+                                      small_time,
+                                      np.abs(result - expected).max()))
+
+    image, labels = synthetic(size, segment, nan_fraction)
+    segments = labels.max() + 1
+    start = time.time()
+    vectorized_medians(image, labels)
+    elapsed = time.time() - start
+    # The loop costs one full-image mask per segment and band
+    loop_estimate = loop_time * (float(segments) * size ** 2 /
+                                 (loop_segments * loop_size ** 2))
+    print('{0}x{0}, {1} segments: vectorized {2:.2f} s, loop estimated '
+          '{3:.0f} s ({4:.0f}x)'.format(size, segments, elapsed, loop_estimate,
+                                        loop_estimate / elapsed))
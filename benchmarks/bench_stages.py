@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark every stage of the local CDD pipeline on synthetic series
+
+For every number of pixels and of monitoring years, generates a synthetic
+series with synthetic.py (6 training years before 2000) and times:
+
+  unmix        cdd_local.unmix of the valid pixels of every acquisition
+  nfdi         cdd_local.get_nfdi of the fractions
+  regression   the training period harmonic regression
+  monitoring   cdd_local.monitor_series over the monitoring period
+  run_cdd      cdd_local.run_cdd, monitoring steps and retrain
+  retrain      cdd_local.regression_retrain of the changed pixels
+  sieve        postprocess.sieve of the run_cdd output
+  fz           postprocess.segment_fz of the run_cdd output
+
+Reports seconds, pixels per second and the peak memory traced by
+tracemalloc (NumPy arrays included) of every stage. Tracing costs little
+for array code, which allocates few large blocks. Also checks that the
+run_cdd change dates find the injected events: the share of event pixels
+detected no earlier than a month before the event, the median detection
+delay, and the share of pixels without an event that changed.
+
+Usage: bench_stages.py [options]
+
+  --pixels=PIXELS   comma separated numbers of pixels, rounded to squares
+                    (default: 2500,10000,40000)
+  --years=YEARS     comma separated numbers of monitoring years from 2000
+                    (default: 4,8,14)
+  --stages=STAGES   comma separated stages (default: all)
+  --seed=SEED       random seed (default: 0)
+  --json=FILE       also write the results to a JSON file
+
+"""
+
+from docopt import docopt
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, memory is not reported
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cdd_local
+import synthetic
+
+STAGES = ('unmix', 'nfdi', 'regression', 'monitoring', 'run_cdd', 'retrain',
+          'sieve', 'fz')
+FIRST_YEAR = 2000
+TRAINING_YEARS = 6
+CF_THRESH = .2
+CHUNK = 65536
+
+
+class Stages(object):
+    """ Seconds and peak traced bytes of every stage, accumulated over
+    the calls of a stage """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.seconds = {}
+        self.peak = {}
+
+    @contextlib.contextmanager
+    def time(self, name):
+        if name not in self.stages:
+            # Run, untimed, what later stages need
+            yield
+            return
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        yield
+        self.seconds[name] = self.seconds.get(name, 0) + time.time() - start
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.peak[name] = max(self.peak.get(name, 0), peak)
+
+
+def nfdi_series(truth, scenes, stages, seed):
+    """ NFDI stack (time, pixels) of the synthetic scenes """
+    nfdi = np.full((len(scenes), truth['gv'].size), np.nan, dtype=np.float32)
+    for i, (date, sensor) in enumerate(scenes):
+        sr, cfmask = synthetic.scene(truth, date, sensor, i, seed)
+        index = np.flatnonzero((cfmask != 2) & (cfmask != 4) & (sr[0] > 0))
+        for start in range(0, len(index), CHUNK):
+            pixels = index[start:start + CHUNK]
+            with stages.time('unmix'):
+                fractions = cdd_local.unmix(sr[:, pixels])
+            with stages.time('nfdi'):
+                nfdi[i, pixels] = cdd_local.get_nfdi(fractions, CF_THRESH)
+    return nfdi
+
+
+def accuracy(truth, change_dates):
+    """ Detection rate and median delay in days of the events, and false
+    alarm rate of the pixels without one """
+    event_dates = truth['date'].ravel()
+    events = event_dates > 0
+    changed = change_dates > 0
+    hits = changed & events & (change_dates >= event_dates - 1 / 12.)
+    delays = (change_dates - event_dates)[hits] * 365.25
+    return {'detection_rate': hits.sum() / float(max(events.sum(), 1)),
+            'median_delay_days': float(np.median(delays)) if hits.any() else None,
+            'false_alarm_rate': (changed & ~events).sum() / float(max((~events).sum(), 1))}
+
+
+def write_output(filename, output, shape):
+    import gdal
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filename, shape[1], shape[0], len(output), gdal.GDT_Float32)
+    for b, band in enumerate(output):
+        dataset.GetRasterBand(b + 1).WriteArray(band.reshape(shape))
+    dataset.FlushCache()
+
+
+def run(pixels, years, stages, seed):
+    """ (results of every stage, accuracy) for one grid point """
+    side = int(round(np.sqrt(pixels)))
+    shape = (side, side)
+    end_year = FIRST_YEAR + years - 1
+    truth = synthetic.make_truth(shape, event_start=FIRST_YEAR,
+                                 event_end=end_year, seed=seed)
+    scenes = synthetic.acquisitions(FIRST_YEAR - TRAINING_YEARS, end_year)
+    dates = [date for date, _ in scenes]
+    sensors = [sensor for _, sensor in scenes]
+    t = cdd_local.years_since_epoch(dates)
+    train = t < cdd_local.years_since_epoch([synthetic.datetime.date(FIRST_YEAR, 1, 1)])[0]
+
+    timer = Stages(stages)
+    nfdi = nfdi_series(truth, scenes, timer, seed)
+    # Compile the numba monitoring scan, if any, before timing it
+    cdd_local.monitor_series(cdd_local.init_status(1), np.zeros((1, 4)),
+                             np.ones(1), t[:1], nfdi[:1, :1], 5, 3.5)
+
+    with timer.time('regression'):
+        stats = cdd_local.RegressionStats(nfdi.shape[1]).update(t[train], nfdi[train])
+        coefs = stats.coefs()
+    if 'monitoring' in stages:
+        tmean = stats.mean_residuals(coefs)
+        with timer.time('monitoring'):
+            cdd_local.monitor_series(cdd_local.init_status(nfdi.shape[1]), coefs,
+                                     tmean, t[~train], nfdi[~train], 5, 3.5)
+
+    result = {}
+    if set(stages) & set(('run_cdd', 'retrain', 'sieve', 'fz')):
+        with timer.time('run_cdd'):
+            output = cdd_local.run_cdd(dates, sensors, nfdi,
+                                       years=range(FIRST_YEAR, end_year + 1, 2))
+        result = accuracy(truth, output[0])
+        with timer.time('retrain'):
+            cdd_local.regression_retrain(t, nfdi, output[0])
+
+    if set(stages) & set(('sieve', 'fz')):
+        import postprocess
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'cdd.tif')
+        write_output(filename, output, shape)
+        with timer.time('sieve'):
+            postprocess.sieve(filename, None, False, processes=1)
+        with timer.time('fz'):
+            postprocess.segment_fz(filename, None, 20, .8, 4, False)
+        shutil.rmtree(directory)
+
+    results = []
+    for name in stages:
+        seconds = timer.seconds.get(name)
+        if seconds is None:
+            continue
+        results.append({'stage': name, 'pixels': side * side, 'years': years,
+                        'observations': len(scenes), 'seconds': seconds,
+                        'pixels_per_second': side * side / seconds if seconds else None,
+                        'peak_bytes': timer.peak.get(name)})
+    return results, dict(result, pixels=side * side, years=years)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    pixels = [int(p) for p in (args['--pixels'] or '2500,10000,40000').split(',')]
+    years = [int(y) for y in (args['--years'] or '4,8,14').split(',')]
+    stages = args['--stages'].split(',') if args['--stages'] else STAGES
+    for name in stages:
+        if name not in STAGES:
+            print('unknown stage {0}, one of {1}'.format(name, ', '.join(STAGES)))
+            sys.exit(1)
+    seed = int(args['--seed']) if args['--seed'] else 0
+
+    all_results = []
+    all_accuracy = []
+    for p in pixels:
+        for y in years:
+            results, detection = run(p, y, stages, seed)
+            print('{0} pixels, {1} years, {2} acquisitions'.format(
+                detection['pixels'], y, results[0]['observations'] if results else '?'))
+            for r in results:
+                peak = r['peak_bytes']
+                print('  {0:>10}: {1:8.2f} s {2:12.0f} pixels/s {3:>10}'.format(
+                    r['stage'], r['seconds'], r['pixels_per_second'] or 0,
+                    '{0:.1f} MB'.format(peak / 1e6) if peak is not None else 'n/a'))
+            if 'detection_rate' in detection:
+                print('  detection rate {0:.1%}, median delay {1} days, false '
+                      'alarm rate {2:.2%}'.format(
+                          detection['detection_rate'],
+                          '{0:.0f}'.format(detection['median_delay_days'])
+                          if detection['median_delay_days'] is not None else 'n/a',
+                          detection['false_alarm_rate']))
+            all_results.extend(results)
+            all_accuracy.append(detection)
+
+    if args['--json']:
+        with open(args['--json'], 'w') as f:
+            json.dump({'stages': all_results, 'accuracy': all_accuracy}, f,
+                      indent=2)
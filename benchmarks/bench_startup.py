@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Benchmark the startup time of the CDD modules
+
+Imports every module in a fresh interpreter, as a batch worker or a test
+would, and reports the fastest and median import times over the repeats,
+and anything the import printed, which should be nothing. Also times the
+modules cdd.py used to import (pandas, matplotlib and pylab) when they
+are installed, and with --importtime lists the slowest imports of every
+module from python -X importtime.
+
+Usage: bench_startup.py [options]
+
+  --modules=MODULES   comma separated modules (default: cdd,cdd_local,postprocess)
+  --repeat=REPEAT     imports per module (default: 10)
+  --importtime        list the slowest imports of every module
+
+"""
+
+from docopt import docopt
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TIMER = ('import time; start = time.time(); import {0}; '
+         'print("\\nseconds %f" % (time.time() - start))')
+PREVIOUS = 'pandas, matplotlib.dates, pylab'
+
+
+def import_time(module):
+    """ (seconds, output printed by the import) in a fresh interpreter """
+    output = subprocess.check_output([sys.executable, '-c', TIMER.format(module)],
+                                     cwd=ROOT, stderr=subprocess.STDOUT)
+    output = output.decode('utf-8', 'replace')
+    printed, _, seconds = output.rpartition('\nseconds ')
+    return float(seconds), printed.strip()
+
+
+def slowest_imports(module, n=10):
+    """ [(cumulative microseconds, imported module)] from -X importtime """
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                                'import {0}'.format(module)], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    imports = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].rstrip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def report(name, module, repeat, optional=False):
+    try:
+        results = [import_time(module) for _ in range(repeat)]
+    except subprocess.CalledProcessError as e:
+        if optional:
+            print('{0:>12}: not installed'.format(name))
+        else:
+            print('{0:>12}: import failed\n{1}'.format(name, e.output.decode(
+                'utf-8', 'replace')))
+        return
+    times = sorted(seconds for seconds, _ in results)
+    printed = results[0][1]
+    print('{0:>12}: min {1:.3f} s, median {2:.3f} s{3}'.format(
+        name, times[0], times[len(times) // 2],
+        ', printed: {0!r}'.format(printed) if printed else ''))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    modules = (args['--modules'] or 'cdd,cdd_local,postprocess').split(',')
+    repeat = int(args['--repeat']) if args['--repeat'] else 10
+
+    for module in modules:
+        report(module, module, repeat)
+    report('previous', PREVIOUS, repeat, optional=True)
+
+    if args['--importtime']:
+        for module in modules:
+            print('{0} slowest imports (cumulative us):'.format(module))
+            for us, imported in slowest_imports(module):
+                print('  {0:>10d} {1}'.format(us, imported))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Synthetic Landsat surface reflectance stacks with known degradation
+
+Every pixel is forest whose endmember fractions follow a seasonal harmonic
+and a trend. Rectangular patches of pixels have a degradation event of
+known date and magnitude: a loss of green vegetation to non-photosynthetic
+vegetation, which recovers exponentially. Acquisitions follow the 16 day
+revisit of each sensor over its operating period, Landsat 7 8 days apart
+from Landsat 5 and 8. They have clouds flagged in cfmask, some haze
+that cfmask misses, and the SLC-off gaps of Landsat 7 from June 2003.
+Reflectance is the mixture of the cdd_local endmembers plus noise.
+
+Writes one stack per acquisition in the layout read by cdd_local.py, named
+after the Landsat scene ID, and truth.npz with the event date (fractional
+years since 1970, as the CDD change date, 0 without an event), magnitude
+(green vegetation fraction lost) and recovery time in years of every pixel
+as (rows, cols) arrays.
+
+Usage: synthetic.py [options] <directory>
+
+  --size=SIZE         raster side in pixels (default: 100)
+  --start=START       first year of acquisitions (default: 1994)
+  --end=END           last year of acquisitions (default: 2014)
+  --events=EVENTS     fraction of pixels with an event (default: .2)
+  --event-start=YEAR  first year of the events (default: 2000)
+  --seed=SEED         random seed (default: 0)
+
+"""
+
+from docopt import docopt
+import datetime
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cdd_local
+
+# ** ACQUISITIONS **
+
+# First and last acquisition of every sensor, None while it is operating
+SENSOR_PERIODS = {'LT5': (datetime.date(1984, 3, 16), datetime.date(2011, 11, 18)),
+                  'LE7': (datetime.date(1999, 4, 24), None),
+                  'LC8': (datetime.date(2013, 4, 11), None)}
+REVISIT = 16
+SLC_OFF = datetime.date(2003, 5, 31)
+SENSOR_IDS = {'LT5': ('T', 5), 'LE7': ('E', 7), 'LC8': ('C', 8)}
+
+def acquisitions(start_year, end_year, sensors=('LT5', 'LE7', 'LC8')):
+    """ Sorted (date, sensor) of the acquisitions from start_year to the end
+    of end_year """
+    start = datetime.date(start_year, 1, 1)
+    end = datetime.date(end_year, 12, 31)
+    result = []
+    for sensor in sensors:
+        first, last = SENSOR_PERIODS[sensor]
+        last = min(last or end, end)
+        date = first
+        if date < start:
+            date += datetime.timedelta((start - date).days // REVISIT * REVISIT)
+        while date <= last:
+            if date >= start:
+                result.append((date, sensor))
+            date += datetime.timedelta(REVISIT)
+    return sorted(result)
+
+# ** PIXELS **
+
+def make_truth(shape, events=.2, event_start=2000, event_end=2014, seed=0):
+    """ Fraction model and events of every pixel, arrays of shape
+
+    Events start between the beginning of event_start and the middle of
+    event_end, in patches of 2 to 15 pixels a side, until a fraction events
+    of the pixels has one.
+    """
+    rng = np.random.RandomState(seed)
+    truth = {
+        'gv': rng.uniform(.7, .85, shape),
+        'npv': rng.uniform(.05, .15, shape),
+        'soil': rng.uniform(.02, .08, shape),
+        'amplitude': rng.uniform(.02, .06, shape),
+        'phase': rng.uniform(0, 2 * np.pi, shape),
+        # Change of the green vegetation fraction per year
+        'trend': rng.normal(0, .002, shape),
+        'date': np.zeros(shape),
+        'magnitude': np.zeros(shape),
+        'recovery': np.zeros(shape),
+    }
+    first, last = cdd_local.years_since_epoch(
+        [datetime.date(event_start, 1, 1), datetime.date(event_end, 7, 1)])
+    while (truth['date'] > 0).mean() < events:
+        h, w = rng.randint(2, 16, 2)
+        y, x = rng.randint(0, shape[0]), rng.randint(0, shape[1])
+        patch = (slice(y, y + h), slice(x, x + w))
+        truth['date'][patch] = rng.uniform(first, last)
+        truth['magnitude'][patch] = rng.uniform(.05, .35)
+        truth['recovery'][patch] = rng.uniform(1, 6)
+    return truth
+
+def fractions(truth, t):
+    """ Noise free gv, shade, npv, soil, cloud fractions (5, pixels) at t,
+    in fractional years since 1970 """
+    gv = (truth['gv'] + truth['amplitude'] * np.sin(2 * np.pi * t + truth['phase'])
+          + truth['trend'] * (t - 30)).ravel()
+    since = (t - truth['date']).ravel()
+    event = (truth['date'].ravel() > 0) & (since >= 0)
+    loss = np.zeros(gv.shape)
+    loss[event] = (truth['magnitude'].ravel()[event] *
+                   np.exp(-since[event] / truth['recovery'].ravel()[event]))
+    loss = np.minimum(loss, gv)
+    gv = np.clip(gv - loss, 0, 1)
+    npv = truth['npv'].ravel() + loss
+    soil = truth['soil'].ravel()
+    shade = np.maximum(1 - gv - npv - soil, 0)
+    result = np.array([gv, shade, npv, soil, np.zeros(gv.shape)])
+    return result / result.sum(axis=0)
+
+# ** SCENES **
+
+def coarse_mask(rng, shape, fraction, cell=8):
+    # Blobs of cell pixels a side covering about fraction of the image
+    coarse = rng.uniform(size=(shape[0] // cell + 1, shape[1] // cell + 1)) < fraction
+    return np.kron(coarse, np.ones((cell, cell), dtype=bool))[:shape[0], :shape[1]].ravel()
+
+def scene(truth, date, sensor, index, seed=0, noise=100):
+    """ SR bands B1 B2 B3 B4 B5 B7 (6, pixels) int16 and cfmask (pixels,)
+    of one acquisition, the index-th of the series """
+    shape = truth['gv'].shape
+    rng = np.random.RandomState([seed, index])
+    t = cdd_local.years_since_epoch([date])[0]
+    cloud = cdd_local.ENDMEMBERS[:, 4][:, np.newaxis]
+
+    sr = cdd_local.ENDMEMBERS.dot(fractions(truth, t))
+    sr += rng.normal(0, noise, sr.shape)
+    cover = rng.uniform(0, .6)
+    clouds = coarse_mask(rng, shape, cover)
+    sr[:, clouds] = cloud + rng.normal(0, noise, (sr.shape[0], clouds.sum()))
+    # Haze that cfmask misses
+    haze = coarse_mask(rng, shape, cover * .1) & ~clouds
+    sr[:, haze] = .5 * sr[:, haze] + .5 * cloud
+
+    cfmask = np.zeros(sr.shape[1], dtype=np.uint8)
+    cfmask[clouds] = 4
+    sr = np.clip(np.round(sr), 1, 16000).astype(np.int16)
+    if sensor == 'LE7' and date >= SLC_OFF:
+        rows, cols = np.indices(shape)
+        gaps = ((cols + rows // 3) % 14 < 3).ravel()
+        sr[:, gaps] = -9999
+        cfmask[gaps] = 255
+    return sr, cfmask
+
+def scene_filename(date, sensor, path=225, row=68):
+    letter, number = SENSOR_IDS[sensor]
+    return 'L{0}{1}{2:03d}{3:03d}{4}{5:03d}SYN00_sr.tif'.format(
+        letter, number, path, row, date.year, date.timetuple().tm_yday)
+
+def write_stack(filename, sr, cfmask, sensor, shape):
+    """ Write a stack as read by cdd_local.read_scene """
+    import gdal
+    if sensor == 'LC8':
+        # Coastal band first, B1 stands in for it
+        sr = np.concatenate([sr[:1], sr])
+    bands = np.concatenate([sr, cfmask[np.newaxis].astype(np.int16)])
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filename, shape[1], shape[0], len(bands), gdal.GDT_Int16)
+    dataset.SetGeoTransform((0, 30, 0, 0, 0, -30))
+    for b, band in enumerate(bands):
+        dataset.GetRasterBand(b + 1).WriteArray(band.reshape(shape))
+    dataset.FlushCache()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    size = int(args['--size']) if args['--size'] else 100
+    start_year = int(args['--start']) if args['--start'] else 1994
+    end_year = int(args['--end']) if args['--end'] else 2014
+    events = float(args['--events']) if args['--events'] else .2
+    event_start = int(args['--event-start']) if args['--event-start'] else 2000
+    seed = int(args['--seed']) if args['--seed'] else 0
+    directory = args['<directory>']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    truth = make_truth((size, size), events, event_start, end_year, seed)
+    np.savez_compressed(os.path.join(directory, 'truth.npz'), **truth)
+    scenes = acquisitions(start_year, end_year)
+    for i, (date, sensor) in enumerate(scenes):
+        sr, cfmask = scene(truth, date, sensor, i, seed)
+        write_stack(os.path.join(directory, scene_filename(date, sensor)), sr,
+                    cfmask, sensor, (size, size))
+    print('{0} acquisitions, {1:.1%} of the pixels with an event'.format(
+        len(scenes), (truth['date'] > 0).mean()))
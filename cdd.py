@@ -14,86 +14,150 @@ Usage: GE_cdd.py [options] <output>
   --forest=FOREST   forest % cover threshold (default: 30)
   --aoi             Use an area of interest (must hard code)
   --cf=CF_THRESH    Cloud frqction threshold
+  --window=WINDOW   Sliding training window in years, at least 2 (default: none)
+  --start=START     first monitoring year (default: 2000)
+  --end=END         last monitoring year (default: 2014)
+  --stride=STRIDE   years monitored per step (default: 2)
+  --checkpoint=ASSET  Asset prefix for the monitoring state after each step,
+                    a rerun with the same parameters resumes after the last
+                    saved step
+  --graph-report=FILE  Write the computation graph size of each stage to a JSON report
+  --profile=FILE    Write the time and memory of the input, monitoring, retrain
+                    and export stages to a JSON and Chrome trace file, see
+                    profiling.py (default: the CDD_PROFILE environment variable)
 
 """
 
 from docopt import docopt
-import os,sys
-import numpy as np
-import datetime
-import pandas as pd
-import matplotlib.dates as mdates
-from matplotlib import dates
-from pylab import *
-
-#Import pycc and earth engine
+import os,sys,json,time,math
+
+#Import earth engine
 import ee
-import ccd
 
-# Initialize Earth Engine
-ee.Initialize()
-print('Earth Engine Initialized')
+import profiling
 
-# Parse arguments
-if __name__ == '__main__':
-    args = docopt(__doc__, version='0.6.2')
+# Earth Engine is initialized by the first run that needs it, so importing
+# this module has no side effects
+_initialized = False
+
+def initialize():
+  # Initialize Earth Engine once
+  global _initialized
+  if not _initialized:
+    ee.Initialize()
+    print('Earth Engine Initialized')
+    _initialized = True
+
+# ** PARAMETERS **
 
 path = None
 row = None
 pathrow = False
-if args['--path']:
-    path = int(args['--path'])
-    pathrow = True
+consec = 5
+thresh = 3.5
+forest_threshold = 30
+cloud_score = 30
+cf_thresh = .2
+window = None
+aoi = False
+start_year = 2000
+end_year = 2014
+stride = 2
+checkpoint = None
+
+# Retraining period after the monitoring
+RETRAIN_YEAR = 2011
+
+def set_params(args):
+  # Set the parameters from docopt arguments
+  global path, row, pathrow, consec, thresh, forest_threshold, cloud_score, cf_thresh, window, aoi
+  global start_year, end_year, stride, checkpoint
+
+  path = None
+  row = None
+  pathrow = False
+  if args['--path']:
+      path = int(args['--path'])
+      pathrow = True
+
+  if args['--row']:
+      row = int(args['--row'])
+  elif pathrow:
+      print('need to supply row with path')
+      sys.exit()
+
+  if args['--consec']:
+      consec = int(args['--consec'])
+  else:
+      consec = 5
 
-if args['--row']:
-    row = int(args['--row'])
-elif pathrow:
-    print('need to supply row with path')
-    sys.exit()
+  if args['--thresh']:
+      thresh = float(args['--thresh'])
+  else:
+      thresh = 3.5
 
-if args['--consec']:
-    consec = int(args['--consec'])
-else:
-    consec = 5
+  if args['--forest']:
+      forest_threshold = int(args['--forest'])
+  else:
+      forest_threshold = 30
 
+  if args['--cloud']:
+      cloud_score = int(args['--cloud'])
+  else:
+      cloud_score = 30
+
+  if args['--cf']:
+      cf_thresh = float(args['--cf'])
+  else:
+      cf_thresh = .2
 
-if args['--thresh']:
-    thresh = float(args['--thresh'])
-else:
-    thresh = 3.5
+  if args['--window']:
+      window = int(args['--window'])
+  else:
+      window = None
 
-if args['--forest']:
-    forest_threshold = int(args['--forest'])
-else:
-    forest_threshold = 30
+  aoi = False
+  if args['--aoi']:
+      aoi = True
 
-if args['--cloud']:
-    cloud_score = int(args['--cloud'])
-else:
-    cloud_score = 30
+  if args['--start']:
+      start_year = int(args['--start'])
+  else:
+      start_year = 2000
 
-if args['--cf']:
-    cf_thresh = float(args['--cf'])
-else:
-    cf_thresh = .2
+  if args['--end']:
+      end_year = int(args['--end'])
+  else:
+      end_year = 2014
 
+  if args['--stride']:
+      stride = int(args['--stride'])
+  else:
+      stride = 2
 
-aoi = False
-if args['--aoi']:
-    aoi = True
+  checkpoint = args['--checkpoint']
 
-output=str(args['<output>'])
-print(output)
+def get_years():
+  # Monitoring years, each step monitors stride years
+  return list(range(start_year, end_year + 1, stride))
 
 #GLOBALS
-global AOI
 
 # Good roads in 225 68
-AOI = ee.Geometry.Polygon(
-        [[[-53.778076171875, -10.692996347925074],
-          [-53.81927490234375, -11.183790773046617],
-          [-53.35784912109375, -11.108337084308145],
-          [-53.3441162109375, -10.763159330300516]]])
+AOI_COORDS = [[[-53.778076171875, -10.692996347925074],
+               [-53.81927490234375, -11.183790773046617],
+               [-53.35784912109375, -11.108337084308145],
+               [-53.3441162109375, -10.763159330300516]]]
+
+# Building a geometry needs an initialized Earth Engine, so the AOI is
+# built by the first run that uses it
+_aoi = None
+
+def get_aoi():
+  global _aoi
+  if _aoi is None:
+    _aoi = ee.Geometry.Polygon(AOI_COORDS)
+  return _aoi
 
 # spectral endmembers from Souza (2005).
 #gv= [500, 900, 400, 6100, 3000, 1000]
@@ -119,10 +183,20 @@ cloud = [9000, 9600, 8000, 7800, 7200, 6500]
 
 
 # Hansen forest cover
-if aoi:
-    forest2000 = ee.Image('UMD/hansen/global_forest_change_2015_v1_3').select('treecover2000').clip(AOI)
-else:
-    forest2000 = ee.Image('UMD/hansen/global_forest_change_2015_v1_3').select('treecover2000')
+def get_forest2000():
+  if aoi:
+    return ee.Image('UMD/hansen/global_forest_change_2015_v1_3').select('treecover2000').clip(get_aoi())
+  else:
+    return ee.Image('UMD/hansen/global_forest_change_2015_v1_3').select('treecover2000')
+
+# Mask the pixels outside the forest (and the AOI) in every input image, so
+# cloud scores, unmixing and the regressions only compute forest pixels
+def mask_forest(image):
+  forest = get_forest2000().gt(ee.Image(forest_threshold))
+  if aoi:
+    return ee.Image(image).updateMask(forest).clip(get_aoi())
+  else:
+    return ee.Image(image).updateMask(forest)
 
 # ** FUNCTIONS **
 
@@ -152,7 +226,7 @@ def makeVariables(image):
   # Compute time of the image in fractional years relative to the Epoch.
   year = ee.Image(image.date().difference(ee.Date('1970-01-01'), 'year')) # this is the years since 1970
   # Compute the season in radians, one cycle per year.
-  season = year.multiply(2 * np.pi)
+  season = year.multiply(2 * math.pi)
   # Return an image of the predictors followed by the response.
   return image.select().addBands(ee.Image(1)).addBands(
     year.rename(['t'])).addBands(
@@ -160,6 +234,10 @@ def makeVariables(image):
     season.cos().rename(['cos'])).addBands(
     image.select(['NFDI'])).toFloat()
 
+# Mask the predictors where the response is masked
+def mask_variables(image):
+  return image.updateMask(image.select('NFDI').mask())
+
 # Add coefficients to image
 def addcoefs(image):
   newimage = ee.Image(image).addBands(ee.Image(coefficientsImage))
@@ -189,10 +267,7 @@ def pred_middle_retrain(retrain_middle, retrain_coefs):
       'coef_trend': ee.Image(image).select('Slope'),
       'constant': ee.Image(image).select('Intercept')
     })
-  if aoi:
-      return pred_nfdi_imd.clip(AOI)
-  else:
-      return pred_nfdi_imd
+  return pred_nfdi_imd
 
 # Add standard deviation band
 def addmean(image):
@@ -297,207 +372,38 @@ def monitor_func(image, new_image):
 
 def mask_57(img):
   mask = img.select(['cfmask']).neq(4).And(img.select(['cfmask']).neq(2)).And(img.select('B1').gt(ee.Image(0)))
-  if aoi:
-    return img.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7']).clip(AOI)
-  else:
-    return img.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
+  return img.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
 
 def mask_8(img):
   mask = img.select(['cfmask']).neq(4).And(img.select(['cfmask']).neq(2)).And(img.select('B2').gt(ee.Image(0)))
-  if aoi:
-    return ee.Image(img.updateMask(mask).select(['B2', 'B3','B4','B5','B6','B7']).rename(['B1','B2','B3','B4','B5','B7'])).clip(AOI)
-  else:
-    return ee.Image(img.updateMask(mask).select(['B2', 'B3','B4','B5','B6','B7']).rename(['B1','B2','B3','B4','B5','B7']))
+  return ee.Image(img.updateMask(mask).select(['B2', 'B3','B4','B5','B6','B7']).rename(['B1','B2','B3','B4','B5','B7']))
 
 def get_inputs_training(_year, path, row):
-  
-  # Get inputs for training period
-  year = _year - 1
-  train_year_start = str(_year - 6) 
-  train_start = train_year_start + '-01-01'
-  train_end = str(year) + '-12-31'
-
-  if pathrow:  
-    train_collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      ).filterDate(train_start, train_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  
-    train_collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(train_start, train_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  else:
-    train_collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      ).filterDate(train_start, train_end
-      ).filterBounds(AOI)
- 
-    train_collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(train_start, train_end
-      ).filterBounds(AOI)
-  # Mask clouds
-                   
-  train_col7_noclouds = train_collection7.map(mask_57).map(add_cloudscore7)
-                   
-  train_col5_noclouds = train_collection5.map(mask_57).map(add_cloudscore5)
-  
-  train_col_noclouds = train_col7_noclouds.merge(train_col5_noclouds)
-
-  # Training collection unmixed
-  
-  train_col_unmix = train_col_noclouds.map(unmix)
-
-  # Collection NFDI
-  train_nfdi = ee.ImageCollection(train_col_unmix.map(get_nfdi)).sort('system:time_start')
-
-  return train_nfdi
+  # Get inputs for training period: the six years before _year
+  return get_inputs(_year - 6, _year - 1, ['LE7', 'LT5'])
 
 def get_inputs_monitoring(year, path, row):
-
-  # Get inputs for monitoring period
-
-  monitor_start = str(year) + '-01-01'
-  monitor_end = str(year + 1) + '-12-31'
-  
-  if pathrow: 
-    collection8 = ee.ImageCollection('LANDSAT/LC8_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  
-    collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  
-    collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  else:
-    collection8 = ee.ImageCollection('LANDSAT/LC8_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-  
-    collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-  
-    collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-  
-  # Mask clouds
-  col8_noclouds = collection8.map(mask_8).map(add_cloudscore8)
-
-  col7_noclouds = collection7.map(mask_57).map(add_cloudscore7)
-                   
-  col5_noclouds = collection5.map(mask_57).map(add_cloudscore5)
-  
-  # merge
-  col_l87noclouds = col8_noclouds.merge(col7_noclouds)
-  col_noclouds = col_l87noclouds.merge(col5_noclouds)
-
-  # Training collection unmixed
-
-  col_unmix = col_noclouds.map(unmix)
-
-  # Collection NFDI
-  nfdi = ee.ImageCollection(col_unmix.map(get_nfdi)).sort('system:time_start')
-
-  return nfdi
+  # Get inputs for monitoring period: stride years from year
+  return get_inputs(year, year + stride - 1, ['LC8', 'LE7', 'LT5'])
 
 def get_inputs_retrain(year, path, row):
+  # Get inputs for the retraining period: year and the following year
+  return get_inputs(year, year + 1, ['LC8', 'LE7', 'LT5'])
 
-  # Get inputs for monitoring period
 
-  monitor_start = str(year) + '-01-01'
-  year_end = year + 1
-  monitor_end = str(year_end) + '-12-31'
-  
-  if pathrow: 
-    collection8 = ee.ImageCollection('LANDSAT/LC8_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  
-    collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  
-    collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row))
-  else:
-    collection8 = ee.ImageCollection('LANDSAT/LC8_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-  
-    collection7 = ee.ImageCollection('LANDSAT/LE7_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-  
-    collection5 = ee.ImageCollection('LANDSAT/LT5_SR'
-      # Filter to get only two years of data.
-      ).filterDate(monitor_start, monitor_end
-      ).filterBounds(AOI)
-
-  # Mask clouds
-  col8_noclouds = collection8.map(mask_8).map(add_cloudscore8) 
-
-  col7_noclouds = collection7.map(mask_57).map(add_cloudscore7)
-                   
-  col5_noclouds = collection5.map(mask_57).map(add_cloudscore5)
-  
-  # merge
-  col_l87noclouds = col8_noclouds.merge(col7_noclouds)
-  col_noclouds = col_l87noclouds.merge(col5_noclouds)
-
-  # Training collection unmixed
-
-  col_unmix = col_noclouds.map(unmix)
-
-  # Collection NFDI
-  nfdi = ee.ImageCollection(col_unmix.map(get_nfdi)).sort('system:time_start')
-
-  return nfdi
-
-
-def get_regression_coefs(train_array):
+def get_regression_coefs(train_collection):
   # Get regression coefficients for the training period
-  
-  # Define the axes of iation in the collection array.
-  imageAxis = 0
-  bandAxis = 1
-
 
-  # Check the length of the image axis (number of images).
-  arrayLength = train_array.arrayLength(imageAxis)
-  # Update the mask to ensure that the number of images is greater than or
-  # equal to the number of predictors (the linear model is solveable).
-  train_array = train_array.updateMask(arrayLength.gt(4))
+  # Ensure that the number of images is greater than the number of
+  # predictors (the linear model is solveable). Masked observations are
+  # skipped by the reducer.
+  count = ee.ImageCollection(train_collection).select('NFDI').count()
 
-  # Get slices of the array according to positions along the band axis.
-  predictors = train_array.arraySlice(bandAxis, 0, 4)
-  response = train_array.arraySlice(bandAxis, 4)
-    
-  # coefficients = predictors.matrixSolve(response)
-  coefficients = predictors.matrixPseudoInverse().matrixMultiply(response)
+  # Solve every pixel with a linear regression reducer over the collection
+  # (predictors constant, t, sin, cos; response NFDI)
+  regression = ee.ImageCollection(train_collection).map(mask_variables).select(
+    ['constant', 't', 'sin', 'cos', 'NFDI']).reduce(ee.Reducer.linearRegression(4, 1))
+  coefficients = regression.select('coefficients').updateMask(count.gt(4))
 
   # Turn the results into a multi-band image.
   global coefficientsImage
@@ -505,19 +411,65 @@ def get_regression_coefs(train_array):
 
   return coefficientsImage
 
-def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, first, tmean):
+# Sufficient statistics of the regression, one band per element:
+# X'X (4x4), X'y (4), y'y and the number of observations n
+PREDICTORS = ['constant', 't', 'sin', 'cos']
+XTX_BANDS = ['xtx_%d%d' % (i, j) for i in range(4) for j in range(4)]
+XTY_BANDS = ['xty_%d' % i for i in range(4)]
+STATS_BANDS = XTX_BANDS + XTY_BANDS + ['yty', 'n']
+
+def get_stats(image):
+  # Contribution of one observation (makeVariables image) to the statistics
+  variables = ee.Image(image).toDouble()
+  x = [variables.select(p) for p in PREDICTORS]
+  y = variables.select('NFDI')
+  xtx = [x[i].multiply(x[j]) for i in range(4) for j in range(4)]
+  xty = [x[i].multiply(y) for i in range(4)]
+  stats = ee.Image.cat(xtx + xty + [y.multiply(y), ee.Image(1).toDouble()])
+  return stats.rename(STATS_BANDS).updateMask(y.mask())
+
+def sum_stats(collection):
+  # Statistics of a makeVariables collection. Masked observations are skipped
+  zero = ee.Image.constant([0] * len(STATS_BANDS)).toDouble().rename(STATS_BANDS)
+  return ee.ImageCollection([zero]).merge(ee.ImageCollection(collection).map(get_stats)).sum()
+
+def get_training_stats(train_nfdi, year):
+  # Statistics of the training period before the first monitoring year
+  if window:
+    train_nfdi = ee.ImageCollection(train_nfdi).filterDate(str(year - window) + '-01-01', str(year) + '-01-01')
+  return sum_stats(ee.ImageCollection(train_nfdi).map(makeVariables))
+
+def stats_arrays(stats):
+  xtx = ee.Image(stats).select(XTX_BANDS).toArray().arrayReshape(ee.Image([4, 4]).toArray(), 2)
+  xty = ee.Image(stats).select(XTY_BANDS).toArray().toArray(1)
+  return xtx, xty
+
+def stats_coefs(stats):
+  # Regression coefficients from the statistics, solveable if n > 4
+  xtx, xty = stats_arrays(stats)
+  coefficients = xtx.matrixPseudoInverse().matrixMultiply(xty)
+  return coefficients.arrayProject([0]).arrayFlatten([['coef_constant', 'coef_trend', 'coef_sin', 'coef_cos']]
+    ).updateMask(ee.Image(stats).select('n').gt(4))
+
+def stats_mean_residuals(stats, coefs):
+  # Root mean square residual of coefs over the observations:
+  # sqrt((y'y - 2 b'X'y + b'X'X b) / n)
+  xtx, xty = stats_arrays(stats)
+  b = ee.Image(coefs).toArray().toArray(1)
+  bxty = b.arrayTranspose().matrixMultiply(xty).arrayGet([0, 0])
+  bxtxb = b.arrayTranspose().matrixMultiply(xtx).matrixMultiply(b).arrayGet([0, 0])
+  rss = ee.Image(stats).select('yty').subtract(bxty.multiply(2)).add(bxtxb).max(ee.Image(0))
+  return rss.divide(ee.Image(stats).select('n')).sqrt().rename(['mean_res'])
+
+def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, train_stats, first, tmean):
  # Main function for monitoring, should be looped over for each year
+  global coefficientsImage, train_nfdi_mean
 
   # * REGRESSION
 
-  # train array = nfdi collection as arrays
-  train_array = ee.ImageCollection(train_nfdi).map(makeVariables).toArray()
-
-  # train_all = train array with temporal iables attached
-  train_all = ee.ImageCollection(train_nfdi).map(makeVariables)
-
   # coefficients image = image with regression coefficients (intercept, slope, sin, cos) for each pixel
-  _coefficientsImage = get_regression_coefs(train_array)
+  # solved from the sufficient statistics of the training period
+  _coefficientsImage = stats_coefs(train_stats)
   
   # check change status. If mid-change - use last year's coefficients. 
   is_changing = ee.Image(ts_status).select("band_2").gt(ee.Image(0)).Or(ee.Image(ts_status).select('band_1').eq(ee.Image(0)))
@@ -527,25 +479,14 @@ def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, first, tme
   old_changing_coefs = ee.Image(is_changing).multiply(ee.Image(old_coefs))
   current_coefs_nochange = ee.Image(not_changing).multiply(ee.Image(_coefficientsImage))
 
-  global coefficientsImage
   coefficientsImage = old_changing_coefs.add(current_coefs_nochange)
 
   #Get Tmean = mean NFDI residuals
   # If not in the middle of a change - use tmean for current training period
   # Else - use last year's
   if first:
-    train_coefs = ee.ImageCollection(train_all).map(addcoefs)
-
-    # predict_nfdi_train = predicted NFDI based on regression coefficients for each image in training period
-    predict_nfdi_train = ee.ImageCollection(train_coefs).map(predict_nfdi)
-
-    # train_nfdi_mean = mean normalized residuals for the training period
-    #Current year tmean = mean abs() residuals
-    global train_nfdi_mean
-#    train_nfdi_mean = predict_nfdi_train.map(get_mean_residuals).mean().rename(['mean_res'])
-#    _train_nfdi_mean = train_nfdi_mean
-    train_nfdi_sq_res = predict_nfdi_train.map(get_mean_residuals).mean()
-    train_nfdi_mean = ee.Image(train_nfdi_sq_res).sqrt().rename(['mean_res'])
+    # train_nfdi_mean = root mean square residuals for the training period
+    train_nfdi_mean = stats_mean_residuals(train_stats, coefficientsImage)
     _train_nfdi_mean = train_nfdi_mean
 
   else:
@@ -555,21 +496,12 @@ def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, first, tme
 
     not_changing_mag = ee.Image(is_changing_mag).eq(ee.Image(0))
 
-    train_coefs = ee.ImageCollection(train_all).map(addcoefs)
-
-    # predict_nfdi_train = predicted NFDI based on regression coefficients for each image in training period
-    predict_nfdi_train = ee.ImageCollection(train_coefs).map(predict_nfdi)
-
-    # train_nfdi_mean = mean normalized residuals for the training period
-    #Current year tmean = mean abs() residuals
-    #_train_nfdi_mean = predict_nfdi_train.map(get_mean_residuals).mean().rename(['mean_res'])
-    _train_nfdi_sq_res = predict_nfdi_train.map(get_mean_residuals).mean()
-    _train_nfdi_mean = ee.Image(_train_nfdi_sq_res).sqrt().rename(['mean_res'])
+    # Current year tmean = root mean square residuals
+    _train_nfdi_mean = stats_mean_residuals(train_stats, coefficientsImage)
 
     old_changing_tmean = ee.Image(is_changing_mag).multiply(ee.Image(tmean))
     current_tmean_nochange = ee.Image(not_changing_mag).multiply(ee.Image(_train_nfdi_mean))
 
-    global train_nfdi_mean
     train_nfdi_mean = old_changing_tmean.add(current_tmean_nochange).rename(['mean_res'])
 
 
@@ -602,7 +534,15 @@ def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, first, tme
   # combine monitoring nfdi with training
   new_training = ee.ImageCollection(train_nfdi).merge(monitor_nfdi).sort('system:time_start')
 
-  return ee.List([results, coefficientsImage, new_training, _train_nfdi_mean])
+  # Update the training statistics with the monitoring observations only
+  new_stats = ee.Image(train_stats).add(sum_stats(monitor_collection))
+  if window:
+    # and remove the observations that fall out of the next training window,
+    # monitoring observations included when the window is shorter than a step
+    dropped = new_training.filterDate(str(year - window) + '-01-01', str(year + stride - window) + '-01-01')
+    new_stats = new_stats.subtract(sum_stats(dropped.map(makeVariables)))
+
+  return ee.List([results, coefficientsImage, new_training, _train_nfdi_mean, new_stats])
 
 
 # Retraining
@@ -610,111 +550,261 @@ def deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, first, tme
 def mask_nochange(image):
   # mask retrain stack if there has been no change
   ischanged = ee.Image(change_dates).gt(ee.Image(0))
-  if aoi:
-      return ee.Image(image).updateMask(ischanged).clip(AOI)
-  else:
-      return ee.Image(image).updateMask(ischanged)
+  return ee.Image(image).updateMask(ischanged)
 
-def mask_beforechange(image):
-  # mask retrain stack before change
-  im_date = ee.Image(image).metadata('system:time_start').divide(ee.Image(315576e5))
-  skip_year = change_dates.add(ee.Image(1))
-  af_change = im_date.gt(skip_year)
-  if aoi:
-      return ee.Image(image).updateMask(af_change).clip(AOI)
-  else:
-      return ee.Image(image).updateMask(af_change)
+def get_obs_date(image):
+  # Date of the image in years since 1970 where it has an observation
+  return ee.Image(image).metadata('system:time_start').divide(ee.Image(31557600000)).updateMask(
+    ee.Image(image).select('NFDI').mask()).rename(['years'])
 
 def regression_retrain(original_collection, year, path, row):
   # get a few more years data
   y1_data = get_inputs_retrain(year, path, row)
   
-  full_data_nomask = original_collection.merge(y1_data).sort('system:time_start')
+  full_data_nomask = original_collection.merge(y1_data)
 
   stack_nochange_masked = full_data_nomask.map(mask_nochange)
   
-  stack_masked= stack_nochange_masked.map(mask_beforechange)
-  
   #run regression on data after a change
   train_iables = ee.ImageCollection(stack_nochange_masked).map(makeVariables)
-  
-  train_array = train_iables.toArray()
 
   # coefficients image = image with regression coefficients (intercept, slope, sin, cos) for each pixel
-  _coefficientsImage = get_regression_coefs(train_array)
-  
-  coefficientsImage = _coefficientsImage 
-  
-  retrain_with_coefs = ee.ImageCollection(train_iables).map(addcoefs)
-  
-  retrain_predict1 = ee.ImageCollection(retrain_with_coefs).map(predict_nfdi)
-  
-  retrain_predict2 = ee.ImageCollection(retrain_predict1).map(mask_nochange)
-  
-  retrain_predict = ee.ImageCollection(retrain_predict1).map(mask_beforechange)
-  
-  return ee.List([_coefficientsImage.rename(['Intercept', 'Slope','Sin','Cos']), retrain_predict])
-
-
-def add_cloudscore5(image):
-   thedate = image.date()
-   date_bef = thedate.advance(-1, 'day')
-   date_aft = thedate.advance(1,'day')
-   toa = ee.ImageCollection('LANDSAT/LT05/C01/T1_TOA'
-      ).filterDate(date_bef, date_aft
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row)
-      ).first()
-   cs = ee.Algorithms.If(
-    ee.Image(toa),
-    ee.Image(ee.Algorithms.Landsat.simpleCloudScore(ee.Image(toa))).select('cloud'),
-    ee.Image(0).rename(['cloud']))
+  _coefficientsImage = get_regression_coefs(train_iables)
 
-   mask = ee.Image(cs).lt(ee.Image(cloud_score))
-   if aoi:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7']).clip(AOI)
-   else:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
-
-def add_cloudscore7(image):
-   thedate = image.date()
-   date_bef = thedate.advance(-1, 'day')
-   date_aft = thedate.advance(1,'day')
-   toa = ee.ImageCollection('LANDSAT/LE07/C01/T1_TOA'
-      ).filterDate(date_bef, date_aft
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row)
-      ).first()
-   cs = ee.Algorithms.If(
-    ee.Image(toa),
-    ee.Image(ee.Algorithms.Landsat.simpleCloudScore(ee.Image(toa))).select('cloud'),
-    ee.Image(0).rename(['cloud']))
+  # last_date = date of the last observation of every changed pixel, a
+  # per-pixel reduction over the whole stack however many images it has
+  last_date = ee.ImageCollection(stack_nochange_masked).map(get_obs_date).max()
 
-   mask = ee.Image(cs).lt(ee.Image(cloud_score))
-   if aoi:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7']).clip(AOI)
-   else:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
-
-def add_cloudscore8(image):
-   thedate = image.date()
-   date_bef = thedate.advance(-1, 'day')
-   date_aft = thedate.advance(1,'day')
-   toa = ee.ImageCollection('LANDSAT/LC08/C01/T1_TOA'
-      ).filterDate(date_bef, date_aft
-      ).filter(ee.Filter.eq('WRS_PATH', path)
-      ).filter(ee.Filter.eq('WRS_ROW', row)
-      ).first()
+  return ee.List([_coefficientsImage.rename(['Intercept', 'Slope','Sin','Cos']), last_date])
+
+
+# Cloud score of the TOA scene matched to each SR image, stored as the
+# cloud_score property by join_cloudscore
+def add_cloudscore(image):
    cs = ee.Algorithms.If(
-    ee.Image(toa),
-    ee.Image(ee.Algorithms.Landsat.simpleCloudScore(ee.Image(toa))).select('cloud'),
+    image.get('cloud_score'),
+    ee.Image(image.get('cloud_score')),
     ee.Image(0).rename(['cloud']))
-     
+
    mask = ee.Image(cs).lt(ee.Image(cloud_score))
-   if aoi:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7']).clip(AOI)
-   else:
-     return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
+   return image.updateMask(mask).select(['B1','B2', 'B3','B4','B5','B7'])
+
+def get_cloudscore(image):
+  score = ee.Algorithms.Landsat.simpleCloudScore(ee.Image(image)).select('cloud')
+  return ee.Image(score.copyProperties(image, ['system:time_start', 'WRS_PATH', 'WRS_ROW']))
+
+def join_cloudscore(collection, toa):
+  # Match every SR image with the TOA scene of the same path/row acquired
+  # within a day in a single join. Scores are only computed for the TOA
+  # scenes that are matched
+  match = ee.Filter.And(
+    ee.Filter.maxDifference(difference=86400000, leftField='system:time_start', rightField='system:time_start'),
+    ee.Filter.equals(leftField='WRS_PATH', rightField='WRS_PATH'),
+    ee.Filter.equals(leftField='WRS_ROW', rightField='WRS_ROW'))
+  scores = ee.ImageCollection(toa).map(get_cloudscore)
+  return ee.ImageCollection(ee.Join.saveFirst('cloud_score', outer=True).apply(collection, scores, match))
+
+# Input collections
+
+# Landsat surface reflectance collection, TOA collection used for cloud
+# scores and band mask
+SENSORS = {
+  'LT5': ('LANDSAT/LT5_SR', 'LANDSAT/LT05/C01/T1_TOA', mask_57),
+  'LE7': ('LANDSAT/LE7_SR', 'LANDSAT/LE07/C01/T1_TOA', mask_57),
+  'LC8': ('LANDSAT/LC8_SR', 'LANDSAT/LC08/C01/T1_TOA', mask_8)
+}
+
+# Preprocessed sensor-year collections, shared by training, monitoring and
+# retraining so each one appears once in the computation graph
+_collections = {}
+
+def filter_footprint(collection):
+  if pathrow:
+    return collection.filter(ee.Filter.eq('WRS_PATH', path)
+      ).filter(ee.Filter.eq('WRS_ROW', row))
+  else:
+    return collection.filterBounds(get_aoi())
+
+def get_sensor_year(sensor, year):
+  # NFDI collection of one sensor for one calendar year
+  key = (sensor, year, pathrow, path, row, aoi, forest_threshold, cloud_score, cf_thresh)
+  if key not in _collections:
+    collection_id, toa_id, mask_func = SENSORS[sensor]
+    # Forest pixels of the scenes, every later stage inherits the mask
+    collection = filter_footprint(ee.ImageCollection(collection_id
+      ).filterDate(str(year) + '-01-01', str(year + 1) + '-01-01')).map(mask_forest)
+    # TOA scenes for the cloud scores, a day either side of the year
+    toa = filter_footprint(ee.ImageCollection(toa_id
+      ).filterDate(str(year - 1) + '-12-31', str(year + 1) + '-01-02')).map(mask_forest)
+    # Mask clouds, unmix and get NFDI
+    _collections[key] = join_cloudscore(collection, toa).map(mask_func).map(add_cloudscore).map(unmix).map(get_nfdi)
+  return _collections[key]
+
+def get_inputs(start_year, end_year, sensors):
+  # NFDI collection from the start of start_year to the end of end_year
+  with profiling.stage('get_inputs {0}-{1}'.format(start_year, end_year)):
+    collection = ee.ImageCollection([])
+    for year in range(start_year, end_year + 1):
+      for sensor in sensors:
+        collection = collection.merge(get_sensor_year(sensor, year))
+    # The period ends on (and excludes) December 31 of end_year
+    return ee.ImageCollection(collection).filterDate(
+      str(start_year) + '-01-01', str(end_year) + '-12-31').sort('system:time_start')
+
+# ** GRAPH INSTRUMENTATION **
+
+# Stages recorded for the graph report, None unless it was requested
+graph_report = None
+
+def graph_stats(obj):
+  # Size of the serialized computation graph of an Earth Engine object:
+  # number of distinct function invocations (nodes), number of invocations
+  # if shared subgraphs were repeated (expanded_nodes), longest chain of
+  # invocations (depth) and serialized bytes
+  serialized = ee.serializer.toJSON(obj)
+  graph = json.loads(serialized)
+  if 'values' in graph:
+    refs = graph['values']
+    root = refs[graph['result']]
+  elif 'scope' in graph:
+    refs = dict(graph['scope'])
+    root = graph['value']
+  else:
+    refs = {}
+    root = graph
+
+  def children(value):
+    if isinstance(value, dict):
+      if 'valueReference' in value:
+        return [refs[value['valueReference']]]
+      if value.get('type') == 'ValueRef':
+        return [refs[value['value']]]
+      return list(value.values())
+    if isinstance(value, list):
+      return value
+    return []
+
+  def is_invocation(value):
+    return isinstance(value, dict) and (
+      'functionInvocationValue' in value or value.get('type') == 'Invocation')
+
+  # (depth, expanded nodes, is a node) of every value, without recursion as graphs of
+  # the full run are deeper than the recursion limit
+  memo = {}
+  stack = [(root, False)]
+  while stack:
+    value, visited = stack.pop()
+    if id(value) in memo:
+      continue
+    kids = children(value)
+    if not visited:
+      stack.append((value, True))
+      stack.extend((kid, False) for kid in kids if id(kid) not in memo)
+    else:
+      own = 1 if is_invocation(value) else 0
+      memo[id(value)] = (own + max([memo[id(kid)][0] for kid in kids] or [0]),
+                         own + sum(memo[id(kid)][1] for kid in kids), own)
+
+  nodes = sum(own for _, _, own in memo.values())
+  depth, expanded, _ = memo[id(root)]
+  return {'nodes': nodes, 'expanded_nodes': expanded, 'depth': depth,
+          'bytes': len(serialized)}
+
+def record_graph(stage, obj):
+  # Add the graph size of obj after a stage to the report
+  if graph_report is None:
+    return
+  start = time.time()
+  stats = graph_stats(obj)
+  stats['stage'] = stage
+  stats['serialize_seconds'] = time.time() - start
+  graph_report.append(stats)
+  print('{0}: {1} nodes, depth {2}, {3} bytes'.format(stage, stats['nodes'], stats['depth'], stats['bytes']))
+
+def record_round_trip(stage, func, *args):
+  # Call func, recording the wall-clock time of the server round trip
+  start = time.time()
+  result = func(*args)
+  if graph_report is not None:
+    graph_report.append({'stage': stage, 'round_trip_seconds': time.time() - start})
+  return result
+
+def write_graph_report(filename):
+  with open(filename, 'w') as f:
+    json.dump({'stages': graph_report}, f, indent=2)
+
+# ** CHECKPOINTS **
+
+# The monitoring state after each step is exported to the asset
+# <checkpoint>_<year> with the bands below, and the parameters of the run
+# as properties. A rerun with the same parameters loads the state of the
+# last exported step and only builds the steps after it, a rerun with other
+# parameters is refused.
+STATUS_BANDS = ['band_1','band_2','band_3','band_4','band_5']
+COEF_BANDS = ['coef_constant', 'coef_trend', 'coef_sin', 'coef_cos']
+ORIGINAL_COEF_BANDS = ['original_' + b for b in COEF_BANDS]
+
+# Export tasks of the checkpoints of the last run_cdd
+checkpoint_tasks = []
+
+def checkpoint_id(year):
+  return '{0}_{1}'.format(checkpoint, year)
+
+def checkpoint_params():
+  # Parameters the monitoring state depends on
+  return {'cdd_first_year': get_years()[0], 'cdd_stride': stride,
+          'cdd_consec': consec, 'cdd_thresh': thresh, 'cdd_window': window or 0,
+          'cdd_forest': forest_threshold, 'cdd_cloud': cloud_score,
+          'cdd_cf': cf_thresh, 'cdd_path': path or 0, 'cdd_row': row or 0,
+          'cdd_aoi': int(aoi)}
+
+def asset_info(asset_id):
+  # Asset metadata, None if the asset does not exist
+  try:
+    return ee.data.getInfo(asset_id)
+  except ee.EEException:
+    return None
+
+def check_checkpoint(asset_id, info):
+  # Refuse to resume from the state of a run with other parameters
+  properties = info.get('properties') or {}
+  for name, value in sorted(checkpoint_params().items()):
+    if properties.get(name) != value:
+      raise ValueError('checkpoint {0} belongs to a run with other parameters '
+                       '({1} is {2}, not {3})'.format(asset_id, name, properties.get(name), value))
+
+def get_region():
+  # Footprint of the run, for exports of unbounded images
+  if aoi:
+    return get_aoi()
+  return ee.Image(get_inputs_training(start_year, path, row).first()).geometry()
+
+def export_checkpoint(year, ts_status, coefs, original_coefs, tmean, stats):
+  state = ee.Image.cat([
+    ee.Image(ts_status).rename(STATUS_BANDS),
+    ee.Image(coefs).rename(COEF_BANDS),
+    ee.Image(original_coefs).rename(ORIGINAL_COEF_BANDS),
+    ee.Image(tmean).rename(['mean_res']),
+    ee.Image(stats).rename(STATS_BANDS)]).toDouble().set(checkpoint_params())
+  return ee.batch.Export.image.toAsset(
+    image=state, description=os.path.basename(checkpoint_id(year)),
+    assetId=checkpoint_id(year), region=get_region(), scale=30,
+    maxPixels=1e13)
+
+def load_checkpoint(year):
+  # (ts_status, coefs, original_coefs, tmean, stats) after the step of year
+  state = ee.Image(checkpoint_id(year))
+  return (state.select(STATUS_BANDS), state.select(COEF_BANDS),
+          state.select(ORIGINAL_COEF_BANDS, COEF_BANDS),
+          state.select('mean_res'), state.select(STATS_BANDS))
+
+def get_train_nfdi(years, i):
+  # Training collection after the step of years[i]: the training period and
+  # all monitoring periods so far
+  train_nfdi = get_inputs_training(years[0], path, row)
+  for year in years[:i + 1]:
+    train_nfdi = train_nfdi.merge(get_inputs_monitoring(year, path, row))
+  return train_nfdi.sort('system:time_start')
 
 # ** MAIN WORK **
 
@@ -724,141 +814,148 @@ coefficientsImage = ""
 train_nfdi_mean = ""
 change_dates = ""
 
-# ts_status = initial image for change detection iteration. 
-# Bands:
-    # 1. Change (1) or no change (0). Used as mask. Default: 0
-    # 2. Consecutive observations passed threshold. Default: 0
-    # 3. Date of change if 1 = 1. Default: 0
-    # 4. Magnitude of change
-    # 5. iterator 
-    
-ts_status = ee.Image(1).addBands([ee.Image(0),ee.Image(0),ee.Image(0),ee.Image(1)]).rename(['band_1','band_2','band_3','band_4','band_5']).unmask()
-
-# Do the monitoring for each year.
-
-old_coefs = ee.Image(0)
-
-# First year inputs
-
-train_nfdi = get_inputs_training(2000, path, row)
-
-results = deg_monitoring(2000, ts_status, path, row, old_coefs, train_nfdi, True, None)
-
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-original_coefs = old_coefs
-tmean = results.get(3)
+def run_cdd():
+  # Build the CDD output image for the current parameters
+  global change_dates
+  initialize()
 
-results = deg_monitoring(2002, ts_status, path, row, old_coefs, train_nfdi, True, None)
+  # ts_status = initial image for change detection iteration. 
+  # Bands:
+      # 1. Change (1) or no change (0). Used as mask. Default: 0
+      # 2. Consecutive observations passed threshold. Default: 0
+      # 3. Date of change if 1 = 1. Default: 0
+      # 4. Magnitude of change
+      # 5. iterator 
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-original_coefs = old_coefs
-tmean = results.get(3)
+  ts_status = ee.Image(1).addBands([ee.Image(0),ee.Image(0),ee.Image(0),ee.Image(1)]).rename(['band_1','band_2','band_3','band_4','band_5']).unmask()
 
-results = deg_monitoring(2004, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
+  # Do the monitoring for each year.
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-tmean = results.get(3)
+  old_coefs = ee.Image(0)
+  tmean = None
+  original_coefs = None
+  years = get_years()
 
-results = deg_monitoring(2006, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
+  # First year inputs
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-tmean = results.get(3)
+  with profiling.stage('training'):
+    train_nfdi = get_inputs_training(years[0], path, row)
+    train_stats = get_training_stats(train_nfdi, years[0])
 
-results = deg_monitoring(2008, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
+  # Resume after the last step with a saved state
+  first_step = 0
+  if checkpoint:
+    for i in reversed(range(len(years))):
+      info = asset_info(checkpoint_id(years[i]))
+      if info is not None:
+        check_checkpoint(checkpoint_id(years[i]), info)
+        ts_status, old_coefs, original_coefs, tmean, train_stats = load_checkpoint(years[i])
+        train_nfdi = get_train_nfdi(years, i)
+        first_step = i + 1
+        print('Resuming after {0}'.format(years[i]))
+        break
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-tmean = results.get(3)
+  del checkpoint_tasks[:]
+  for i in range(first_step, len(years)):
+    year = years[i]
+    # The first two years use their own tmean
+    with profiling.stage('deg_monitoring {0}'.format(year)):
+      results = deg_monitoring(year, ts_status, path, row, old_coefs, train_nfdi, train_stats, i < 2, tmean)
+    record_graph('deg_monitoring {0}'.format(year), results)
 
-results = deg_monitoring(2010, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
+    ts_status = results.get(0)
+    old_coefs = results.get(1)
+    train_nfdi = results.get(2)
+    train_stats = results.get(4)
+    tmean = results.get(3)
+    if i < 2:
+      original_coefs = old_coefs
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-tmean = results.get(3)
+    if checkpoint:
+      checkpoint_tasks.append(export_checkpoint(year, ts_status, old_coefs, original_coefs, tmean, train_stats))
 
-results = deg_monitoring(2012, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
+  final_results = ee.Image(ts_status)
+  final_train = ee.ImageCollection(train_nfdi)
+  change_output = final_results.select('band_1').eq(ee.Image(0))
 
-ts_status = results.get(0)
-old_coefs = results.get(1)
-train_nfdi = results.get(2)
-tmean = results.get(3)
+  change_dates = final_results.select('band_3')
 
-results = deg_monitoring(2014, ts_status, path, row, old_coefs, train_nfdi, False, tmean)
 
-final_results = ee.Image(results.get(0))
-final_train = ee.ImageCollection(results.get(2))
-change_output = final_results.select('band_1').eq(ee.Image(0))
+  # Retrain
 
-global change_dates
-change_dates = final_results.select('band_3')
+  with profiling.stage('regression_retrain'):
+    retrain_regression = regression_retrain(final_train, RETRAIN_YEAR, path, row)
+  record_graph('regression_retrain', retrain_regression)
 
+  retrain_coefs = ee.Image(retrain_regression.get(0))
+  retrain_last_date = ee.Image(retrain_regression.get(1))
 
-# Retrain
+  # get the date at the middle of the retrain time series
+  retrain_middle = ee.Image(ee.Image(retrain_last_date).subtract(ee.Image(change_dates)).divide(ee.Image(2)).add(ee.Image(change_dates))).rename(['years'])
+  predict_middle = pred_middle_retrain(retrain_middle, retrain_coefs)
 
-retrain_regression = regression_retrain(final_train, 2011, path, row)
 
-retrain_coefs = ee.Image(retrain_regression.get(0))
-retrain_predict = ee.ImageCollection(retrain_regression.get(1))
-retrain_predict_last = ee.Image(retrain_predict.toList(1000).get(-1))
+  # Get coefficients for middle of TS before
+  original_middle = ee.Image(ee.Image(change_dates).add(ee.Image(1970)).divide(ee.Image(2))).rename(['years'])
+  predict_middle_original = pred_middle_retrain(original_middle, ee.Image(original_coefs).rename(['Intercept', 'Slope','Sin','Cos']))
 
-# Get predicted NFDI at middle of time series
-retrain_last = ee.Image(retrain_predict.toList(1000).get(-1))
 
-if aoi:
-  retrain_last_date = ee.Image(retrain_last).metadata('system:time_start').divide(ee.Image(31557600000)).clip(AOI)
-else:
-  retrain_last_date = ee.Image(retrain_last).metadata('system:time_start').divide(ee.Image(31557600000))
 
-# get the date at the middle of the retrain time series
-retrain_middle = ee.Image(ee.Image(retrain_last_date).subtract(ee.Image(change_dates)).divide(ee.Image(2)).add(ee.Image(change_dates))).rename(['years'])
-predict_middle = pred_middle_retrain(retrain_middle, retrain_coefs)
+  # Prepare output
 
+  # Normalize magnitude
+  # st_magnitude = short-term change magnitude
+  st_magnitude = final_results.select('band_4').divide(ee.Image(consec)).multiply(change_dates.gt(ee.Image(0)))
 
-# Get coefficients for middle of TS before
-original_middle = ee.Image(ee.Image(change_dates).add(ee.Image(1970)).divide(ee.Image(2))).rename(['years'])
-predict_middle_original = pred_middle_retrain(original_middle, ee.Image(original_coefs).rename(['Intercept', 'Slope','Sin','Cos']))
+  # save_output:
+  # Bands:
+      # 1. Change date
+      # 2. Short-term change magnitude
+      # 3. Regression constant (intercept) TODO: Normalize to middle of time period
+      # 4. Regression slope
+      # 5. Predicted NFDI: End of time period
+      # 6. Pre-Change intercept normalized to middle of training period
+  # Mask:
+      # Hansen 2000 forest mask according to % canopy cover threshold (forest_threshold),
+      # the inputs are already masked, non-forest pixels are exported as 0
 
 
+  save_output = change_dates.addBands([st_magnitude, retrain_coefs.select('Slope'), predict_middle, predict_middle_original]).multiply(get_forest2000().gt(ee.Image(forest_threshold))).toFloat()
+  #save_output = change_dates.addBands([st_magnitude, retrain_coefs.select('Slope'), predict_middle]).multiply(forest2000.gt(ee.Image(forest_threshold))).toFloat()
+  record_graph('save_output', save_output)
 
-# Prepare output
-
-# Normalize magnitude
-# st_magnitude = short-term change magnitude
-st_magnitude = final_results.select('band_4').divide(ee.Image(consec)).multiply(change_dates.gt(ee.Image(0)))
-
-# save_output:
-# Bands:
-    # 1. Change date
-    # 2. Short-term change magnitude
-    # 3. Regression constant (intercept) TODO: Normalize to middle of time period
-    # 4. Regression slope
-    # 5. Predicted NFDI: End of time period
-    # 6. Pre-Change intercept normalized to middle of training period
-# Mask:
-    # Hansen 2000 forest mask according to % canopy cover threshold (forest_threshold)
-
-
-save_output = change_dates.addBands([st_magnitude, retrain_coefs.select('Slope'), predict_middle, predict_middle_original]).multiply(forest2000.gt(ee.Image(forest_threshold))).toFloat()
-#save_output = change_dates.addBands([st_magnitude, retrain_coefs.select('Slope'), predict_middle]).multiply(forest2000.gt(ee.Image(forest_threshold))).toFloat()
-
-print('Submitting task')
-
-task_config = {
-  'description': output,
-  'scale': 30
-  }
-task = ee.batch.Export.image(save_output, output, task_config)
-task.start()
+  return save_output
 
+def export_output(save_output, output):
+  # Export task for the output image
+  task_config = {
+    'description': output,
+    'scale': 30
+    }
+  return ee.batch.Export.image(save_output, output, task_config)
 
 
+if __name__ == '__main__':
+    args = docopt(__doc__, version='0.6.2')
+    profiling.enable(args['--profile'])
+    set_params(args)
+    if args['--graph-report']:
+        graph_report = []
+
+    output=str(args['<output>'])
+    print(output)
+
+    with profiling.stage('run_cdd'):
+        save_output = run_cdd()
+
+    print('Submitting task')
+    with profiling.stage('export'):
+        task = export_output(save_output, output)
+        record_round_trip('task.start', task.start)
+    for checkpoint_task in checkpoint_tasks:
+      print('Submitting checkpoint {0}'.format(checkpoint_task.config['description']))
+      with profiling.stage('export checkpoint'):
+        record_round_trip('checkpoint task.start', checkpoint_task.start)
+
+    if args['--graph-report']:
+        write_graph_report(args['--graph-report'])
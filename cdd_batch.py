@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Run Continuous Degradation Detection for many Landsat path/rows
+
+Builds the cdd.py output of every path/row and submits the export tasks to
+Earth Engine, keeping at most --max-tasks of them running. Failed tasks are
+retried with exponential backoff and a JSON manifest of the outputs and
+their task states is rewritten as the tasks progress. A rerun with the
+same manifest resumes the batch: completed outputs are skipped, tasks
+still running are checked again and failed ones are submitted again.
+
+Usage: cdd_batch.py [options] <pathrows> <manifest>
+
+  <pathrows>          file with one path/row per line, or a comma separated
+                      list of path/rows, e.g. 225/068,226/068
+  --prefix=PREFIX     output name prefix (default: cdd)
+  --max-tasks=TASKS   concurrently running tasks (default: 5)
+  --retries=RETRIES   retries of a failed task (default: 3)
+  --backoff=BACKOFF   seconds before the first retry, doubled for each
+                      further retry (default: 60)
+  --poll=POLL         seconds between task status checks (default: 30)
+  --fake              use a local fake task backend instead of Earth Engine
+  --cloud=CLOUD       cloud threshold
+  --consec=CONSEC     consecutive obs to trigger change (default: 5)
+  --thresh=THRESH     change threshold (default: 3.5)
+  --forest=FOREST     forest % cover threshold (default: 30)
+  --cf=CF_THRESH      Cloud fraction threshold
+  --window=WINDOW     Sliding training window in years, at least 2
+  --start=START       first monitoring year (default: 2000)
+  --end=END           last monitoring year (default: 2014)
+  --stride=STRIDE     years monitored per step (default: 2)
+
+"""
+
+from docopt import docopt
+import json
+import os
+import re
+import sys
+import time
+
+# Earth Engine task states, UNKNOWN for a task id Earth Engine does not know
+COMPLETED = 'COMPLETED'
+FAILED = ('FAILED', 'CANCELLED', 'UNKNOWN')
+ACTIVE = ('SUBMITTED', 'READY', 'RUNNING')
+
+# ** BACKENDS **
+
+# A backend submits a job and returns a task id, and reports the
+# (state, error message) of a list of task ids.
+
+class EarthEngineBackend(object):
+    """ Builds cdd.py outputs and starts them as Earth Engine export tasks """
+
+    def __init__(self, params):
+        import cdd
+        cdd.initialize()
+        self.cdd = cdd
+        self.params = params
+
+    def submit(self, job):
+        params = dict(self.params)
+        params.update({'--path': str(job['path']), '--row': str(job['row']),
+                       '--aoi': False, '--checkpoint': None})
+        self.cdd.set_params(params)
+        task = self.cdd.export_output(self.cdd.run_cdd(), job['output'])
+        task.start()
+        return task.id
+
+    def status(self, task_ids):
+        import ee
+        return dict((s['id'], (s['state'], s.get('error_message')))
+                    for s in ee.data.getTaskStatus(task_ids))
+
+class FakeBackend(object):
+    """ Local stand-in for Earth Engine to exercise the scheduler
+
+    Tasks complete after polls status checks. failures maps an output name
+    to the number of times its task fails before it succeeds.
+    """
+
+    def __init__(self, polls=1, failures=None):
+        self.polls = polls
+        self.failures = dict(failures or {})
+        self.tasks = {}
+        self.submitted = []
+
+    def submit(self, job):
+        task_id = 'FAKE{0}'.format(len(self.submitted))
+        self.submitted.append(job['output'])
+        fail = self.failures.get(job['output'], 0) > 0
+        if fail:
+            self.failures[job['output']] -= 1
+        self.tasks[task_id] = [self.polls, fail]
+        return task_id
+
+    def status(self, task_ids):
+        statuses = {}
+        for task_id in task_ids:
+            if task_id not in self.tasks:
+                statuses[task_id] = ('UNKNOWN', None)
+                continue
+            task = self.tasks[task_id]
+            task[0] -= 1
+            if task[0] > 0:
+                statuses[task_id] = ('RUNNING', None)
+            elif task[1]:
+                statuses[task_id] = ('FAILED', 'fake failure')
+            else:
+                statuses[task_id] = (COMPLETED, None)
+        return statuses
+
+# ** SCHEDULER **
+
+def make_job(path, row, prefix='cdd'):
+    return {'path': path, 'row': row,
+            'output': '{0}_{1:03d}{2:03d}'.format(prefix, path, row),
+            'state': 'PENDING', 'task_id': None, 'attempts': 0,
+            'error': None}
+
+class BatchRunner(object):
+    """ Runs jobs through a backend with a cap on concurrent tasks
+
+    Jobs whose submission or task fails are retried up to retries times,
+    waiting backoff seconds before the first retry and twice as long before
+    each further one. The manifest, if given, is rewritten after every
+    status check.
+    """
+
+    def __init__(self, backend, max_tasks=5, retries=3, backoff=60, poll=30,
+                 manifest=None, clock=time.time, sleep=time.sleep):
+        self.backend = backend
+        self.max_tasks = max_tasks
+        self.retries = retries
+        self.backoff = backoff
+        self.poll = poll
+        self.manifest = manifest
+        self.clock = clock
+        self.sleep = sleep
+
+    def run(self, jobs):
+        # Tasks of a resumed batch still running are checked, not submitted
+        running = dict((job['task_id'], job) for job in jobs
+                       if job['task_id'] and job['state'] in ACTIVE)
+        pending = [job for job in jobs if job['state'] != COMPLETED and
+                   job['task_id'] not in running]
+        while pending or running:
+            self.check(running, pending)
+            self.submit(pending, running)
+            self.write_manifest(jobs)
+            if pending or running:
+                self.sleep(self.poll)
+        return jobs
+
+    def check(self, running, pending):
+        if not running:
+            return
+        statuses = self.backend.status(list(running))
+        for task_id, (state, error) in statuses.items():
+            job = running[task_id]
+            if state != job['state']:
+                print('{0}: {1}'.format(job['output'], state))
+            job['state'] = state
+            if state == COMPLETED:
+                job['error'] = None
+                del running[task_id]
+            elif state in FAILED:
+                del running[task_id]
+                self.retry(job, error, pending)
+
+    def submit(self, pending, running):
+        now = self.clock()
+        for job in [j for j in pending if j.get('not_before', 0) <= now]:
+            if len(running) >= self.max_tasks:
+                break
+            pending.remove(job)
+            job['attempts'] += 1
+            try:
+                task_id = self.backend.submit(job)
+            except Exception as e:
+                print('{0}: submission failed: {1}'.format(job['output'], e))
+                self.retry(job, str(e), pending)
+                continue
+            job['task_id'] = task_id
+            job['state'] = 'SUBMITTED'
+            running[task_id] = job
+            print('{0}: submitted {1}'.format(job['output'], task_id))
+
+    def retry(self, job, error, pending):
+        job['error'] = error
+        if job['attempts'] > self.retries:
+            job['state'] = 'FAILED'
+            return
+        job['state'] = 'RETRY'
+        job['not_before'] = (self.clock() +
+                             self.backoff * 2 ** (job['attempts'] - 1))
+        pending.append(job)
+
+    def write_manifest(self, jobs):
+        if not self.manifest:
+            return
+        keys = ('path', 'row', 'output', 'state', 'task_id', 'attempts',
+                'error')
+        with open(self.manifest, 'w') as f:
+            json.dump({'jobs': [dict((k, job[k]) for k in keys)
+                                for job in jobs]}, f, indent=2)
+
+def read_manifest(manifest, jobs):
+    """ jobs with the state, task and attempts saved in manifest by an
+    earlier run. Jobs neither completed nor running start over """
+    with open(manifest) as f:
+        saved = dict((job['output'], job) for job in json.load(f)['jobs'])
+    for job in jobs:
+        if job['output'] not in saved:
+            continue
+        for key in ('state', 'task_id', 'attempts', 'error'):
+            job[key] = saved[job['output']][key]
+        if job['state'] not in ACTIVE and job['state'] != COMPLETED:
+            job['state'] = 'PENDING'
+            job['attempts'] = 0
+    return jobs
+
+def read_pathrows(pathrows):
+    """ [(path, row)] from a file with one path/row per line or from a comma
+    separated list """
+    if os.path.isfile(pathrows):
+        with open(pathrows) as f:
+            items = [line.split('#')[0] for line in f]
+    else:
+        items = pathrows.split(',')
+    result = []
+    for item in items:
+        if not item.strip():
+            continue
+        path, row = re.split(r'[/,\s]+', item.strip())
+        result.append((int(path), int(row)))
+    return result
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__, version='0.6.2')
+
+    prefix = args['--prefix'] or 'cdd'
+    max_tasks = int(args['--max-tasks']) if args['--max-tasks'] else 5
+    retries = int(args['--retries']) if args['--retries'] else 3
+    backoff = float(args['--backoff']) if args['--backoff'] else 60
+    poll = float(args['--poll']) if args['--poll'] else 30
+
+    jobs = [make_job(path, row, prefix)
+            for path, row in read_pathrows(args['<pathrows>'])]
+    print('{0} path/rows'.format(len(jobs)))
+    if os.path.exists(args['<manifest>']):
+        jobs = read_manifest(args['<manifest>'], jobs)
+        print('resuming, {0} completed'.format(
+            sum(job['state'] == COMPLETED for job in jobs)))
+
+    if args['--fake']:
+        backend = FakeBackend()
+    else:
+        backend = EarthEngineBackend(args)
+
+    runner = BatchRunner(backend, max_tasks, retries, backoff, poll,
+                         args['<manifest>'])
+    jobs = runner.run(jobs)
+
+    failed = [job['output'] for job in jobs if job['state'] != COMPLETED]
+    if failed:
+        print('failed: {0}'.format(', '.join(failed)))
+        sys.exit(1)
@@ -0,0 +1,925 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Continuous Degradation Detection on local Landsat stacks
+
+Runs the same algorithm as cdd.py on surface reflectance GeoTIFFs stored on
+disk instead of Earth Engine collections. Each acquisition is one GeoTIFF
+named after its Landsat scene ID (e.g. LE72250682000123CUB00_sr.tif or
+LE07_L1TP_225068_20000502_..._sr.tif) holding the SR bands followed by the
+cfmask band:
+
+  Landsat 5/7:  B1 B2 B3 B4 B5 B7 cfmask
+  Landsat 8:    B1 B2 B3 B4 B5 B6 B7 cfmask
+
+All stacks must share the same grid. The output is the 5 band product
+written by cdd.py (change date, short-term magnitude, retrain slope,
+predicted NFDI after change, predicted NFDI before change).
+
+Usage: cdd_local.py [options] <input> <output>
+
+  --consec=CONSEC         consecutive obs to trigger change (default: 5)
+  --thresh=THRESH         change threshold (default: 3.5)
+  --forest=FOREST         forest % cover threshold (default: 30)
+  --treecover=TREECOVER   Hansen treecover2000 GeoTIFF on the stack grid
+  --cf=CF_THRESH          Cloud fraction threshold (default: .2)
+  --window=WINDOW         sliding training window in years (default: none)
+  --start=START           first monitoring year (default: 2000)
+  --end=END               last monitoring year (default: 2014)
+  --stride=STRIDE         years monitored per step (default: 2)
+  --checkpoint=DIR        directory for the monitoring state after each step,
+                          a rerun resumes after the last saved step
+  --tile=TILE             tile size in pixels (default: 256)
+  --processes=PROCESSES   worker processes (default: number of cores)
+
+"""
+
+from docopt import docopt
+import datetime
+import multiprocessing
+import os
+import re
+import sys
+
+import gdal
+import numpy as np
+
+# spectral endmembers, same as cdd.py
+gv= [500, 900, 400, 6100, 3000, 1000]
+npv= [1400, 1700, 2200, 3000, 5500, 3000]
+soil= [2000, 3000, 3400, 5800, 6000, 5800]
+shade= [0, 0, 0, 0, 0, 0]
+cloud = [9000, 9600, 8000, 7800, 7200, 6500]
+
+ENDMEMBERS = np.array([gv, shade, npv, soil, cloud], dtype=np.float64).T
+
+# GDAL band numbers of B1 B2 B3 B4 B5 B7 (mask_57 / mask_8) and of cfmask
+SR_BANDS = {'LT5': [1, 2, 3, 4, 5, 6],
+            'LE7': [1, 2, 3, 4, 5, 6],
+            'LC8': [2, 3, 4, 5, 6, 7]}
+CFMASK_BAND = {'LT5': 7, 'LE7': 7, 'LC8': 8}
+
+# Monitoring years, years monitored per step and retrain year of the cdd.py
+# main loop
+YEARS = range(2000, 2015, 2)
+STRIDE = 2
+RETRAIN_YEAR = 2011
+FOREST_THRESHOLD = 30
+
+# Scene IDs: pre-collection (LE72250682000123...) and collection 1
+# (LE07_L1TP_225068_20000502_...)
+_PRE_COLLECTION = re.compile(r'L([TEC])([578])\d{6}(\d{4})(\d{3})')
+_COLLECTION = re.compile(r'L([TEC])0([578])_\w{4}_\d{6}_(\d{4})(\d{2})(\d{2})')
+
+# ** SCENES **
+
+def parse_scene_id(filename):
+    """ Return (sensor, date) of a Landsat scene from its file name """
+    name = os.path.basename(filename)
+    match = _COLLECTION.search(name)
+    if match:
+        sensor = 'L' + match.group(1) + match.group(2)
+        date = datetime.date(*[int(g) for g in match.groups()[2:]])
+        return sensor, date
+    match = _PRE_COLLECTION.search(name)
+    if match:
+        sensor = 'L' + match.group(1) + match.group(2)
+        date = (datetime.date(int(match.group(3)), 1, 1) +
+                datetime.timedelta(int(match.group(4)) - 1))
+        return sensor, date
+    raise ValueError('Not a Landsat scene ID: {0}'.format(name))
+
+def list_scenes(directory):
+    """ List (date, sensor, path) of every stack in directory, sorted by date """
+    scenes = []
+    for name in os.listdir(directory):
+        if not name.lower().endswith(('.tif', '.tiff')):
+            continue
+        sensor, date = parse_scene_id(name)
+        scenes.append((date, sensor, os.path.join(directory, name)))
+    return sorted(scenes)
+
+def years_since_epoch(dates):
+    """ Fractional years since 1970 (time_start / 315576e5 in cdd.py) """
+    epoch = datetime.date(1970, 1, 1)
+    return np.array([(d - epoch).days / 365.25 for d in dates])
+
+def filter_date(dates, start, end):
+    """ Boolean index of dates in [start, end), as ee.ImageCollection.filterDate """
+    start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+    return np.array([start <= d < end for d in dates], dtype=bool)
+
+def read_scene(path, sensor, block=None):
+    """ Read the SR bands and clear mask of one stack (mask_57 / mask_8)
+
+    block is an optional (xoff, yoff, xsize, ysize) window to read.
+    """
+    block = block or ()
+    ds = gdal.Open(path)
+    sr = np.array([ds.GetRasterBand(b).ReadAsArray(*block)
+                   for b in SR_BANDS[sensor]], dtype=np.float64)
+    cfmask = ds.GetRasterBand(CFMASK_BAND[sensor]).ReadAsArray(*block)
+    # cfmask 4 = cloud, 2 = shadow
+    valid = (cfmask != 4) & (cfmask != 2) & (sr[0] > 0)
+    return sr, valid
+
+# ** UNMIXING AND NFDI **
+
+def unmix_operators(endmembers):
+    """ Sum-to-one least squares solution for every set of active endmembers
+
+    Returns operators (sets, 5, bands) and offsets (sets, 5) indexed by the
+    bit mask of active endmembers, so that the fractions of a pixel with
+    reflectance r are operators[s].dot(r) + offsets[s], zero for inactive
+    endmembers. Computed once from the inverse of each KKT matrix.
+    """
+    count = endmembers.shape[1]
+    operators = np.zeros((2 ** count, count, endmembers.shape[0]))
+    offsets = np.zeros((2 ** count, count))
+    for subset in range(1, 2 ** count):
+        active = [i for i in range(count) if subset >> i & 1]
+        e = endmembers[:, active]
+        kkt = np.zeros((len(active) + 1,) * 2)
+        kkt[:-1, :-1] = e.T.dot(e)
+        kkt[:-1, -1] = 1
+        kkt[-1, :-1] = 1
+        kkt = np.linalg.pinv(kkt)
+        operators[subset, active] = kkt[:-1, :-1].dot(e.T)
+        offsets[subset, active] = kkt[:-1, -1]
+    return operators, offsets
+
+# Endmembers and reflectance are scaled to 0-1 for conditioning
+UNMIX_SCALE = 1e-4
+UNMIX_OPERATORS = unmix_operators(ENDMEMBERS * UNMIX_SCALE)
+
+def unmix(sr, max_iter=20):
+    """ Fully constrained unmixing of reflectance (bands, pixels)
+
+    Least squares fractions (5, pixels) in gv, shade, npv, soil, cloud order
+    that sum to one and are non-negative, as ee.Image.unmix(..., True, True).
+    Solved with a batched active set method: pixels sharing the same active
+    endmembers are solved together with the precomputed operators, the most
+    negative fraction is dropped from infeasible pixels and the endmember
+    with the largest positive multiplier is added back to feasible pixels
+    that are not optimal.
+    """
+    operators, offsets = UNMIX_OPERATORS
+    endmembers = ENDMEMBERS * UNMIX_SCALE
+    count = endmembers.shape[1]
+    sr = sr * UNMIX_SCALE
+    bits = 1 << np.arange(count)
+
+    fractions = np.zeros((count, sr.shape[1]))
+    active = np.full(sr.shape[1], 2 ** count - 1)
+    todo = np.arange(sr.shape[1])
+    for _ in range(max_iter):
+        if not len(todo):
+            break
+        _sr = sr[:, todo]
+        _active = active[todo]
+        _fractions = np.empty((count, len(todo)))
+        for subset in np.unique(_active):
+            index = _active == subset
+            _fractions[:, index] = (operators[subset].dot(_sr[:, index]) +
+                                    offsets[subset][:, np.newaxis])
+        fractions[:, todo] = _fractions
+
+        is_active = (_active[np.newaxis] & bits[:, np.newaxis]) > 0
+        negative = np.where(is_active, _fractions, 0).min(axis=0) < -1e-12
+        # Drop the most negative fraction
+        drop = np.where(is_active, _fractions, np.inf).argmin(axis=0)
+        _active[negative] &= ~bits[drop[negative]]
+
+        # Multipliers of the inactive endmembers: gradient of the residual
+        # minus the sum-to-one multiplier (equal gradient over active ones)
+        gradient = endmembers.T.dot(_sr - endmembers.dot(_fractions))
+        mu = (np.where(is_active, gradient, 0).sum(axis=0) /
+              np.maximum(is_active.sum(axis=0), 1))
+        gain = np.where(is_active, -np.inf, gradient - mu)
+        add = gain.argmax(axis=0)
+        suboptimal = ~negative & (gain.max(axis=0) > 1e-12)
+        _active[suboptimal] |= bits[add[suboptimal]]
+
+        active[todo] = _active
+        todo = todo[negative | suboptimal]
+
+    # Pixels that did not converge are projected to the constraints
+    if len(todo):
+        _fractions = np.maximum(fractions[:, todo], 0)
+        fractions[:, todo] = _fractions / _fractions.sum(axis=0)
+    return fractions
+
+def get_nfdi(fractions, cf_thresh):
+    """ NFDI from fractions, masked where cloud fraction >= cf_thresh """
+    gv_, shade_, npv_, soil_, cloud_ = fractions
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gv_shade = gv_ / (1 - shade_)
+        nfdi = (gv_shade - (npv_ + soil_)) / (gv_shade + npv_ + soil_)
+    nfdi[~(cloud_ < cf_thresh) | ~np.isfinite(nfdi)] = np.nan
+    return nfdi
+
+def unmix_nfdi(sr, valid, cf_thresh, chunk=65536):
+    """ NFDI (y, x) of an image (unmix and get_nfdi in cdd.py)
+
+    The valid pixels are unmixed, cloud masked and turned into NFDI one
+    chunk at a time, so the fraction bands are never stored for the image.
+    """
+    nfdi = np.full(valid.size, np.nan, dtype=np.float32)
+    index = np.flatnonzero(valid)
+    sr = sr.reshape(sr.shape[0], -1)
+    for start in range(0, len(index), chunk):
+        pixels = index[start:start + chunk]
+        nfdi[pixels] = get_nfdi(unmix(sr[:, pixels]), cf_thresh)
+    return nfdi.reshape(valid.shape)
+
+def load_nfdi(scenes, cf_thresh, block=None, mask=None):
+    """ NFDI stack (time, y, x) of a list of (date, sensor, path) scenes
+
+    Only the pixels of mask (y, x), all by default, are unmixed, the others
+    are NaN.
+    """
+    nfdi = []
+    for date, sensor, path in scenes:
+        sr, valid = read_scene(path, sensor, block)
+        if mask is not None:
+            valid &= mask
+        nfdi.append(unmix_nfdi(sr, valid, cf_thresh))
+    return np.array(nfdi)
+
+# ** REGRESSION **
+
+def make_variables(t):
+    """ Predictors (time, 4): constant, t, sin and cos of the season """
+    season = t * 2 * np.pi
+    return np.column_stack([np.ones_like(t), t, np.sin(season), np.cos(season)])
+
+def solve_normal_equations(xtx, xty):
+    """ Solve a batch of 4x4 normal equations, (pixels, 4, 4) and (pixels, 4)
+
+    Singular systems (repeated dates) get the minimum norm solution, as
+    matrixPseudoInverse would.
+    """
+    try:
+        return np.linalg.solve(xtx, xty[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        return np.matmul(np.linalg.pinv(xtx), xty[:, :, np.newaxis])[:, :, 0]
+
+class RegressionStats(object):
+    """ Per-pixel sufficient statistics of the harmonic regression
+
+    X'X (pixels, 4, 4), X'y (pixels, 4), y'y and n (pixels,) of the
+    unmasked observations added so far. Observations are added as the
+    training period grows (and removed as a sliding window moves), so
+    refitting only costs the observations that changed.
+    """
+
+    def __init__(self, pixels):
+        self.xtx = np.zeros((pixels, 4, 4))
+        self.xty = np.zeros((pixels, 4))
+        self.yty = np.zeros(pixels)
+        self.n = np.zeros(pixels)
+
+    def update(self, t, nfdi, sign=1, chunk=10000):
+        """ Add (sign=1) or remove (sign=-1) observations (time, pixels)
+
+        Masked observations (NaN) are skipped with masked reductions over
+        the time axis.
+        """
+        predictors = make_variables(t)
+        # Outer product of the predictors of each date, (time, 16)
+        outer = (predictors[:, :, np.newaxis] *
+                 predictors[:, np.newaxis, :]).reshape(len(t), 16)
+        for start in range(0, nfdi.shape[1], chunk):
+            pixels = slice(start, start + chunk)
+            response = nfdi[:, pixels]
+            valid = ~np.isnan(response)
+            weight = valid.astype(np.float64)
+            response = np.where(valid, response, 0).astype(np.float64)
+            self.xtx[pixels] += sign * outer.T.dot(weight).T.reshape(-1, 4, 4)
+            self.xty[pixels] += sign * predictors.T.dot(response).T
+            self.yty[pixels] += sign * (response ** 2).sum(axis=0)
+            self.n[pixels] += sign * weight.sum(axis=0)
+        return self
+
+    def take(self, index):
+        """ RegressionStats of the pixels of index """
+        stats = RegressionStats(0)
+        stats.xtx, stats.xty = self.xtx[index], self.xty[index]
+        stats.yty, stats.n = self.yty[index], self.n[index]
+        return stats
+
+    def put(self, index, stats):
+        """ Set the statistics of the pixels of index from stats """
+        self.xtx[index], self.xty[index] = stats.xtx, stats.xty
+        self.yty[index], self.n[index] = stats.yty, stats.n
+
+    def coefs(self):
+        """ Regression coefficients (pixels, 4), NaN with 4 or fewer
+        observations """
+        coefs = np.full(self.xty.shape, np.nan)
+        solvable = self.n > 4
+        coefs[solvable] = solve_normal_equations(self.xtx[solvable],
+                                                 self.xty[solvable])
+        return coefs
+
+    def mean_residuals(self, coefs):
+        """ Root mean square residual (tmean) of coefs over the observations """
+        rss = (self.yty - 2 * (coefs * self.xty).sum(axis=1) +
+               np.einsum('pi,pij,pj->p', coefs, self.xtx, coefs))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.maximum(rss, 0) / self.n)
+
+def get_regression_coefs(t, nfdi):
+    """ Harmonic regression coefficients (pixels, 4) of an NFDI series
+
+    nfdi is (time, pixels) with NaN for masked observations. The normal
+    equations of every pixel are formed with masked reductions over the
+    time axis and solved at once. As in cdd.get_regression_coefs, masked
+    observations are dropped and pixels need more than 4 observations.
+    """
+    return RegressionStats(nfdi.shape[1]).update(t, nfdi).coefs()
+
+def predict_nfdi(t, coefs):
+    """ Predicted NFDI (time, pixels) """
+    return make_variables(t).dot(coefs.T)
+
+# ** MONITORING **
+
+def init_status(n):
+    """ Initial ts_status (5, pixels), see monitor_func """
+    status = np.zeros((5, n))
+    status[0] = 1
+    status[4] = 1
+    return status
+
+def status_changing(status):
+    """ 1 where a pixel is mid-change or changed, NaN where status is masked """
+    is_changing = ((status[1] > 0) | (status[0] == 0)).astype(np.float64)
+    is_changing[np.isnan(status[0])] = np.nan
+    return is_changing
+
+# Main monitoring function
+# status = 5 band array with status of change detection:
+    # 1. Change (1) or no change (0). Used as mask. Default: 0
+    # 2. Consecutive observations passed threshold. Default: 0
+    # 3. Date of change if 1 = 1. Default: 0
+    # 4. Magnitude of change
+    # 5. iterator
+def monitor_func(status, date, nfdi, pred, tmean, consec, thresh):
+    """ One ImageCollection.iterate step of cdd.monitor_func """
+    band_1, band_2, band_3, band_4, band_5 = status
+
+    # 1 if no change has been detected and not passed consec thresh
+    zero_mask_nc = (band_1 == 1) & (band_2 < consec)
+    cloud_mask = ~np.isnan(nfdi)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_res = (np.where(cloud_mask, nfdi, 0) - pred) / tmean
+        gt_thresh = (np.abs(norm_res) > thresh) & zero_mask_nc & cloud_mask
+
+        # Consecutive observations beyond threshold, not reset by clouds
+        _band_2 = (band_2 + gt_thresh) * band_1
+        band_2 = _band_2 * ((_band_2 > band_2) | ~cloud_mask)
+
+        flag_change = band_2 == consec
+        band_1 = ((band_1 == 1) & ~flag_change).astype(np.float64)
+        band_3 = band_3 + date * flag_change
+
+        magnitude = np.abs(norm_res) * gt_thresh * zero_mask_nc
+        is_changing = (band_1 == 0) | (band_2 > 0)
+        band_4 = (band_4 + magnitude) * is_changing
+
+    return np.array([band_1, band_2, band_3, band_4, band_5 + 1])
+
+def monitoring_model(status, old_coefs, stats, first, tmean):
+    """ Coefficients and tmean of a monitoring step
+
+    stats are the RegressionStats of the training period. Pixels mid-change
+    keep last step's coefficients (and tmean unless first). Returns the
+    coefficients, the tmean used for monitoring and the unblended tmean of
+    the training period.
+    """
+    _coefs = stats.coefs()
+
+    # check change status. If mid-change - use last year's coefficients.
+    is_changing = status_changing(status)[:, np.newaxis]
+    coefs = is_changing * old_coefs + (1 - is_changing) * _coefs
+
+    _tmean = stats.mean_residuals(coefs)
+    if first:
+        train_nfdi_mean = _tmean
+    else:
+        is_changing = is_changing[:, 0]
+        train_nfdi_mean = is_changing * tmean + (1 - is_changing) * _tmean
+    return coefs, train_nfdi_mean, _tmean
+
+# The scan runs monitor_func over every acquisition in one pass. With numba
+# the pixels are scanned in blocks of SCAN_BLOCK, whose state, model and
+# tmean are held in small arrays while the block goes through the dates,
+# predicting NFDI as it goes. Without numba the same steps are NumPy ufuncs
+# writing into buffers allocated once per scan. Both give the same status
+# as monitor_func, NaN and infinite residuals included.
+
+SCAN_BLOCK = 512
+USE_NUMBA = True
+_numba_scan = None
+
+def scan_blocks(status, predictors, nfdi, coefs, tmean, consec, thresh):
+    """ monitor_func over nfdi (time, pixels) in place on status, compiled
+    by numba """
+    n = nfdi.shape[1]
+    b1 = np.empty(SCAN_BLOCK)
+    b2 = np.empty(SCAN_BLOCK)
+    b3 = np.empty(SCAN_BLOCK)
+    b4 = np.empty(SCAN_BLOCK)
+    c = np.empty((4, SCAN_BLOCK))
+    m = np.empty(SCAN_BLOCK)
+    for start in range(0, n, SCAN_BLOCK):
+        w = min(n, start + SCAN_BLOCK) - start
+        for p in range(w):
+            b1[p] = status[0, start + p]
+            b2[p] = status[1, start + p]
+            b3[p] = status[2, start + p]
+            b4[p] = status[3, start + p]
+            for k in range(4):
+                c[k, p] = coefs[start + p, k]
+            m[p] = tmean[start + p]
+        for i in range(nfdi.shape[0]):
+            x0 = predictors[i, 0]
+            date = predictors[i, 1]
+            x2 = predictors[i, 2]
+            x3 = predictors[i, 3]
+            row = nfdi[i, start:start + w]
+            for p in range(w):
+                value = np.float64(row[p])
+                cloud = value == value
+                zero_mask_nc = (b1[p] == 1) & (b2[p] < consec)
+                pred = c[0, p] * x0 + c[1, p] * date + c[2, p] * x2 + c[3, p] * x3
+                res = abs(((value if cloud else 0.) - pred) / m[p])
+                gt_thresh = (res > thresh) & zero_mask_nc & cloud
+                # Consecutive observations beyond threshold, not reset by
+                # clouds
+                _band_2 = (b2[p] + gt_thresh) * b1[p]
+                band_2 = _band_2 * ((_band_2 > b2[p]) | (not cloud))
+                flag_change = band_2 == consec
+                band_1 = 1. if (b1[p] == 1) & (not flag_change) else 0.
+                b3[p] = b3[p] + date * flag_change
+                b4[p] = ((b4[p] + res * gt_thresh * zero_mask_nc) *
+                         ((band_1 == 0) | (band_2 > 0)))
+                b1[p] = band_1
+                b2[p] = band_2
+        for p in range(w):
+            status[0, start + p] = b1[p]
+            status[1, start + p] = b2[p]
+            status[2, start + p] = b3[p]
+            status[3, start + p] = b4[p]
+            status[4, start + p] += nfdi.shape[0]
+
+def numba_scan():
+    """ scan_blocks compiled by numba, None without numba """
+    global _numba_scan
+    if _numba_scan is None:
+        try:
+            import numba
+        except ImportError:
+            _numba_scan = False
+        else:
+            # Division by a zero tmean gives inf or NaN as in NumPy
+            _numba_scan = numba.njit(scan_blocks, error_model='numpy',
+                                     nogil=True, cache=True)
+    return _numba_scan or None
+
+def scan_numpy(status, predictors, nfdi, coefs, tmean, consec, thresh):
+    """ monitor_func over nfdi (time, pixels) in place on status, with
+    buffers allocated once """
+    band_1, band_2, band_3, band_4, band_5 = status
+    n = status.shape[1]
+    pred = np.empty(n)
+    res = np.empty(n)
+    new_band_2 = np.empty(n)
+    masked = np.empty(n, dtype=bool)
+    cloud_mask = np.empty(n, dtype=bool)
+    zero_mask_nc = np.empty(n, dtype=bool)
+    gt_thresh = np.empty(n, dtype=bool)
+    flag_change = np.empty(n, dtype=bool)
+    condition = np.empty(n, dtype=bool)
+    other = np.empty(n, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(nfdi.shape[0]):
+            np.less(band_2, consec, out=zero_mask_nc)
+            np.equal(band_1, 1, out=condition)
+            zero_mask_nc &= condition
+            np.isnan(nfdi[i], out=masked)
+            np.logical_not(masked, out=cloud_mask)
+
+            np.dot(coefs, predictors[i], out=pred)
+            res[:] = nfdi[i]
+            np.copyto(res, 0., where=masked)
+            res -= pred
+            res /= tmean
+            np.abs(res, out=res)
+            np.greater(res, thresh, out=gt_thresh)
+            gt_thresh &= zero_mask_nc
+            gt_thresh &= cloud_mask
+
+            # Consecutive observations beyond threshold, not reset by clouds
+            np.add(band_2, gt_thresh, out=new_band_2)
+            new_band_2 *= band_1
+            np.greater(new_band_2, band_2, out=condition)
+            condition |= masked
+            np.multiply(new_band_2, condition, out=band_2)
+
+            np.equal(band_2, consec, out=flag_change)
+            np.equal(band_1, 1, out=condition)
+            np.logical_not(flag_change, out=other)
+            condition &= other
+            band_1[:] = condition
+            np.multiply(flag_change, predictors[i, 1], out=pred)
+            band_3 += pred
+
+            res *= gt_thresh
+            res *= zero_mask_nc
+            np.equal(band_1, 0, out=condition)
+            np.greater(band_2, 0, out=other)
+            condition |= other
+            band_4 += res
+            band_4 *= condition
+    band_5 += nfdi.shape[0]
+
+def monitor_series(status, coefs, tmean, t, nfdi, consec, thresh):
+    """ Run monitor_func over the acquisitions (t, nfdi (time, pixels)) in
+    order, with the model coefs and tmean """
+    # Pixels without a model are masked from here on, as in Earth Engine
+    masked = ~np.isfinite(tmean) | (tmean == 0)
+
+    status = np.array(status, dtype=np.float64)
+    predictors = make_variables(np.asarray(t, dtype=np.float64))
+    coefs = np.ascontiguousarray(np.broadcast_to(coefs, (status.shape[1], 4)),
+                                 dtype=np.float64)
+    tmean = np.ascontiguousarray(tmean, dtype=np.float64)
+    nfdi = np.ascontiguousarray(nfdi)
+    scan = (USE_NUMBA and numba_scan()) or scan_numpy
+    scan(status, predictors, nfdi, coefs, tmean, consec, thresh)
+    status[:, masked] = np.nan
+    return status
+
+def deg_monitoring(status, old_coefs, stats, monitor, first, tmean, consec,
+                   thresh):
+    """ One monitoring step of cdd.deg_monitoring
+
+    stats are the RegressionStats of the training period and monitor a
+    (t, nfdi) tuple. Pixels mid-change keep last step's coefficients (and
+    tmean unless first). Returns the new status, coefficients and the
+    unblended tmean of the training period.
+    """
+    coefs, train_nfdi_mean, _tmean = monitoring_model(status, old_coefs,
+                                                      stats, first, tmean)
+    status = monitor_series(status, coefs, train_nfdi_mean, monitor[0],
+                            monitor[1], consec, thresh)
+    return status, coefs, _tmean
+
+# ** RETRAINING **
+
+def regression_retrain(t, nfdi, change_dates):
+    """ Post-change regression on pixels that changed, as Intercept, Slope,
+    Sin, Cos (pixels, 4) """
+    ischanged = change_dates > 0
+    coefs = np.full((nfdi.shape[1], 4), np.nan)
+    coefs[ischanged] = get_regression_coefs(t, nfdi[:, ischanged])
+    return coefs
+
+def last_observation(t, nfdi):
+    """ Time of the last valid observation of every pixel, NaN without
+    one """
+    valid = np.isfinite(nfdi)
+    last = np.where(valid, t[:, np.newaxis], -np.inf).max(axis=0)
+    last[~valid.any(axis=0)] = np.nan
+    return last
+
+def pred_middle_retrain(middle, coefs):
+    """ Trend-only prediction (no seasonality) at time middle """
+    return coefs[:, 0] + coefs[:, 1] * middle
+
+# ** CHECKPOINTS **
+
+def checkpoint_filename(checkpoint, year):
+    return '{0}_{1}.npz'.format(checkpoint, year)
+
+def save_checkpoint(filename, params, forest, status, coefs, original_coefs,
+                    tmean, stats):
+    """ Save the monitoring state after a step to a compressed npz file
+
+    params and the forest mask identify the run the state belongs to. The
+    file is written under a temporary name first so an interrupted run
+    never leaves a truncated checkpoint behind.
+    """
+    save_npz(filename, params=np.array(params, dtype=np.float64),
+             forest=forest, status=status, coefs=coefs,
+             original_coefs=original_coefs,
+             tmean=tmean, xtx=stats.xtx, xty=stats.xty, yty=stats.yty,
+             n=stats.n)
+
+def save_npz(filename, **arrays):
+    """ np.savez_compressed through a temporary file and a rename """
+    tmp_filename = filename[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(tmp_filename, **arrays)
+    os.rename(tmp_filename, filename)
+
+def load_checkpoint(filename, params, forest):
+    """ Return (status, coefs, original_coefs, tmean, stats) saved by
+    save_checkpoint """
+    pixels = len(forest)
+    with np.load(filename) as state:
+        if (not np.array_equal(state['params'], np.array(params, dtype=np.float64))
+                or 'forest' not in state.files
+                or not np.array_equal(state['forest'], forest)):
+            raise ValueError('checkpoint {0} belongs to a run with other '
+                             'parameters'.format(filename))
+        stats = RegressionStats(pixels)
+        stats.xtx, stats.xty = state['xtx'], state['xty']
+        stats.yty, stats.n = state['yty'], state['n']
+        return (state['status'], state['coefs'], state['original_coefs'],
+                state['tmean'], stats)
+
+# ** MAIN WORK **
+
+# Only the active pixels, still monitored, are refit and monitored by a
+# step. Pixels outside the forest mask are never active, as their output is
+# 0, nor are pixels masked for the lack of a model, which stay masked.
+# Without a sliding window a changed pixel keeps its model and its change,
+# so it leaves the active pixels after the step it changed in. Pixels out
+# of the active ones keep the statistics, coefficients and tmean of the
+# step they left, and their status moves on as monitor_func would leave
+# it.
+
+def still_active(status, window):
+    """ Pixels of a step's status still monitored in the next step """
+    if window:
+        # A changed pixel may still lose its model as observations leave the
+        # training window
+        return ~np.isnan(status[0])
+    return status[0] == 1
+
+def leave_step(status, coefs, tmean, inactive, observations):
+    """ Move the status of the inactive pixels over a step of observations
+    in place, as monitor_func and monitoring_model would """
+    masked = inactive & np.isnan(status[0])
+    coefs[masked] = np.nan
+    tmean[masked] = np.nan
+    if observations:
+        # The consecutive count of a changed pixel is reset
+        status[1, inactive & (status[0] == 0)] = 0
+    status[4, inactive] += observations
+
+def run_cdd(dates, sensors, nfdi, treecover=None, consec=5, thresh=3.5,
+            forest_threshold=FOREST_THRESHOLD, years=YEARS, stride=STRIDE,
+            retrain_year=RETRAIN_YEAR, window=None, checkpoint=None,
+            cf_thresh=.2):
+    """ Run the cdd.py pipeline on an NFDI stack
+
+    dates and sensors describe the time axis of nfdi (time, pixels). Each
+    of years starts a monitoring step of stride years. window is the length
+    in years of a sliding training period, by default the training period
+    keeps growing. If checkpoint is given the state after each step is
+    saved to <checkpoint>_<year>.npz and the run resumes after the last
+    saved step, if it was saved by a run with the same parameters, forest
+    mask and cf_thresh, the cloud fraction threshold nfdi was computed
+    with. Only the forest pixels, with treecover above forest_threshold,
+    are monitored. Returns the 5 band output (5, pixels).
+    """
+    t = years_since_epoch(dates)
+    pixels = nfdi.shape[1]
+    if treecover is None:
+        forest = np.ones(pixels, dtype=bool)
+    else:
+        forest = treecover > forest_threshold
+
+    def get_inputs(start, end, sensor_list):
+        return filter_date(dates, start, end) & np.array(
+            [s in sensor_list for s in sensors], dtype=bool)
+
+    # First year inputs (get_inputs_training)
+    train = get_inputs('{0}-01-01'.format(years[0] - 6),
+                       '{0}-12-31'.format(years[0] - 1), ['LE7', 'LT5'])
+    full_train = train.copy()
+    if window:
+        window_start = years_since_epoch([datetime.date(years[0] - window, 1, 1)])
+        train &= t >= window_start[0]
+
+    # Resume after the last step with a saved state
+    params = (years[0], stride, consec, thresh, window or 0, forest_threshold,
+              cf_thresh)
+    resumed = -1
+    if checkpoint:
+        for i in reversed(range(len(years))):
+            filename = checkpoint_filename(checkpoint, years[i])
+            if os.path.exists(filename):
+                status, coefs, original_coefs, tmean, stats = load_checkpoint(
+                    filename, params, forest)
+                resumed = i
+                break
+    if resumed < 0:
+        active = np.flatnonzero(forest)
+        stats = RegressionStats(pixels)
+        stats.put(active, RegressionStats(len(active)).update(
+            t[train], nfdi[np.ix_(train, active)]))
+        status = init_status(pixels)
+        coefs = np.zeros((pixels, 4))
+        tmean = np.full(pixels, np.nan)
+        original_coefs = None
+    else:
+        active = np.flatnonzero(forest & still_active(status, window))
+
+    for i, year in enumerate(years):
+        monitor = get_inputs('{0}-01-01'.format(year),
+                             '{0}-12-31'.format(year + stride - 1),
+                             ['LC8', 'LE7', 'LT5'])
+        if i > resumed:
+            monitor_nfdi = nfdi[np.ix_(monitor, active)]
+            active_stats = stats.take(active)
+            # cdd.py treats the first two years as first years
+            active_status, active_coefs, active_tmean = deg_monitoring(
+                status[:, active], coefs[active], active_stats,
+                (t[monitor], monitor_nfdi), i < 2, tmean[active], consec,
+                thresh)
+            inactive = np.ones(pixels, dtype=bool)
+            inactive[active] = False
+            leave_step(status, coefs, tmean, inactive, monitor.sum())
+            status[:, active] = active_status
+            coefs[active] = active_coefs
+            tmean[active] = active_tmean
+            if i < 2:
+                original_coefs = coefs.copy()
+
+            # combine monitoring nfdi with training
+            active_stats.update(t[monitor], monitor_nfdi)
+        train |= monitor
+        full_train |= monitor
+        if window:
+            # Remove observations that fall out of the next training window,
+            # after the last step too, so that a longer run resuming from its
+            # checkpoint starts from the same statistics as a fresh one
+            window_start = years_since_epoch(
+                [datetime.date(year + stride - window, 1, 1)])[0]
+            dropped = train & (t < window_start)
+            if i > resumed:
+                active_stats.update(t[dropped], nfdi[np.ix_(dropped, active)],
+                                    sign=-1)
+            train &= ~dropped
+        if i > resumed:
+            stats.put(active, active_stats)
+            active = active[still_active(active_status, window)]
+
+        if checkpoint and i > resumed:
+            save_checkpoint(checkpoint_filename(checkpoint, year), params,
+                            forest, status, coefs, original_coefs, tmean, stats)
+
+    change_dates = status[2]
+
+    # Retrain on the full series plus the retrain years (merged again, as
+    # in cdd.py)
+    retrain = get_inputs('{0}-01-01'.format(retrain_year),
+                         '{0}-12-31'.format(retrain_year + 1),
+                         ['LC8', 'LE7', 'LT5'])
+    retrain_t = np.concatenate([t[full_train], t[retrain]])
+    changed = np.flatnonzero(change_dates > 0)
+    retrain_nfdi = np.concatenate([nfdi[np.ix_(full_train, changed)],
+                                   nfdi[np.ix_(retrain, changed)]])
+    retrain_coefs = np.full((pixels, 4), np.nan)
+    retrain_coefs[changed] = regression_retrain(retrain_t, retrain_nfdi,
+                                                change_dates[changed])
+
+    # get the date at the middle of the retrain time series, which ends
+    # with the last observation of every pixel
+    retrain_last_date = np.full(pixels, np.nan)
+    retrain_last_date[changed] = last_observation(retrain_t, retrain_nfdi)
+    retrain_middle = (retrain_last_date - change_dates) / 2 + change_dates
+    predict_middle = pred_middle_retrain(retrain_middle, retrain_coefs)
+
+    # Get coefficients for middle of TS before
+    original_middle = (change_dates + 1970) / 2
+    predict_middle_original = pred_middle_retrain(original_middle,
+                                                  original_coefs)
+
+    # Normalize magnitude
+    st_magnitude = status[3] / consec * (change_dates > 0)
+
+    # save_output:
+    # Bands:
+        # 1. Change date
+        # 2. Short-term change magnitude
+        # 3. Retrain regression slope
+        # 4. Predicted NFDI after change, middle of retrain period
+        # 5. Pre-Change intercept normalized to middle of training period
+    # Mask:
+        # Hansen 2000 forest mask according to % canopy cover threshold
+    save_output = np.array([change_dates, st_magnitude, retrain_coefs[:, 1],
+                            predict_middle, predict_middle_original])
+    if treecover is not None:
+        save_output = save_output * (treecover > forest_threshold)
+    # Masked pixels are exported as 0
+    save_output[~np.isfinite(save_output)] = 0
+    return save_output.astype(np.float32)
+
+# ** TILES **
+
+# The algorithm is per pixel, so tiles are processed independently without
+# any overlap: each worker reads its block of every acquisition and returns
+# the output block, which is written as soon as it is done.
+
+def tile_blocks(x_size, y_size, tile):
+    """ (xoff, yoff, xsize, ysize) blocks covering the grid """
+    for yoff in range(0, y_size, tile):
+        for xoff in range(0, x_size, tile):
+            yield (xoff, yoff, min(tile, x_size - xoff), min(tile, y_size - yoff))
+
+def process_tile(task):
+    """ Run CDD on one block, returns (block, output (5, ysize, xsize)) """
+    block, scenes, treecover, cf_thresh, params = task
+    forest = None
+    if treecover:
+        treecover = gdal.Open(treecover).ReadAsArray(*block)
+        # Only the forest pixels are unmixed
+        forest = treecover > params.get('forest_threshold', FOREST_THRESHOLD)
+        treecover = treecover.ravel()
+    nfdi = load_nfdi(scenes, cf_thresh, block, forest)
+    nfdi = nfdi.reshape(len(scenes), -1)
+    if params.get('checkpoint'):
+        # One set of checkpoints per tile
+        params = dict(params, checkpoint=os.path.join(
+            params['checkpoint'], 'tile_{0}_{1}'.format(block[0], block[1])))
+    output = run_cdd([s[0] for s in scenes], [s[1] for s in scenes], nfdi,
+                     treecover, cf_thresh=cf_thresh, **params)
+    return block, output.reshape(-1, block[3], block[2])
+
+def create_output(path, dst_filename, bands=5):
+    """ Create a Float32 GeoTIFF on the grid of path """
+    example = gdal.Open(path)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(dst_filename, example.RasterXSize,
+                            example.RasterYSize, bands, gdal.GDT_Float32)
+    dataset.SetGeoTransform(example.GetGeoTransform())
+    dataset.SetProjection(example.GetProjection())
+    return dataset
+
+def run_tiled(scenes, dst_filename, treecover=None, cf_thresh=.2, tile=256,
+              processes=None, **params):
+    """ Run CDD over the scene grid tile by tile in a process pool
+
+    scenes is a list of (date, sensor, path) and treecover an optional path
+    to the Hansen treecover2000 raster. Other keyword arguments are passed
+    to run_cdd. Output blocks are written to dst_filename as tiles finish.
+    """
+    dataset = create_output(scenes[0][2], dst_filename)
+    tasks = [(block, scenes, treecover, cf_thresh, params) for block in
+             tile_blocks(dataset.RasterXSize, dataset.RasterYSize, tile)]
+
+    pool = None
+    if processes == 1:
+        results = map(process_tile, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(process_tile, tasks)
+
+    try:
+        for i, (block, output) in enumerate(results):
+            for b in range(output.shape[0]):
+                dataset.GetRasterBand(b + 1).WriteArray(output[b], block[0],
+                                                        block[1])
+            print('tile {0}/{1}'.format(i + 1, len(tasks)))
+    finally:
+        # Workers are stopped, also on an error
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    dataset.FlushCache()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__, version='0.6.2')
+
+    consec = int(args['--consec']) if args['--consec'] else 5
+    thresh = float(args['--thresh']) if args['--thresh'] else 3.5
+    forest_threshold = int(args['--forest']) if args['--forest'] else FOREST_THRESHOLD
+    cf_thresh = float(args['--cf']) if args['--cf'] else .2
+    window = int(args['--window']) if args['--window'] else None
+    tile = int(args['--tile']) if args['--tile'] else 256
+    start_year = int(args['--start']) if args['--start'] else 2000
+    end_year = int(args['--end']) if args['--end'] else 2014
+    stride = int(args['--stride']) if args['--stride'] else STRIDE
+    checkpoint = args['--checkpoint']
+    if checkpoint and not os.path.isdir(checkpoint):
+        os.makedirs(checkpoint)
+    processes = int(args['--processes']) if args['--processes'] else None
+
+    scenes = list_scenes(args['<input>'])
+    if not scenes:
+        print('no Landsat stacks in {0}'.format(args['<input>']))
+        sys.exit(1)
+    print('{0} scenes'.format(len(scenes)))
+
+    run_tiled(scenes, args['<output>'], args['--treecover'], cf_thresh, tile,
+              processes, consec=consec, thresh=thresh,
+              forest_threshold=forest_threshold, window=window,
+              years=range(start_year, end_year + 1, stride), stride=stride,
+              checkpoint=checkpoint)
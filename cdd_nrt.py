@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Near real time Continuous Degradation Detection on new acquisitions
+
+Continues the monitoring of a cdd_local.py run saved with --checkpoint
+with acquisitions made after its last monitoring step. The model of the
+next step (coefficients refit on the full training statistics, kept for
+pixels mid-change, and tmean) is fixed from the last checkpoint, and
+monitor_func is applied once per new acquisition to the saved status,
+including the counters of consecutive observations beyond the threshold.
+The updated state is saved next to the checkpoints, so every run only
+reads the acquisitions it has not seen yet, and only unmixes the pixels
+of the forest mask of the run. It is built again from the checkpoints
+when cdd_local.py saved a later step since, or ran with other parameters.
+The NFDI of the new acquisitions is computed with the cloud fraction
+threshold of the run.
+
+Writes the changes confirmed by the new acquisitions as a 2 band GeoTIFF
+(change date, short-term magnitude), 0 elsewhere.
+
+Usage: cdd_nrt.py [options] <checkpoint> <input> <output>
+
+  <checkpoint>            checkpoint directory of the cdd_local.py run
+  <input>                 directory of Landsat stacks, as for cdd_local.py
+  --tile=TILE             tile size of the cdd_local.py run (default: 256)
+  --cf=CF_THRESH          Cloud fraction threshold, must be that of the
+                          cdd_local.py run (default: that of the run)
+  --processes=PROCESSES   worker processes (default: number of cores)
+
+"""
+
+from docopt import docopt
+import datetime
+import glob
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+import cdd_local
+
+# ** STATE **
+
+# State of a tile after the last update: <checkpoint>/tile_<x>_<y>_nrt.npz
+# with the run parameters and the year of the step it was built from, the
+# forest mask, status, monitoring coefficients and tmean, and the ordinal
+# day of the last processed acquisition.
+
+def last_checkpoint(prefix):
+    """ (year, filename) of the last step saved by cdd_local.run_cdd """
+    steps = []
+    for filename in glob.glob(prefix + '_*.npz'):
+        match = re.match(r'_(\d{4})\.npz$', filename[len(prefix):])
+        if match:
+            steps.append((int(match.group(1)), filename))
+    if not steps:
+        raise ValueError('no checkpoint for {0}'.format(prefix))
+    return max(steps)
+
+def init_state(prefix, pixels):
+    """ Monitoring state after the last step of the checkpointed run """
+    year, filename = last_checkpoint(prefix)
+    with np.load(filename) as state:
+        params = state['params']
+        forest = state['forest'] if 'forest' in state.files else None
+    if forest is None or len(forest) != pixels:
+        raise ValueError('checkpoint {0} does not belong to a tile of {1} '
+                         'pixels'.format(filename, pixels))
+    start, stride = int(params[0]), int(params[1])
+    status, coefs, _, tmean, stats = cdd_local.load_checkpoint(
+        filename, params, forest)
+
+    # Model of the step after the last one, which is a first step (with its
+    # own tmean) only among the first two steps
+    first = (year - start) // stride + 1 < 2
+    coefs, tmean, _ = cdd_local.monitoring_model(status, coefs, stats, first,
+                                                 tmean)
+    # The last step monitored up to, and excluding, December 31
+    last = datetime.date(year + stride - 1, 12, 30).toordinal()
+    return {'params': params, 'year': np.array(year), 'forest': forest,
+            'status': status, 'coefs': coefs, 'tmean': tmean,
+            'last': np.array(last)}
+
+def load_state(prefix, pixels):
+    """ State saved by the last update, unless the checkpointed run saved a
+    later step or changed parameters since """
+    filename = prefix + '_nrt.npz'
+    if not os.path.exists(filename):
+        return init_state(prefix, pixels)
+    year, checkpoint = last_checkpoint(prefix)
+    with np.load(checkpoint) as run:
+        params = run['params']
+    with np.load(filename) as state:
+        if ('year' in state.files and int(state['year']) == year and
+                np.array_equal(state['params'], params)):
+            return dict((key, state[key]) for key in state.files)
+    print('{0}: model rebuilt from the step of {1}'.format(prefix, year))
+    return init_state(prefix, pixels)
+
+# ** UPDATE **
+
+def update(state, t, nfdi):
+    """ Run monitor_func over new acquisitions (t, nfdi (time, pixels))
+
+    Updates state in place and returns the mask of pixels whose change was
+    confirmed by these acquisitions.
+    """
+    consec, thresh = state['params'][2], state['params'][3]
+    unchanged = state['status'][0] == 1
+    state['status'] = cdd_local.monitor_series(
+        state['status'], state['coefs'], state['tmean'], t, nfdi, consec,
+        thresh)
+    return unchanged & (state['status'][0] == 0)
+
+def process_tile(task):
+    """ Update one block, returns (block, output (2, ysize, xsize)) """
+    block, scenes, checkpoint, cf_thresh = task
+    prefix = os.path.join(checkpoint, 'tile_{0}_{1}'.format(block[0], block[1]))
+    pixels = block[2] * block[3]
+    state = load_state(prefix, pixels)
+    # The new acquisitions are masked as the history they extend
+    run_cf_thresh = float(state['params'][6])
+    if cf_thresh is not None and cf_thresh != run_cf_thresh:
+        raise ValueError('cloud fraction threshold {0} differs from the {1} '
+                         'of the checkpointed run'.format(cf_thresh,
+                                                          run_cf_thresh))
+
+    output = np.zeros((2, pixels), dtype=np.float32)
+    new_scenes = [s for s in scenes if s[0].toordinal() > state['last']]
+    if new_scenes:
+        # Only the forest pixels of the run are monitored and unmixed
+        forest = state.get('forest')
+        if forest is not None:
+            forest = forest.reshape(block[3], block[2])
+        nfdi = cdd_local.load_nfdi(new_scenes, run_cf_thresh, block, forest)
+        t = cdd_local.years_since_epoch([s[0] for s in new_scenes])
+        changed = update(state, t, nfdi.reshape(len(new_scenes), -1))
+        state['last'] = np.array(new_scenes[-1][0].toordinal())
+
+        output[0, changed] = state['status'][2, changed]
+        output[1, changed] = state['status'][3, changed] / state['params'][2]
+    cdd_local.save_npz(prefix + '_nrt.npz', **state)
+    return block, output.reshape(2, block[3], block[2]), len(new_scenes)
+
+def run_nrt(scenes, checkpoint, dst_filename, cf_thresh=None, tile=256,
+            processes=None):
+    """ Update every tile of a checkpointed run with the new acquisitions of
+    scenes, writing the newly confirmed changes to dst_filename
+
+    cf_thresh, by default that of the run, raises ValueError if it is not
+    the cloud fraction threshold of the run.
+    """
+    dataset = cdd_local.create_output(scenes[0][2], dst_filename, bands=2)
+    tasks = [(block, scenes, checkpoint, cf_thresh) for block in
+             cdd_local.tile_blocks(dataset.RasterXSize, dataset.RasterYSize,
+                                   tile)]
+
+    pool = None
+    if processes == 1:
+        results = map(process_tile, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(process_tile, tasks)
+
+    try:
+        changes = 0
+        for i, (block, output, new_scenes) in enumerate(results):
+            for b in range(output.shape[0]):
+                dataset.GetRasterBand(b + 1).WriteArray(output[b], block[0],
+                                                        block[1])
+            changes += int((output[0] > 0).sum())
+            print('tile {0}/{1}: {2} new acquisitions'.format(i + 1, len(tasks),
+                                                              new_scenes))
+    finally:
+        # Workers are stopped, also on an error
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    dataset.FlushCache()
+    return changes
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__, version='0.6.2')
+
+    cf_thresh = float(args['--cf']) if args['--cf'] else None
+    tile = int(args['--tile']) if args['--tile'] else 256
+    processes = int(args['--processes']) if args['--processes'] else None
+
+    scenes = cdd_local.list_scenes(args['<input>'])
+    if not scenes:
+        print('no Landsat stacks in {0}'.format(args['<input>']))
+        sys.exit(1)
+
+    changes = run_nrt(scenes, args['<checkpoint>'], args['<output>'],
+                      cf_thresh, tile, processes)
+    print('{0} new changes'.format(changes))
@@ -8,218 +8,953 @@ Usage: postprocess_cdd.py [options] (sieve | fz | kmeans) <input> <output>
   --sigma=<SIGMA>         Sigma value for FZ test
   --scale=<SCALE>         Scale value for FZ test
   --convdate=<CONVDATE>   Convert date to year
+  --segsize=<SEGSIZE>     Mean segment size in pixels for kmeans (default: 400)
+  --reducers=<REDUCERS>   Comma separated reducer of each band for kmeans:
+                          median, mean, mode or max, the last one is used for
+                          the remaining bands (default: mode,max,median)
+  --tile=<TILE>           Tile size in pixels for kmeans and sieve (default:
+                          2048). fz segments the whole raster at once unless
+                          a tile size is given
+  --halo=<HALO>           Pixels around every kmeans or fz tile seen by the
+                          segmentation (default: 0 for kmeans, 32 for fz)
+  --processes=<PROCESSES> Worker processes for sieve and fz (default: number
+                          of cores)
+  --profile=<FILE>        Write the time and memory of the read, segment,
+                          sieve, reduce and write stages to a JSON and Chrome
+                          trace file, see profiling.py (default: the
+                          CDD_PROFILE environment variable)
+
+Outputs are compressed cloud optimized GeoTIFFs. With --convdate their bands
+are scaled Int16 when the values of every band fit, Float32 otherwise, and
+they are Float32 without it. The sieved change mask is Byte.
+
+The commands are also available as functions returning the output
+datasets, see run, and postprocess_batch.py runs them over many files.
 
 """
 
-import cv2, sys
-import pymeanshift as pms
+import sys
+import multiprocessing
+import os
+import warnings
 import numpy as np
 import gdal
-import scipy.stats
+import scipy.ndimage
 from docopt import docopt
-from skimage.color import rgb2gray
-#from skimage.filters import sobel
-from skimage.segmentation import felzenszwalb, slic, quickshift#, watershed
-from skimage.segmentation import mark_boundaries
-from skimage.util import img_as_float
-import time
+from skimage.segmentation import felzenszwalb, slic
+
+import profiling
 
 def convert_date(array):
     array[0,:,:][array[0,:,:] > 0] += 1970
-    array[0,:,:] = array[0,:,:].astype(np.int)
+    # Whole years, truncated as an integer cast would, NaN kept
+    array[0,:,:] = np.trunc(array[0,:,:])
     return array
 
+def segment_medians(values, labels, nan_to_zero=False):
+    """ Median of the positive values of every segment of labels, 0 for
+    segments whose median is not positive
+
+    Segments containing NaN get 0 unless nan_to_zero, where NaN counts as 0.
+    The values are sorted by label once, so every segment is a contiguous
+    run of sorted values and its medians are found by indexing.
+    Returns an array indexed by label.
+    """
+    labels = labels.ravel()
+    values = values.ravel()
+    if nan_to_zero:
+        values = np.where(np.isnan(values), 0, values)
+    n_labels = labels.max() + 1
+
+    order = np.lexsort((values, labels))
+    sorted_values = values[order]
+    counts = np.bincount(labels, minlength=n_labels)
+    starts = np.cumsum(counts) - counts
+    # NaN sort last and are excluded from the positive values
+    nans = np.bincount(labels, weights=np.isnan(values), minlength=n_labels)
+    positives = np.bincount(labels, weights=values > 0, minlength=n_labels).astype(np.int64)
+
+    def median(starts, counts):
+        # Median of the runs sorted_values[starts:starts + counts]
+        counts = np.maximum(counts, 1)
+        low = sorted_values[np.minimum(starts + (counts - 1) // 2, len(sorted_values) - 1)]
+        high = sorted_values[np.minimum(starts + counts // 2, len(sorted_values) - 1)]
+        return (low + high) / 2
+
+    # Positive values are the last ones before any NaN
+    with np.errstate(invalid='ignore'):
+        is_positive = (counts > 0) & (nans == 0) & (median(starts, counts) > 0)
+    positive_starts = starts + counts - positives
+    return np.where(is_positive, median(positive_starts, positives), 0)
+
+# Bands 1, 2 and 4, from 1, which felzenszwalb segments, and number of
+# bands reduced to their segment medians
+FZ_BANDS = [1, 2, 4]
+FZ_MEDIANS = 4
+
+def fz_image(full_image, bands=(0, 1, 3)):
+    # uint8 image of bands 1, 2 and 4 for felzenszwalb, at indexes bands of
+    # full_image
+    img = np.empty(full_image.shape[1:] + (3,), dtype=np.uint8)
+    for i, band in enumerate(bands):
+        img[:,:,i] = full_image[band]
+    return img
+
+def segment_fz(image, output, scale, sigma, minseg, convdate, tile=None,
+               halo=32, processes=None):
+    """ Median of bands 1 to 4 over Felzenszwalb segments
+
+    The whole raster is segmented at once, or with tile in overlapping tiles
+    of a process pool whose segments are then joined across tile edges.
+    The medians are reduced and written block by block, of tile pixels or
+    of the output blocks. Returns the output dataset, in memory when output
+    is None.
+    """
+    original_im = open_input(image)
+    x_size, y_size = original_im.RasterXSize, original_im.RasterYSize
+
+    #Assign median values based on Felzenzwalb segmentation algorithm
+    with profiling.stage('segment') as stage:
+        if tile:
+            segments_fz = fz_tiles(image, scale, sigma, minseg, tile, halo,
+                                   processes)
+        else:
+            fz_bands, _ = read_block(image, (0, 0, x_size, y_size),
+                                     bands=FZ_BANDS)
+            segments_fz = felzenszwalb(fz_image(fz_bands, (0, 1, 2)),
+                                       scale=scale, sigma=sigma,
+                                       min_size=minseg)
+            fz_bands = None
+        stage.arrays(segments=segments_fz)
+    if tile:
+        print('seam boundary ratio {0:.2f}'.format(seam_ratio(segments_fz,
+                                                              tile)))
+
+    blocks = list(tile_blocks(x_size, y_size, tile or 4 * COG_BLOCK))
+    with profiling.stage('reduce') as stage:
+        # Medians of every segment, bands after the fourth are 0
+        summary = np.zeros((original_im.RasterCount, segments_fz.max() + 1),
+                           dtype=np.float32)
+        summary[:FZ_MEDIANS] = block_medians(image, segments_fz, blocks)
+        if convdate:
+            summary = convert_date(summary[:, np.newaxis])[:, 0]
+        stage.arrays(summary=summary)
+
+    types = band_types(value_ranges(summary), convdate, output is None)
+    dataset = create_output(image, output, types)
+    for xoff, yoff, block_x, block_y in blocks:
+        write_block(dataset, summary[:, segments_fz[yoff:yoff + block_y,
+                                                    xoff:xoff + block_x]],
+                    (xoff, yoff, block_x, block_y), types)
+    result = close_output(dataset, output)
+    dataset = None
+    remove_temporary(output)
+    return result
+
+def block_medians(image, segments, blocks):
+    """ segment_medians of bands 1 to 4 over the segments of the raster,
+    reading its blocks one at a time
+
+    The segments within a block are reduced with the block, the pixels of
+    segments spanning blocks are kept until every block is read. Bands 3
+    and 4 count NaN as 0, bands 1 and 2 get 0 in segments with NaN.
+    Returns an array (4, segments).
+    """
+    counts = np.bincount(segments.ravel())
+    medians = np.zeros((FZ_MEDIANS, len(counts)))
+    spanning_labels = []
+    spanning_values = []
+    for xoff, yoff, x_size, y_size in blocks:
+        values, _ = read_block(image, (xoff, yoff, x_size, y_size),
+                               bands=list(range(1, FZ_MEDIANS + 1)))
+        values = values.reshape(FZ_MEDIANS, -1)
+        labels = segments[yoff:yoff + y_size, xoff:xoff + x_size].ravel()
+        uniques, local = np.unique(labels, return_inverse=True)
+        local = local.ravel()
+        within = np.bincount(local) == counts[uniques]
+        for band in range(FZ_MEDIANS):
+            medians[band, uniques[within]] = segment_medians(
+                values[band], local, nan_to_zero=band >= 2)[within]
+        spanning = ~within[local]
+        spanning_labels.append(labels[spanning])
+        spanning_values.append(values[:, spanning])
+
+    labels = np.concatenate(spanning_labels)
+    if len(labels):
+        values = np.concatenate(spanning_values, axis=1)
+        uniques, local = np.unique(labels, return_inverse=True)
+        for band in range(FZ_MEDIANS):
+            medians[band, uniques] = segment_medians(
+                values[band], local.ravel(), nan_to_zero=band >= 2)
+    return medians
+
+# Reducers of the positive values of a segment for segment_km. mode is the
+# most frequent whole year, for the change date band
+REDUCERS = ('median', 'mean', 'mode', 'max')
+
+def segment_reduce(values, labels, reducer):
+    """ Reduce the positive values of every segment of labels, 0 for
+    segments without positive values (NaN counts as 0)
+
+    The positive values are sorted by label once, so every segment is a
+    contiguous run. Returns an array indexed by label.
+    """
+    if reducer not in REDUCERS:
+        raise ValueError('unknown reducer {0}'.format(reducer))
+    labels = labels.ravel()
+    values = values.ravel()
+    n_labels = labels.max() + 1
+    positive = values > 0
+    labels = labels[positive]
+    values = values[positive]
+    if reducer == 'mode':
+        values = np.floor(values)
+
+    counts = np.bincount(labels, minlength=n_labels)
+    has_values = counts > 0
+    result = np.zeros(len(counts))
+    if reducer == 'mean':
+        sums = np.bincount(labels, weights=values, minlength=len(counts))
+        result[has_values] = sums[has_values] / counts[has_values]
+        return result
+
+    order = np.lexsort((values, labels))
+    labels = labels[order]
+    values = values[order]
+    starts = (np.cumsum(counts) - counts)[has_values]
+    counts = counts[has_values]
+    if reducer == 'max':
+        result[has_values] = values[starts + counts - 1]
+    elif reducer == 'median':
+        result[has_values] = (values[starts + (counts - 1) // 2] +
+                              values[starts + counts // 2]) / 2
+    else:
+        # Runs of equal (label, value), keep the longest run of every label
+        # and the earliest year on ties
+        new_run = np.ones(len(values), dtype=bool)
+        new_run[1:] = (labels[1:] != labels[:-1]) | (values[1:] != values[:-1])
+        run_starts = np.flatnonzero(new_run)
+        run_counts = np.diff(np.append(run_starts, len(values)))
+        run_labels = labels[run_starts]
+        best = np.lexsort((values[run_starts], -run_counts, run_labels))
+        first = np.ones(len(best), dtype=bool)
+        first[1:] = run_labels[best][1:] != run_labels[best][:-1]
+        result[run_labels[best][first]] = values[run_starts][best][first]
+    return result
+
+def tile_blocks(x_size, y_size, tile):
+    """ (xoff, yoff, xsize, ysize) blocks covering the raster """
+    for yoff in range(0, y_size, tile):
+        for xoff in range(0, x_size, tile):
+            yield (xoff, yoff, min(tile, x_size - xoff), min(tile, y_size - yoff))
+
+# ** INPUT **
+
+# Inputs are read block by block, every block once with all the bands it
+# needs, in the input data type. Steps which depend on the neighbourhood
+# of a pixel read their block with a halo of pixels around it, clipped to
+# the raster, and keep the results of the block only.
+
+_input = {}
+
+def open_input(path):
+    """ GDAL dataset of path, kept open by the process until another input
+    is opened """
+    key = (os.getpid(), path)
+    if key not in _input:
+        _input.clear()
+        _input[key] = gdal.Open(path, gdal.GA_ReadOnly)
+    return _input[key]
+
+def read_block(path, block, halo=0, bands=None):
+    """ Read block grown by halo pixels on every side
+
+    bands is a list of band numbers, from 1, or None for all the bands.
+    Returns (array (bands, ysize, xsize), (row slice, column slice) of the
+    block in the array).
+    """
+    dataset = open_input(path)
+    xoff = max(0, block[0] - halo)
+    yoff = max(0, block[1] - halo)
+    x_size = min(dataset.RasterXSize, block[0] + block[2] + halo) - xoff
+    y_size = min(dataset.RasterYSize, block[1] + block[3] + halo) - yoff
+    with profiling.stage('read') as stage:
+        if bands is None:
+            array = dataset.ReadAsArray(xoff, yoff, x_size, y_size)
+            array = array.reshape(-1, y_size, x_size)
+        else:
+            array = np.stack([dataset.GetRasterBand(b).ReadAsArray(
+                xoff, yoff, x_size, y_size) for b in bands])
+        stage.arrays(array=array)
+    inner = (slice(block[1] - yoff, block[1] - yoff + block[3]),
+             slice(block[0] - xoff, block[0] - xoff + block[2]))
+    return array, inner
+
+# ** OUTPUT **
+
+# Outputs are cloud optimized GeoTIFFs. Blocks are written to a tiled,
+# uncompressed temporary file, whose overviews are then built and which is
+# copied to a DEFLATE compressed, tiled GeoTIFF with the overviews after
+# the full resolution image. Only a block at a time is held in memory.
+#
+# A GeoTIFF has a single data type. When the change date is converted to a
+# year, the bands are scaled Int16 if the values of every band fit at its
+# scale: the year, the short-term magnitude in hundredths and the slope and
+# NFDI bands in ten thousandths, up to +-3.2767. The intercept normalized
+# to the middle of the training period often exceeds that range, and the
+# output is then Float32 as it is without convdate. The scale of every band
+# is set in the file, the values are stored / scale.
+
+COG_BLOCK = 512
+GDAL_TYPES = {'uint8': gdal.GDT_Byte, 'int16': gdal.GDT_Int16,
+              'float32': gdal.GDT_Float32}
+CONVDATE_SCALES = (1, .01, 1e-4)
+
+def band_types(ranges, convdate, in_memory=False):
+    """ (dtype, scale) of every band of a CDD output
+
+    ranges are the (min, max) of every band, as written: after
+    convert_date with convdate. In memory outputs are not scaled.
+    """
+    bands = len(ranges)
+    if not convdate or in_memory:
+        return [('float32', 1)] * bands
+    scales = [CONVDATE_SCALES[min(b, 2)] for b in range(bands)]
+    info = np.iinfo(np.int16)
+    if all(info.min <= np.round(low / scale) and np.round(high / scale) <= info.max
+           for (low, high), scale in zip(ranges, scales)):
+        return [('int16', scale) for scale in scales]
+    return [('float32', 1)] * bands
+
+def value_ranges(array):
+    """ (min, max) of every band of array (bands, ...), with 0 and with NaN
+    as 0, as outputs are written """
+    values = np.nan_to_num(array.reshape(len(array), -1))
+    return list(zip(np.minimum(values.min(axis=1), 0),
+                    np.maximum(values.max(axis=1), 0)))
+
+def input_ranges(path, convdate):
+    """ value_ranges of the input, block by block, after convert_date with
+    convdate. Segment reducers and the sieve keep values in these ranges """
+    dataset = open_input(path)
+    ranges = [(0, 0)] * dataset.RasterCount
+    for block in tile_blocks(dataset.RasterXSize, dataset.RasterYSize,
+                             4 * COG_BLOCK):
+        array, _ = read_block(path, block)
+        array = array.astype(np.float64)
+        if convdate:
+            array = convert_date(array)
+        ranges = [(min(low, block_low), max(high, block_high))
+                  for (low, high), (block_low, block_high)
+                  in zip(ranges, value_ranges(array))]
+    return ranges
+
+def create_output(path, dst_filename, types):
+    """ Temporary tiled GeoTIFF on the grid of path for bands of types, made
+    into dst_filename by close_output, or an in-memory dataset when
+    dst_filename is None """
+    example = open_input(path)
+    if dst_filename is None:
+        dataset = gdal.GetDriverByName('MEM').Create(
+            '', example.RasterXSize, example.RasterYSize, len(types),
+            GDAL_TYPES[types[0][0]])
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(dst_filename + '.tmp.tif', example.RasterXSize,
+                                example.RasterYSize, len(types),
+                                GDAL_TYPES[types[0][0]],
+                                ['TILED=YES', 'BLOCKXSIZE={0}'.format(COG_BLOCK),
+                                 'BLOCKYSIZE={0}'.format(COG_BLOCK),
+                                 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform(example.GetGeoTransform())
+    dataset.SetProjection(example.GetProjection())
+    for b, (dtype, scale) in enumerate(types):
+        dataset.GetRasterBand(b + 1).SetScale(scale)
+    return dataset
+
+def write_block(dataset, array, block, types):
+    """ Write array (bands, ysize, xsize) at block. Integer bands store
+    round(value / scale) clipped to their type, with NaN as 0, and warn of
+    the clipped values """
+    with profiling.stage('write') as stage:
+        stage.arrays(array=array)
+        for b, (dtype, scale) in enumerate(types):
+            values = array[b]
+            if np.dtype(dtype).kind != 'f':
+                info = np.iinfo(dtype)
+                values = np.round(np.nan_to_num(values).astype(np.float64) / scale)
+                clipped = np.count_nonzero((values < info.min) | (values > info.max))
+                if clipped:
+                    warnings.warn('{0} values of band {1} out of the {2} range '
+                                  'at scale {3} were clipped'.format(
+                                      clipped, b + 1, dtype, scale))
+                values = np.clip(values, info.min, info.max)
+            dataset.GetRasterBand(b + 1).WriteArray(values.astype(dtype),
+                                                    block[0], block[1])
+
+def close_output(dataset, dst_filename):
+    """ Build the overviews of the temporary file, down to a single block,
+    and copy it to the cloud optimized dst_filename. Returns the output
+    dataset. The temporary file is removed by remove_temporary """
+    if dst_filename is None:
+        return dataset
+    with profiling.stage('write overviews'):
+        levels = []
+        while (max(dataset.RasterXSize, dataset.RasterYSize) // 2 ** len(levels)
+               > COG_BLOCK):
+            levels.append(2 ** (len(levels) + 1))
+        # Change dates and magnitudes are not averaged with unchanged pixels
+        if levels:
+            dataset.BuildOverviews('NEAREST', levels)
+        dataset.FlushCache()
+
+        if dataset.GetRasterBand(1).DataType == gdal.GDT_Float32:
+            predictor = 3
+        else:
+            predictor = 2
+        driver = gdal.GetDriverByName('GTiff')
+        driver.CreateCopy(dst_filename, dataset, 0,
+                          ['TILED=YES', 'BLOCKXSIZE={0}'.format(COG_BLOCK),
+                           'BLOCKYSIZE={0}'.format(COG_BLOCK), 'COMPRESS=DEFLATE',
+                           'PREDICTOR={0}'.format(predictor),
+                           'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER'])
+        return gdal.Open(dst_filename)
+
+def remove_temporary(dst_filename):
+    """ Delete the temporary file of dst_filename. Every handle to it must
+    be released first, Windows and some drivers cannot delete an open
+    file """
+    if dst_filename is not None:
+        gdal.GetDriverByName('GTiff').Delete(dst_filename + '.tmp.tif')
+
 def save_raster(array, path, dst_filename, convdate):
 
     #Convert date from years since 1970 to year
     if convdate:
         array = convert_date(array)
 
-    example = gdal.Open(path)
-    x_pixels = array.shape[2]  # number of pixels in x
-    y_pixels = array.shape[1]  # number of pixels in y
-    bands = array.shape[0]
-    driver = gdal.GetDriverByName('GTiff')
-    dataset = driver.Create(dst_filename,x_pixels, y_pixels, bands ,gdal.GDT_Float64)
-
-    geotrans=example.GetGeoTransform()  #get GeoTranform from existed 'data0'
-    proj=example.GetProjection() #you can get from a exsited tif or import 
-    dataset.SetGeoTransform(geotrans)
-    dataset.SetProjection(proj)
-
-    for b in range(bands):
-        dataset.GetRasterBand(b+1).WriteArray(array[b,:,:])
-
-    dataset.FlushCache()
-    #dataset=None
-
-def save_raster_memory(array, path):
-    example = gdal.Open(path)
-    x_pixels = array.shape[1]  # number of pixels in x
-    y_pixels = array.shape[0]  # number of pixels in y
-    driver = gdal.GetDriverByName('MEM')
-    dataset = driver.Create('',x_pixels, y_pixels, 1,gdal.GDT_Int32) #TODO: bands
-    dataset.GetRasterBand(1).WriteArray(array[:,:])
-
-    # follow code is adding GeoTranform and Projection
-    geotrans=example.GetGeoTransform()  #get GeoTranform from existed 'data0'
-    proj=example.GetProjection() #you can get from a exsited tif or import 
-    dataset.SetGeoTransform(geotrans)
-    dataset.SetProjection(proj)
-    return dataset
-
-def segment_fz(image, output, scale, sigma, minseg, convdate):
-    original_im = gdal.Open(image)
-
-    #Assign median values based on Felzenzwalb segmentation algorithm
-    three_d_image = original_im.ReadAsArray().astype(np.uint8)
-    three_d_image = three_d_image.swapaxes(0, 2)
-    three_d_image = three_d_image.swapaxes(0, 1)
-    img = three_d_image[:,:,(0,1,3)]
-
-    full_image = original_im.ReadAsArray()
-    full_image = full_image.swapaxes(0, 2)
-    full_image = full_image.swapaxes(0, 1)
-
-    segments_fz = felzenszwalb(img, scale=scale, sigma=sigma, min_size=minseg)
-    median_image = np.zeros_like(full_image).astype(np.float32)
-    for band in range(4):
-        for seg in np.unique(segments_fz):
-            values = full_image[:,:,band][segments_fz == seg]
-
-            if band < 2:
-	        if np.median(values) > 0:
-                    med = np.median(values[values>0])
-                else:
-                    med = 0
-
+    types = band_types(value_ranges(array), convdate, dst_filename is None)
+    dataset = create_output(path, dst_filename, types)
+    for block in tile_blocks(array.shape[2], array.shape[1], 4 * COG_BLOCK):
+        xoff, yoff, xsize, ysize = block
+        write_block(dataset, array[:, yoff:yoff + ysize, xoff:xoff + xsize],
+                    block, types)
+    output = close_output(dataset, dst_filename)
+    dataset = None
+    remove_temporary(dst_filename)
+    return output
+
+def segment_km(image, output, convdate, segsize=400,
+               reducers=('mode', 'max', 'median'), tile=2048, halo=0):
+    """ Summarize every band over SLIC segments of about segsize pixels
+
+    The raster is segmented and reduced tile by tile, so memory is bounded
+    by the tile size. Tiles are segmented with halo pixels around them, so
+    segments along tile edges see their neighbourhood. reducers gives the
+    reducer of each band, the last one is used for the remaining bands.
+    Returns the output dataset, in memory when output is None.
+    """
+    original_im = open_input(image)
+    bands = original_im.RasterCount
+    reducers = list(reducers) + [reducers[-1]] * (bands - len(reducers))
+    ranges = [(0, 0)] * bands
+    if convdate and output is not None:
+        ranges = input_ranges(image, convdate)
+    types = band_types(ranges, convdate, output is None)
+    dataset = create_output(image, output, types)
+
+    for block in tile_blocks(original_im.RasterXSize, original_im.RasterYSize,
+                             tile):
+        full_image, inner = read_block(image, block, halo)
+        img = np.nan_to_num(full_image).astype(np.uint8).transpose(1, 2, 0)
+
+        # Segment count scales with the tile area
+        with profiling.stage('segment') as stage:
+            segments_slic = slic(img, n_segments=max(1, img.shape[0] * img.shape[1] // segsize),
+                                 compactness=10, sigma=1)
+            stage.arrays(segments=segments_slic)
+        segments_slic = segments_slic[inner]
+        with profiling.stage('reduce') as stage:
+            summary = np.zeros((bands, block[3], block[2]))
+            for band in range(bands):
+                summary[band] = segment_reduce(full_image[band][inner], segments_slic,
+                                               reducers[band])[segments_slic]
+            stage.arrays(summary=summary)
+
+        if convdate:
+            summary = convert_date(summary)
+        write_block(dataset, summary, block, types)
+    result = close_output(dataset, output)
+    dataset = None
+    remove_temporary(output)
+    return result
+
+# ** SIEVE **
+
+# gdal.SieveFilter with threshold 4 and 8-connectedness on the changed
+# (band 1 > 0) / unchanged pixels merges every polygon, changed or not,
+# smaller than 4 pixels into its largest neighbouring polygon. A polygon
+# of less than 4 pixels is enclosed by a single polygon of the other value,
+# of at least 4 pixels, so sieving flips it. The exception is a single
+# pixel in a raster corner whose 3 neighbours form a polygon of their own:
+# SieveFilter follows the largest neighbours until a polygon of 4 pixels,
+# so the pixel is merged through its neighbours into the polygon around
+# them and keeps its value.
+#
+# Polygons are labelled tile by tile in a process pool and those crossing
+# tile edges are merged with a union-find, so only tile edges and small
+# polygons are kept in memory.
+#
+# In a raster less than 4 pixels wide or high, a small polygon may span it
+# and touch two polygons, small ones among them. SieveFilter merges it into
+# the first largest one it meets, or not at all when following the largest
+# neighbours never reaches a polygon of 4 pixels. Such rasters are small
+# and are sieved whole by sieve_filter, which merges the polygons as
+# SieveFilter does.
+
+SIEVE_THRESHOLD = 4
+EIGHT_CONNECTED = np.ones((3, 3), dtype=int)
+
+class UnionFind(object):
+    """ Disjoint sets of integer ids """
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while x != root:
+            self.parent[x], x = root, self.parent.get(x, x)
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+def label_polygons(changed):
+    """ 8-connected polygons labelled from 1, changed polygons first.
+    Returns (labels, number of changed polygons, number of polygons) """
+    labels, n_changed = scipy.ndimage.label(changed, EIGHT_CONNECTED)
+    unchanged, n_unchanged = scipy.ndimage.label(~changed, EIGHT_CONNECTED)
+    labels[~changed] = unchanged[~changed] + n_changed
+    return labels, n_changed, n_changed + n_unchanged
+
+def read_changed(image, block):
+    # NaN is unchanged, as in the Int32 copy given to SieveFilter
+    band, _ = read_block(image, block, bands=[1])
+    with np.errstate(invalid='ignore'):
+        return band[0] > 0
+
+def sieve_polygons(task):
+    """ Polygons of one tile: sizes of the polygons on the tile edges, small
+    polygons inside the tile, the labels along the edges and the labels of
+    the pixels of the tile in the 2x2 corners of the raster """
+    image, block, x_size, y_size = task
+    changed = read_changed(image, block)
+    labels, n_changed, n = label_polygons(changed)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+
+    edges = {'top': labels[0], 'bottom': labels[-1],
+             'left': labels[:, 0], 'right': labels[:, -1]}
+    on_edge = np.zeros(n + 1, dtype=bool)
+    for edge in edges.values():
+        on_edge[edge] = True
+    small = np.flatnonzero((sizes < SIEVE_THRESHOLD) & ~on_edge)
+    edge_labels = np.flatnonzero(on_edge)
+    corners = {}
+    for y in (0, 1, y_size - 2, y_size - 1):
+        for x in (0, 1, x_size - 2, x_size - 1):
+            if (block[1] <= y < block[1] + block[3] and
+                    block[0] <= x < block[0] + block[2]):
+                corners[(y, x)] = labels[y - block[1], x - block[0]]
+    return {'block': block, 'n_changed': n_changed, 'n': n,
+            'small': small[small > 0],
+            'edge_sizes': dict(zip(edge_labels, sizes[edge_labels])),
+            'edges': edges, 'corners': corners}
+
+def join_edges(uf, a, a_edge, a_offset, b, b_edge, b_offset):
+    # Union the polygons of two facing tile edges, 8-connected: every pixel
+    # touches the 3 facing pixels around it
+    la = a['edges'][a_edge]
+    lb = b['edges'][b_edge]
+    for shift in (-1, 0, 1):
+        pa = la[max(0, -shift):len(la) - max(0, shift)]
+        pb = lb[max(0, shift):len(lb) - max(0, -shift)]
+        same = (pa <= a['n_changed']) == (pb <= b['n_changed'])
+        pairs = set(zip(pa[same] + a_offset, pb[same] + b_offset))
+        for ga, gb in pairs:
+            uf.union(ga, gb)
+
+def sieve_flips(tiles, grid):
+    """ Labels of the polygons to flip in every tile
+
+    tiles are the sieve_polygons results and grid maps (row, column) of a
+    tile to its index in tiles.
+    """
+    offsets = np.cumsum([0] + [t['n'] for t in tiles])
+    uf = UnionFind()
+    for (i, j), k in grid.items():
+        for (di, dj), a_edge, b_edge in (((0, 1), 'right', 'left'),
+                                         ((1, 0), 'bottom', 'top')):
+            if (i + di, j + dj) in grid:
+                m = grid[(i + di, j + dj)]
+                join_edges(uf, tiles[k], a_edge, offsets[k], tiles[m], b_edge,
+                           offsets[m])
+        # Diagonal neighbours touch at a single corner pixel
+        for dj, a_pixel, b_pixel in ((1, -1, 0), (-1, 0, -1)):
+            if (i + 1, j + dj) in grid:
+                m = grid[(i + 1, j + dj)]
+                la = tiles[k]['edges']['bottom'][a_pixel]
+                lb = tiles[m]['edges']['top'][b_pixel]
+                if (la <= tiles[k]['n_changed']) == (lb <= tiles[m]['n_changed']):
+                    uf.union(la + offsets[k], lb + offsets[m])
+
+    # Sizes of the polygons crossing tile edges
+    sizes = {}
+    for k, tile in enumerate(tiles):
+        for label, size in tile['edge_sizes'].items():
+            root = uf.find(label + offsets[k])
+            sizes[root] = sizes.get(root, 0) + size
+
+    flips = []
+    for k, tile in enumerate(tiles):
+        edge_small = [label for label in tile['edge_sizes']
+                      if sizes[uf.find(label + offsets[k])] < SIEVE_THRESHOLD]
+        flips.append(set(tile['small']) | set(edge_small))
+
+    # Single pixels in the raster corners next to a 3 pixel polygon
+    corners = {}
+    for k, tile in enumerate(tiles):
+        for pixel, label in tile['corners'].items():
+            corners[pixel] = (k, label, uf.find(label + offsets[k]))
+    y_size = max(y for y, _ in corners) + 1
+    x_size = max(x for _, x in corners) + 1
+    if y_size < 3 or x_size < 3:
+        return flips
+    for (y, x), dy, dx in (((0, 0), 1, 1), ((0, x_size - 1), 1, -1),
+                           ((y_size - 1, 0), -1, 1),
+                           ((y_size - 1, x_size - 1), -1, -1)):
+        k, label, root = corners[(y, x)]
+        neighbours = set(corners[pixel][2] for pixel in
+                         ((y + dy, x), (y, x + dx), (y + dy, x + dx)))
+        if (sizes.get(root) == 1 and len(neighbours) == 1 and
+                sizes.get(neighbours.pop()) == 3):
+            flips[k].discard(label)
+    return flips
+
+# Neighbours of a pixel in the order SieveFilter compares them
+SIEVE_NEIGHBOURS = ((-1, 0), (-1, -1), (-1, 1), (0, -1), (0, 1), (1, 0),
+                    (1, -1), (1, 1))
+
+def sieve_filter(changed):
+    """ changed (ysize, xsize) sieved as gdal.SieveFilter with threshold 4
+    and 8-connectedness, for a whole raster """
+    labels, n_changed, n = label_polygons(changed)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+
+    # The largest neighbour of every polygon, the first one met in the
+    # order of the pixels and of their neighbours among equal sizes
+    y_size, x_size = labels.shape
+    order = np.arange(labels.size).reshape(labels.shape) * len(SIEVE_NEIGHBOURS)
+    pairs = []
+    for k, (dy, dx) in enumerate(SIEVE_NEIGHBOURS):
+        here = (slice(max(0, -dy), y_size - max(0, dy)),
+                slice(max(0, -dx), x_size - max(0, dx)))
+        there = (slice(max(0, dy), y_size - max(0, -dy)),
+                 slice(max(0, dx), x_size - max(0, -dx)))
+        pairs.append(np.stack([order[here].ravel() + k, labels[here].ravel(),
+                               labels[there].ravel()]))
+    key, polygon, neighbour = np.concatenate(pairs, axis=1)
+    other = polygon != neighbour
+    key, polygon, neighbour = key[other], polygon[other], neighbour[other]
+    largest = np.zeros(n + 1, dtype=sizes.dtype)
+    np.maximum.at(largest, polygon, sizes[neighbour])
+    first = sizes[neighbour] == largest[polygon]
+    key, polygon, neighbour = key[first], polygon[first], neighbour[first]
+    sort = np.argsort(key, kind='stable')
+    polygon, index = np.unique(polygon[sort], return_index=True)
+    big = np.full(n + 1, -1)
+    big[polygon] = neighbour[sort][index]
+
+    # Small polygons are merged into the first polygon of 4 pixels down the
+    # chain of largest neighbours, if any
+    merged = np.arange(n + 1)
+    for label in np.flatnonzero((sizes < SIEVE_THRESHOLD) & (big >= 0)):
+        seen = set([label])
+        target = big[label]
+        while target >= 0 and sizes[target] < SIEVE_THRESHOLD and target not in seen:
+            seen.add(target)
+            target = big[target]
+        if target >= 0 and sizes[target] >= SIEVE_THRESHOLD:
+            merged[label] = target
+    merged_changed = (merged >= 1) & (merged <= n_changed)
+    return merged_changed[labels]
+
+def sieve_narrow(image, blocks):
+    """ Labels of the polygons to flip in every tile of a raster less than 4
+    pixels wide or high """
+    dataset = open_input(image)
+    changed = read_changed(image, (0, 0, dataset.RasterXSize,
+                                   dataset.RasterYSize))
+    flipped = sieve_filter(changed) != changed
+    flips = []
+    for xoff, yoff, x_size, y_size in blocks:
+        window = (slice(yoff, yoff + y_size), slice(xoff, xoff + x_size))
+        labels, _, _ = label_polygons(changed[window])
+        flips.append(set(np.unique(labels[flipped[window]])))
+    return flips
+
+def sieve_tile(task):
+    """ Sieved band 1 and output bands of one tile """
+    image, block, flips = task
+    out_img, _ = read_block(image, block)
+    with np.errstate(invalid='ignore'):
+        changed = out_img[0] > 0
+    labels, _, n = label_polygons(changed)
+    flip = np.zeros(n + 1, dtype=bool)
+    flip[list(flips)] = True
+    sieved = changed ^ flip[labels]
+
+    out_img[np.isnan(out_img)] = 0
+    out_img[:, ~sieved] = 0
+    return block, sieved, out_img
+
+def sieve(image, dst_filename, convdate, tile=2048, processes=None):
+    """ Remove changed and unchanged polygons of less than 4 pixels
+
+    Writes the sieved change mask to dst_filename and the input with the
+    unchanged pixels set to 0 to <dst_filename>_full.tif. Returns both
+    datasets, in memory when dst_filename is None.
+    """
+    src_ds = open_input(image)
+    blocks = list(tile_blocks(src_ds.RasterXSize, src_ds.RasterYSize, tile))
+
+    pool = None
+    if processes == 1:
+        imap = map
+    else:
+        pool = multiprocessing.Pool(processes)
+        imap = pool.imap
+
+    try:
+        # 1. Polygons of every tile, merged across tile edges
+        if min(src_ds.RasterXSize, src_ds.RasterYSize) < 4:
+            with profiling.stage('sieve flips'):
+                flips = sieve_narrow(image, blocks)
+        else:
+            with profiling.stage('sieve polygons'):
+                tiles = list(imap(sieve_polygons, [
+                    (image, block, src_ds.RasterXSize, src_ds.RasterYSize)
+                    for block in blocks]))
+            with profiling.stage('sieve flips'):
+                grid = dict(((block[1] // tile, block[0] // tile), k)
+                            for k, block in enumerate(blocks))
+                flips = sieve_flips(tiles, grid)
+
+        # 2. Flip the small polygons and write the tiles as they are done
+        mask_types = [('uint8', 1)]
+        dst_ds = create_output(image, dst_filename, mask_types)
+        dst_full = None
+        if dst_filename is not None:
+            dst_full = dst_filename.split('.')[0] + '_full.tif'
+        ranges = [(0, 0)] * src_ds.RasterCount
+        if convdate and dst_full is not None:
+            ranges = input_ranges(image, convdate)
+        full_types = band_types(ranges, convdate, dst_full is None)
+        full_ds = create_output(image, dst_full, full_types)
+
+        sieved_tiles = iter(imap(sieve_tile, [(image, block, flip) for
+                                              block, flip in zip(blocks, flips)]))
+        while True:
+            # Flipping, in the pool, is timed until the next tile is done
+            with profiling.stage('sieve apply'):
+                result = next(sieved_tiles, None)
+            if result is None:
+                break
+            block, sieved, out_img = result
+            write_block(dst_ds, sieved[np.newaxis], block, mask_types)
+            if convdate:
+                out_img = convert_date(out_img)
+            write_block(full_ds, out_img, block, full_types)
+    finally:
+        # Workers are stopped, also on an error
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    outputs = close_output(dst_ds, dst_filename), close_output(full_ds, dst_full)
+    dst_ds = full_ds = None
+    remove_temporary(dst_filename)
+    remove_temporary(dst_full)
+    return outputs
+
+# ** FELZENSZWALB TILES **
+
+# Tiles are segmented with a halo of pixels around them and keep the
+# segments of their own pixels. Two segments facing each other across a
+# tile edge are joined when both tiles, which see the pixels on either
+# side through their halo, put these pixels in the same segment. With
+# halo 0 the tiles cannot tell and nothing is joined.
+#
+# seam_ratio measures the seams left: the rate of segment boundaries
+# between neighbouring pixels across tile edges over the rate elsewhere,
+# 1 when the tile edges do not show in the segmentation.
+
+def fz_tile(task):
+    """ Segments of one tile, numbered from 0, and whether the pixels along
+    every edge are in the same segment as their neighbour across it """
+    image, block, halo, scale, sigma, minseg = task
+    fz_bands, inner = read_block(image, block, halo, bands=FZ_BANDS)
+    labels = felzenszwalb(fz_image(fz_bands, (0, 1, 2)), scale=scale,
+                          sigma=sigma, min_size=minseg)
+
+    rows, cols = inner
+    same = {}
+    if cols.start > 0:
+        same['left'] = labels[rows, cols.start] == labels[rows, cols.start - 1]
+    if cols.stop < labels.shape[1]:
+        same['right'] = labels[rows, cols.stop - 1] == labels[rows, cols.stop]
+    if rows.start > 0:
+        same['top'] = labels[rows.start, cols] == labels[rows.start - 1, cols]
+    if rows.stop < labels.shape[0]:
+        same['bottom'] = labels[rows.stop - 1, cols] == labels[rows.stop, cols]
+
+    uniques, labels = np.unique(labels[inner], return_inverse=True)
+    return {'block': block, 'labels': labels.reshape(block[3], block[2]),
+            'n': len(uniques), 'same': same}
+
+def fz_tiles(image, scale, sigma, minseg, tile, halo=32, processes=None):
+    """ Felzenszwalb segments of the raster, segmented tile by tile in a
+    process pool """
+    src_ds = open_input(image)
+    blocks = list(tile_blocks(src_ds.RasterXSize, src_ds.RasterYSize, tile))
+    tasks = [(image, block, halo, scale, sigma, minseg) for block in blocks]
+    if processes == 1:
+        tiles = list(map(fz_tile, tasks))
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            tiles = pool.map(fz_tile, tasks)
+        finally:
+            # Workers are stopped, also on an error
+            pool.terminate()
+            pool.join()
+
+    offsets = np.cumsum([0] + [t['n'] for t in tiles])
+    grid = dict(((block[1] // tile, block[0] // tile), k)
+                for k, block in enumerate(blocks))
+    uf = UnionFind()
+    for (i, j), k in grid.items():
+        for (di, dj), a_edge, b_edge in (((0, 1), 'right', 'left'),
+                                         ((1, 0), 'bottom', 'top')):
+            m = grid.get((i + di, j + dj))
+            if m is None or a_edge not in tiles[k]['same']:
+                continue
+            if di:
+                la, lb = tiles[k]['labels'][-1], tiles[m]['labels'][0]
             else:
-		values[np.isnan(values)] = 0
-#		values *= 1000
-	        if np.median(values) > 0:
-                    med = np.median(values[values>0])
-                else:
-                    med = 0
-            median_image[:,:,band][segments_fz == seg] = med
-
-    #Reshape
-    s1, s2, s3 = median_image.shape
-
-    median_image = median_image.swapaxes(1, 0)
-    median_image = median_image.swapaxes(2, 0)
-    save_raster(median_image, image, output, convdate)
-    sys.exit()
-
-def segment_km(image, output):
-    original_im = gdal.Open(image)
-
-    #Assign median values based on Felzenzwalb segmentation algorithm
-    three_d_image = original_im.ReadAsArray().astype(np.uint8)
-    three_d_image = three_d_image.swapaxes(0, 2)
-    three_d_image = three_d_image.swapaxes(0, 1)
-    img = three_d_image
-
-    full_image = original_im.ReadAsArray()
-    full_image = full_image.swapaxes(0, 2)
-    full_image = full_image.swapaxes(0, 1)
-
-    segments_slic = slic(img, n_segments=250, compactness=10, sigma=1)
-    median_image = np.zeros_like(img).astype(np.float32)
-    for band in range(3):
-        for seg in np.unique(segments_slic):
-            values = full_image[:,:,band][segments_slic == seg]
-#            mode = scipy.stats.mode(values.astype(int)).mode[0]
-#            if mode > 0:
-            med = np.median(values[values>0])
-#            else:
-#                med = 0
-            median_image[:,:,band][segments_slic == seg] = med
-
-    save_raster(median_image, image, output)
-    sys.exit()
-
-def sieve(image, dst_filename, convdate):
-    # 1. Remove all single pixels
-
-    #First create a band in memory that's that's just 1s and 0s
-    src_ds = gdal.Open( image, gdal.GA_ReadOnly )
-    srcband = src_ds.GetRasterBand(1)
-    srcarray = srcband.ReadAsArray()
-    srcarray[srcarray > 0] = 1
-
-    mem_rast = save_raster_memory(srcarray, image)
-    mem_band = mem_rast.GetRasterBand(1)
-
-    #Now the code behind gdal_sieve.py
-    maskband = None
-    drv = gdal.GetDriverByName('GTiff')
-    dst_ds = drv.Create( dst_filename,src_ds.RasterXSize, src_ds.RasterYSize,1,
-                         srcband.DataType )
-    wkt = src_ds.GetProjection()
-    if wkt != '':
-        dst_ds.SetProjection( wkt )
-    dst_ds.SetGeoTransform( src_ds.GetGeoTransform() )
-
-    dstband = dst_ds.GetRasterBand(1)
-
-    # Parameters
-    prog_func = None
-    threshold = 4
-    connectedness = 8
-
-    result = gdal.SieveFilter(mem_band, maskband, dstband,
-                              threshold, connectedness,
-                              callback = prog_func )
-
-    sieved = dstband.ReadAsArray()
-    sieved[sieved < 0] = 0
-
-    src_new = gdal.Open(image)
-    out_img = src_new.ReadAsArray().astype(np.float)
-
-    out_img[np.isnan(out_img)] = 0 
-
-    for b in range(out_img.shape[0]):
-        out_img[b,:,:][sieved == 0] = 0
-
-
-
-
-    dst_full = dst_filename.split('.')[0] + '_full.tif'
-
-    save_raster(out_img, image, dst_full, convdate)
-    sys.exit()
+                la, lb = tiles[k]['labels'][:, -1], tiles[m]['labels'][:, 0]
+            agree = tiles[k]['same'][a_edge] & tiles[m]['same'][b_edge]
+            for ga, gb in set(zip(la[agree] + offsets[k], lb[agree] + offsets[m])):
+                uf.union(ga, gb)
+
+    roots = np.array([uf.find(label) for label in range(offsets[-1])])
+    roots = np.unique(roots, return_inverse=True)[1]
+    segments = np.zeros((src_ds.RasterYSize, src_ds.RasterXSize), dtype=np.int32)
+    for k, t in enumerate(tiles):
+        xoff, yoff, x_size, y_size = t['block']
+        segments[yoff:yoff + y_size, xoff:xoff + x_size] = roots[t['labels'] + offsets[k]]
+    return segments
+
+def seam_ratio(segments, tile):
+    """ Rate of segment boundaries across tile edges over the rate
+    elsewhere """
+    across = [0, 0]
+    elsewhere = [0, 0]
+    for axis in (0, 1):
+        boundary = np.diff(segments, axis=axis) != 0
+        # Pairs of pixels i, i + 1 with i + 1 on a tile edge
+        seam = (np.arange(1, segments.shape[axis]) % tile) == 0
+        if axis == 0:
+            on_seam, off_seam = boundary[seam], boundary[~seam]
+        else:
+            on_seam, off_seam = boundary[:, seam], boundary[:, ~seam]
+        across[0] += on_seam.sum()
+        across[1] += on_seam.size
+        elsewhere[0] += off_seam.sum()
+        elsewhere[1] += off_seam.size
+    if not across[1] or not elsewhere[0]:
+        return 1.
+    return (float(across[0]) / across[1]) / (float(elsewhere[0]) / elsewhere[1])
+
+
+# ** COMMANDS **
+
+COMMANDS = ('sieve', 'fz', 'kmeans')
+
+def get_options(args):
+    """ Options of the commands from docopt arguments """
+    options = {
+        'sigma': float(args['--sigma']) if args['--sigma'] else .8,
+        'scale': float(args['--scale']) if args['--scale'] else 20,
+        'minseg': int(args['--seg']) if args['--seg'] else 4,
+        'convdate': bool(args['--convdate']),
+        'segsize': int(args['--segsize']) if args['--segsize'] else 400,
+        'tile': int(args['--tile']) if args['--tile'] else 2048,
+        # fz segments the whole raster unless a tile size is given
+        'fz_tile': int(args['--tile']) if args['--tile'] else None,
+        'processes': int(args['--processes']) if args['--processes'] else None,
+    }
+    if args['--reducers']:
+        options['reducers'] = args['--reducers'].split(',')
+    else:
+        options['reducers'] = ['mode', 'max', 'median']
+    for reducer in options['reducers']:
+        if reducer not in REDUCERS:
+            raise ValueError('unknown reducer {0}, use one of {1}'.format(
+                reducer, ', '.join(REDUCERS)))
+
+    if args['--halo']:
+        options['halo'] = int(args['--halo'])
+    elif args['fz']:
+        options['halo'] = 32
+    else:
+        options['halo'] = 0
+    return options
+
+def run(command, image, output, options):
+    """ Run command on image with options from get_options
+
+    Returns the output dataset (for sieve, the sieved mask and full
+    datasets), in memory when output is None.
+    """
+    if command == 'sieve':
+        return sieve(image, output, options['convdate'], options['tile'],
+                     options['processes'])
+    elif command == 'fz':
+        return segment_fz(image, output, options['scale'], options['sigma'],
+                          options['minseg'], options['convdate'],
+                          options['fz_tile'], options['halo'],
+                          options['processes'])
+    elif command == 'kmeans':
+        return segment_km(image, output, options['convdate'],
+                          options['segsize'], options['reducers'],
+                          options['tile'], options['halo'])
+    raise ValueError('unknown command {0}'.format(command))
 
 
 if __name__ == '__main__':
     args = docopt(__doc__, version='0.6.2')
+    profiling.enable(args['--profile'])
 
+    try:
+        options = get_options(args)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-image = args['<input>']
-output = args['<output>']
-
-if args['--sigma']:
-    sigma = float(args['--sigma'])
-else:
-    sigma = .8
-
-if args['--scale']:
-    scale = float(args['--scale'])
-else:
-    scale = 20
-
-if args['--seg']:
-    minseg = args['--seg']
-else:
-    minseg = 4
-
-convdate = False
-if args['--convdate']:
-    convdate = True
-
-if args['sieve']:
-    sieve(image, output, convdate)
-elif args['fz']:
-    segment_fz(image, output, scale, sigma, minseg, convdate)
-elif args['kmeans']:
-    segment_km(image, output)
+    command = [c for c in COMMANDS if args[c]][0]
+    with profiling.stage(command):
+        run(command, args['<input>'], args['<output>'], options)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Postprocess many Continuous Degradation Detection (CDD) results
+
+Runs a postprocess.py command on every CDD output of a directory or glob
+in a pool of worker processes. Every worker imports postprocess, GDAL and
+scikit-image once and then processes files one after another, each file
+in a single process. Outputs are written to <outdir> as
+<name>_<command>.tif.
+
+Usage: postprocess_batch.py [options] (sieve | fz | kmeans) <inputs> <outdir>
+
+  <inputs>                directory of CDD output GeoTIFFs, or a glob such
+                          as 'cdd_*.tif'
+  --processes=<PROCESSES> Files processed at once (default: number of cores)
+  --seg=<SEG_SIZE>        Minimum segment size
+  --sigma=<SIGMA>         Sigma value for FZ test
+  --scale=<SCALE>         Scale value for FZ test
+  --convdate=<CONVDATE>   Convert date to year
+  --segsize=<SEGSIZE>     Mean segment size in pixels for kmeans (default: 400)
+  --reducers=<REDUCERS>   Comma separated reducer of each band for kmeans
+                          (default: mode,max,median)
+  --tile=<TILE>           Tile size in pixels for kmeans and sieve (default:
+                          2048). fz segments the whole raster at once unless
+                          a tile size is given
+  --halo=<HALO>           Pixels around every kmeans or fz tile seen by the
+                          segmentation (default: 0 for kmeans, 32 for fz)
+
+"""
+
+from docopt import docopt
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import postprocess
+
+
+def list_inputs(inputs):
+    """ Sorted GeoTIFFs of a directory, or files matching a glob """
+    if os.path.isdir(inputs):
+        return sorted(glob.glob(os.path.join(inputs, '*.tif')))
+    return sorted(glob.glob(inputs))
+
+def output_filename(image, outdir, command):
+    name = os.path.splitext(os.path.basename(image))[0]
+    return os.path.join(outdir, '{0}_{1}.tif'.format(name, command))
+
+def process_file(task):
+    """ Run a command on one file, returns (image, seconds, error) """
+    command, image, output, options = task
+    start = time.time()
+    try:
+        postprocess.run(command, image, output, options)
+    except Exception:
+        return image, time.time() - start, traceback.format_exc()
+    return image, time.time() - start, None
+
+def run_batch(command, images, outdir, options, processes=None):
+    """ Run command on every image in a process pool, returns the images
+    which failed """
+    # Files are processed in parallel, a file uses a single process
+    options = dict(options, processes=1)
+    tasks = [(command, image, output_filename(image, outdir, command), options)
+             for image in images]
+
+    pool = None
+    if processes == 1:
+        results = map(process_file, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(process_file, tasks)
+
+    try:
+        failed = []
+        for i, (image, elapsed, error) in enumerate(results):
+            if error:
+                print('{0}: failed\n{1}'.format(image, error))
+                failed.append(image)
+            else:
+                print('{0}/{1} {2}: {3:.1f} s'.format(i + 1, len(tasks), image,
+                                                     elapsed))
+    finally:
+        # Workers are stopped, also on an error
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return failed
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__, version='0.6.2')
+
+    try:
+        options = postprocess.get_options(args)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    processes = options['processes']
+
+    images = list_inputs(args['<inputs>'])
+    if not images:
+        print('no CDD outputs in {0}'.format(args['<inputs>']))
+        sys.exit(1)
+    outdir = args['<outdir>']
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    command = [c for c in postprocess.COMMANDS if args[c]][0]
+    print('{0} files'.format(len(images)))
+    failed = run_batch(command, images, outdir, options, processes)
+    if failed:
+        print('failed: {0}'.format(', '.join(failed)))
+        sys.exit(1)
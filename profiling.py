@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Per-stage profiling of the CDD scripts
+
+cdd.py and postprocess.py wrap their stages in stage(), which does nothing
+unless profiling was enabled with their --profile=FILE option or the
+CDD_PROFILE environment variable. Each stage then records its wall and
+CPU time, the peak memory traced by tracemalloc above the memory in use
+when it started (NumPy arrays included, not available on Python 2) and
+the size of the arrays it reports with Stage.arrays.
+
+The file is written when the script exits. It is a Chrome trace, which
+chrome://tracing and Perfetto display with nested stages, and a JSON
+report: the stages in order under "stages", their totals by name under
+"summary" and the machine under "machine". Stages run in worker processes
+are not recorded, the stage around the pool measures them as a whole.
+"""
+
+import atexit
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ENVIRONMENT_VARIABLE = 'CDD_PROFILE'
+
+# CPU time of the process
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+# Recorded stages and open stages, None unless enabled
+_stages = None
+_open = []
+_filename = None
+_start = None
+
+
+class Stage(object):
+    """ A stage being recorded """
+
+    def __init__(self, name):
+        self.name = name
+        self.record = {'stage': name, 'depth': len(_open)}
+        self.peak = 0
+
+    def arrays(self, **arrays):
+        """ Record the shape, dtype and bytes of NumPy arrays """
+        sizes = self.record.setdefault('arrays', {})
+        for name, array in arrays.items():
+            sizes[name] = {'shape': list(array.shape), 'dtype': str(array.dtype),
+                           'bytes': int(array.nbytes)}
+
+
+class _NullStage(object):
+
+    def arrays(self, **arrays):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+def enabled():
+    return _stages is not None
+
+def enable(filename=None):
+    """ Record the stages and write them to filename, or to the file of the
+    CDD_PROFILE environment variable, when the process exits. Does nothing
+    without a file """
+    global _stages, _filename, _start
+    filename = filename or os.environ.get(ENVIRONMENT_VARIABLE)
+    if not filename or enabled():
+        return
+    _stages = []
+    _filename = filename
+    _start = time.time()
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    atexit.register(write)
+
+def _traced_peak():
+    # Peak traced memory since the last reset, when the peak can be reset
+    peak = tracemalloc.get_traced_memory()[1]
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    return peak
+
+@contextlib.contextmanager
+def stage(name):
+    """ Record the stage run by the with block, yields a Stage """
+    if _stages is None:
+        yield _NULL_STAGE
+        return
+    current = Stage(name)
+    if tracemalloc is not None:
+        # The peak so far belongs to the enclosing stage
+        if _open:
+            _open[-1].peak = max(_open[-1].peak, _traced_peak())
+        else:
+            _traced_peak()
+        memory = tracemalloc.get_traced_memory()[0]
+    _open.append(current)
+    start, start_cpu = time.time(), cpu_time()
+    try:
+        yield current
+    finally:
+        end, end_cpu = time.time(), cpu_time()
+        _open.pop()
+        current.record.update({'start': start - _start, 'wall_seconds': end - start,
+                               'cpu_seconds': end_cpu - start_cpu})
+        if tracemalloc is not None:
+            current.peak = max(current.peak, _traced_peak())
+            current.record['peak_bytes'] = max(current.peak - memory, 0)
+            if _open:
+                _open[-1].peak = max(_open[-1].peak, current.peak)
+        _stages.append(current.record)
+
+def summary(stages):
+    """ Count, wall and CPU time and largest peak of the stages by name """
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record['stage'], {
+            'count': 0, 'wall_seconds': 0., 'cpu_seconds': 0., 'peak_bytes': None})
+        total['count'] += 1
+        total['wall_seconds'] += record['wall_seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        if record.get('peak_bytes') is not None:
+            total['peak_bytes'] = max(total['peak_bytes'] or 0, record['peak_bytes'])
+    return totals
+
+def trace_events(stages):
+    """ Chrome trace complete events of the stages """
+    pid = os.getpid()
+    events = []
+    for record in stages:
+        args = dict((k, v) for k, v in record.items()
+                    if k not in ('stage', 'start', 'wall_seconds'))
+        events.append({'name': record['stage'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                       'ts': record['start'] * 1e6,
+                       'dur': record['wall_seconds'] * 1e6, 'args': args})
+    return events
+
+def write(filename=None):
+    """ Write the recorded stages """
+    if _stages is None:
+        return
+    stages = sorted(_stages, key=lambda record: record['start'])
+    report = {
+        'traceEvents': trace_events(stages),
+        'displayTimeUnit': 'ms',
+        'stages': stages,
+        'summary': summary(stages),
+        'machine': {'argv': sys.argv, 'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'processor': platform.processor(),
+                    'cpus': multiprocessing.cpu_count(),
+                    'start': _start},
+    }
+    with open(filename or _filename, 'w') as f:
+        json.dump(report, f, indent=1)
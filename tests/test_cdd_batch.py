@@ -0,0 +1,182 @@
+""" The batch scheduler against the fake backend, with a fake clock """
+
+import json
+
+import pytest
+
+pytest.importorskip('docopt')
+import cdd_batch
+
+
+class Clock(object):
+    """ Time that only moves when the runner sleeps """
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class CountingBackend(cdd_batch.FakeBackend):
+    """ Fake backend recording the unfinished tasks and submission times """
+
+    def __init__(self, clock, **kwargs):
+        cdd_batch.FakeBackend.__init__(self, **kwargs)
+        self.clock = clock
+        self.active = set()
+        self.most_active = 0
+        self.submit_times = {}
+
+    def submit(self, job):
+        task_id = cdd_batch.FakeBackend.submit(self, job)
+        self.active.add(task_id)
+        self.most_active = max(self.most_active, len(self.active))
+        self.submit_times.setdefault(job['output'], []).append(self.clock())
+        return task_id
+
+    def status(self, task_ids):
+        statuses = cdd_batch.FakeBackend.status(self, task_ids)
+        for task_id, (state, _) in statuses.items():
+            if state == cdd_batch.COMPLETED or state in cdd_batch.FAILED:
+                self.active.discard(task_id)
+        return statuses
+
+
+def make_jobs(n):
+    return [cdd_batch.make_job(225, 60 + i) for i in range(n)]
+
+
+def make_runner(backend, clock, **kwargs):
+    return cdd_batch.BatchRunner(backend, clock=clock, sleep=clock.sleep,
+                                 **kwargs)
+
+
+def test_concurrency_cap():
+    clock = Clock()
+    backend = CountingBackend(clock, polls=3)
+    jobs = make_runner(backend, clock, max_tasks=2, poll=10).run(make_jobs(7))
+    assert backend.most_active == 2
+    assert all(job['state'] == cdd_batch.COMPLETED for job in jobs)
+    assert sorted(backend.submitted) == sorted(job['output'] for job in jobs)
+
+
+def test_retry_backoff():
+    clock = Clock()
+    jobs = make_jobs(2)
+    failing = jobs[0]['output']
+    backend = CountingBackend(clock, polls=1, failures={failing: 2})
+    make_runner(backend, clock, retries=3, backoff=60, poll=10).run(jobs)
+
+    assert jobs[0]['state'] == cdd_batch.COMPLETED
+    assert jobs[0]['attempts'] == 3
+    assert jobs[0]['error'] is None
+    assert jobs[1]['attempts'] == 1
+    # Each failure is seen at the next poll, 10 s after the submission,
+    # and the retries wait 60 then 120 s more
+    first, second, third = backend.submit_times[failing]
+    assert second - first >= 10 + 60
+    assert third - second >= 10 + 120
+    assert second - first < 10 + 60 + 10
+    assert third - second < 10 + 120 + 10
+
+
+def test_retries_exhausted():
+    clock = Clock()
+    jobs = make_jobs(1)
+    backend = CountingBackend(clock, failures={jobs[0]['output']: 5})
+    make_runner(backend, clock, retries=1, backoff=5, poll=1).run(jobs)
+    assert jobs[0]['state'] == 'FAILED'
+    assert jobs[0]['attempts'] == 2
+    assert jobs[0]['error'] == 'fake failure'
+
+
+def test_submission_failure_is_retried():
+    clock = Clock()
+
+    class Backend(CountingBackend):
+        def submit(self, job):
+            if len(self.submit_times.get(job['output'], [])) == 0:
+                self.submit_times[job['output']] = [None]
+                raise RuntimeError('quota')
+            return CountingBackend.submit(self, job)
+
+    jobs = make_jobs(1)
+    make_runner(Backend(clock), clock, backoff=5, poll=1).run(jobs)
+    assert jobs[0]['state'] == cdd_batch.COMPLETED
+    assert jobs[0]['attempts'] == 2
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_manifest_after_resume(tmpdir):
+    manifest = str(tmpdir.join('manifest.json'))
+    clock = Clock()
+    backend = CountingBackend(clock, polls=3)
+
+    def interrupt_after(polls):
+        def sleep(seconds):
+            if clock() >= polls * seconds:
+                raise Interrupted()
+            clock.sleep(seconds)
+        return sleep
+
+    # The first run stops while tasks are running
+    runner = cdd_batch.BatchRunner(backend, max_tasks=2, poll=10,
+                                   manifest=manifest, clock=clock,
+                                   sleep=interrupt_after(4))
+    with pytest.raises(Interrupted):
+        runner.run(make_jobs(5))
+    with open(manifest) as f:
+        saved = json.load(f)['jobs']
+    completed = [job['output'] for job in saved
+                 if job['state'] == cdd_batch.COMPLETED]
+    running = dict((job['output'], job['task_id']) for job in saved
+                   if job['state'] in cdd_batch.ACTIVE)
+    assert completed and running
+
+    # The rerun skips the completed outputs and checks the running tasks
+    submitted = len(backend.submitted)
+    jobs = cdd_batch.read_manifest(manifest, make_jobs(5))
+    runner = cdd_batch.BatchRunner(backend, max_tasks=2, poll=10,
+                                   manifest=manifest, clock=clock,
+                                   sleep=clock.sleep)
+    runner.run(jobs)
+    resubmitted = backend.submitted[submitted:]
+    assert not set(resubmitted) & (set(completed) | set(running))
+
+    with open(manifest) as f:
+        saved = dict((job['output'], job) for job in json.load(f)['jobs'])
+    assert sorted(saved) == sorted(job['output'] for job in make_jobs(5))
+    for output, job in saved.items():
+        assert job['state'] == cdd_batch.COMPLETED
+        assert job['error'] is None
+        assert job['task_id'] is not None
+        assert job['path'] == 225 and job['row'] == int(output[-3:])
+        assert job['attempts'] == 1
+    for output, task_id in running.items():
+        assert saved[output]['task_id'] == task_id
+    assert sorted(backend.submitted) == sorted(saved)
+
+
+def test_resume_unknown_tasks(tmpdir):
+    # Tasks Earth Engine no longer knows are submitted again
+    manifest = str(tmpdir.join('manifest.json'))
+    jobs = make_jobs(2)
+    for i, job in enumerate(jobs):
+        job.update({'state': 'RUNNING', 'task_id': 'LOST{0}'.format(i),
+                    'attempts': 1})
+    clock = Clock()
+    cdd_batch.BatchRunner(cdd_batch.FakeBackend(), manifest=manifest,
+                          backoff=0, poll=1, clock=clock,
+                          sleep=clock.sleep).write_manifest(jobs)
+    jobs = cdd_batch.read_manifest(manifest, make_jobs(2))
+    backend = CountingBackend(clock)
+    make_runner(backend, clock, backoff=0, poll=1).run(jobs)
+    assert sorted(backend.submitted) == sorted(job['output'] for job in jobs)
+    assert all(job['state'] == cdd_batch.COMPLETED for job in jobs)
@@ -0,0 +1,80 @@
+""" The local engine's checkpoints: a run resuming from the checkpoints of
+an earlier run gives the output of a fresh run """
+
+import datetime
+import glob
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+pytest.importorskip('docopt')
+import cdd_local
+
+
+def make_series(pixels=60, seed=0):
+    """ (dates, sensors, nfdi) of a synthetic NFDI stack from 1994 to 2014,
+    a drop of NFDI in a third of the pixels and some masked observations """
+    rng = np.random.RandomState(seed)
+    dates = [datetime.date(1994, 1, 5) + datetime.timedelta(8 * i)
+             for i in range(21 * 365 // 8)]
+    sensors = [('LT5', 'LE7', 'LC8')[min(i % 2 + (d.year >= 2012), 2)]
+               for i, d in enumerate(dates)]
+    t = cdd_local.years_since_epoch(dates)[:, np.newaxis]
+    nfdi = (80 + 5 * np.sin(2 * np.pi * t + rng.uniform(0, 6, pixels)) +
+            rng.normal(0, 2, (len(dates), pixels)))
+    change = 30 + rng.uniform(0, 14, pixels)
+    changed = np.arange(pixels) % 3 == 0
+    nfdi -= 40 * (changed & (t > change))
+    nfdi[rng.uniform(size=nfdi.shape) < .3] = np.nan
+    treecover = np.where(np.arange(pixels) % 10 == 1, 10, 80)
+    return dates, sensors, nfdi, treecover
+
+
+@pytest.mark.parametrize('window', [None, 3, 5])
+def test_resume_longer_run(tmpdir, window):
+    dates, sensors, nfdi, treecover = make_series()
+    checkpoint = str(tmpdir.join('state'))
+
+    def run(end, checkpoint=None):
+        return cdd_local.run_cdd(dates, sensors, nfdi, treecover,
+                                 window=window, years=range(2000, end + 1, 2),
+                                 checkpoint=checkpoint)
+
+    run(2008, checkpoint)
+    assert len(glob.glob(checkpoint + '_*.npz')) == 5
+    resumed = run(2014, checkpoint)
+    assert len(glob.glob(checkpoint + '_*.npz')) == 8
+    fresh = run(2014)
+    assert (fresh[0] > 0).any()
+    np.testing.assert_allclose(resumed, fresh, rtol=1e-5, atol=1e-5)
+
+    # The final states match as well
+    params = (2000, 2, 5, 3.5, window or 0, 30, .2)
+    forest = treecover > 30
+    fresh_checkpoint = str(tmpdir.join('fresh'))
+    run(2014, fresh_checkpoint)
+    for a, b in zip(cdd_local.load_checkpoint(checkpoint + '_2014.npz',
+                                              params, forest),
+                    cdd_local.load_checkpoint(fresh_checkpoint + '_2014.npz',
+                                              params, forest)):
+        if isinstance(a, cdd_local.RegressionStats):
+            for name in ('xtx', 'xty', 'yty', 'n'):
+                np.testing.assert_allclose(getattr(a, name), getattr(b, name),
+                                           rtol=1e-9, atol=1e-6)
+        else:
+            np.testing.assert_allclose(a, b, rtol=1e-9, atol=1e-9)
+
+
+def test_checkpoint_other_params(tmpdir):
+    dates, sensors, nfdi, treecover = make_series(pixels=10)
+    checkpoint = str(tmpdir.join('state'))
+    cdd_local.run_cdd(dates, sensors, nfdi, treecover, window=3,
+                      years=range(2000, 2005, 2), checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        cdd_local.run_cdd(dates, sensors, nfdi, treecover, window=4,
+                          years=range(2000, 2005, 2), checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        cdd_local.run_cdd(dates, sensors, nfdi, treecover, window=3,
+                          forest_threshold=5, years=range(2000, 2005, 2),
+                          checkpoint=checkpoint)
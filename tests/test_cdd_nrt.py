@@ -0,0 +1,78 @@
+""" The near real time state against the checkpoints of cdd_local runs """
+
+import datetime
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+pytest.importorskip('docopt')
+import cdd_local
+import cdd_nrt
+from test_cdd_local import make_series
+
+
+def run(prefix, end, window=None, cf_thresh=.2):
+    dates, sensors, nfdi, treecover = make_series()
+    cdd_local.run_cdd(dates, sensors, nfdi, treecover, window=window,
+                      years=range(2000, end + 1, 2), checkpoint=prefix,
+                      cf_thresh=cf_thresh)
+    return treecover > 30
+
+
+@pytest.mark.parametrize('window', [None, 3])
+def test_model_of_next_step(tmpdir, window):
+    # The model fixed from the last checkpoint is the one the next step of a
+    # longer run monitors with
+    forest = run(str(tmpdir.join('short')), 2008, window)
+    run(str(tmpdir.join('long')), 2010, window)
+    state = cdd_nrt.init_state(str(tmpdir.join('short')), len(forest))
+    assert int(state['year']) == 2008
+    with np.load(str(tmpdir.join('long_2010.npz'))) as step:
+        coefs, tmean = step['coefs'], step['tmean']
+    monitored = forest & (state['status'][0] == 1)
+    assert monitored.any()
+    np.testing.assert_allclose(state['coefs'][monitored], coefs[monitored])
+    np.testing.assert_allclose(state['tmean'][monitored], tmean[monitored])
+
+
+def test_state_rebuilt_after_later_checkpoint(tmpdir):
+    prefix = str(tmpdir.join('tile_0_0'))
+    pixels = len(run(prefix, 2008))
+    state = cdd_nrt.load_state(prefix, pixels)
+    state['last'] = np.array(state['last'] + 100)
+    cdd_local.save_npz(prefix + '_nrt.npz', **state)
+    assert int(cdd_nrt.load_state(prefix, pixels)['last']) == state['last']
+
+    # cdd_local saved a later step: the model and the last acquisition come
+    # from it
+    run(prefix, 2010)
+    state = cdd_nrt.load_state(prefix, pixels)
+    expected = cdd_nrt.init_state(prefix, pixels)
+    assert int(state['year']) == 2010
+    for key in ('status', 'coefs', 'tmean', 'last'):
+        np.testing.assert_array_equal(state[key], expected[key])
+
+
+def test_state_rebuilt_with_other_params(tmpdir):
+    prefix = str(tmpdir.join('tile_0_0'))
+    pixels = len(run(prefix, 2008))
+    state = cdd_nrt.load_state(prefix, pixels)
+    state['params'] = state['params'] + 1
+    state['last'] = np.array(state['last'] + 100)
+    cdd_local.save_npz(prefix + '_nrt.npz', **state)
+    state = cdd_nrt.load_state(prefix, pixels)
+    np.testing.assert_array_equal(state['params'],
+                                  cdd_nrt.init_state(prefix, pixels)['params'])
+    assert int(state['last']) == datetime.date(2009, 12, 30).toordinal()
+
+
+def test_cf_thresh_of_the_run(tmpdir):
+    pixels = len(run(str(tmpdir.join('tile_0_0')), 2004, cf_thresh=.3))
+    block = (0, 0, pixels, 1)
+    _, output, new_scenes = cdd_nrt.process_tile(
+        (block, [], str(tmpdir), None))
+    assert new_scenes == 0 and not output.any()
+    cdd_nrt.process_tile((block, [], str(tmpdir), .3))
+    with pytest.raises(ValueError):
+        cdd_nrt.process_tile((block, [], str(tmpdir), .2))
@@ -0,0 +1,47 @@
+""" segment_fz reads its input block by block and reduces the medians of
+the segments as over the whole raster """
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+pytest.importorskip('skimage')
+import postprocess
+from test_postprocess_output import cdd_output, write_raster
+
+
+@pytest.mark.parametrize('block', [1, 7, 64])
+def test_block_medians(tmpdir, block):
+    rng = np.random.RandomState(0)
+    bands = cdd_output((30, 45))
+    bands[:4][rng.uniform(size=(4, 30, 45)) < .1] = np.nan
+    filename = str(tmpdir.join('cdd.tif'))
+    write_raster(filename, bands)
+    segments = rng.randint(0, 60, (30, 45))
+    segments[10:20] = 60 + np.arange(45) // 9
+
+    medians = postprocess.block_medians(
+        filename, segments, list(postprocess.tile_blocks(45, 30, block)))
+    for band in range(4):
+        expected = postprocess.segment_medians(bands[band], segments,
+                                               nan_to_zero=band >= 2)
+        np.testing.assert_array_equal(medians[band], expected)
+
+
+def test_reads_tiles(tmpdir, monkeypatch):
+    filename = str(tmpdir.join('cdd.tif'))
+    write_raster(filename, cdd_output((60, 70)))
+    expected = postprocess.segment_fz(filename, None, 20, .8, 4, False,
+                                      tile=16, halo=4, processes=1)
+    read = []
+    read_block = postprocess.read_block
+
+    def record(path, block, halo=0, bands=None):
+        read.append((block[2] + 2 * halo) * (block[3] + 2 * halo))
+        return read_block(path, block, halo, bands)
+
+    monkeypatch.setattr(postprocess, 'read_block', record)
+    output = postprocess.segment_fz(filename, None, 20, .8, 4, False,
+                                    tile=16, halo=4, processes=1)
+    assert max(read) <= 24 * 24
+    np.testing.assert_array_equal(output.ReadAsArray(), expected.ReadAsArray())
@@ -0,0 +1,124 @@
+""" Change dates converted to years and the outputs written with them """
+
+import weakref
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+pytest.importorskip('skimage')
+import postprocess
+
+
+def test_convert_date():
+    array = np.array([[[0, 35.6], [np.nan, 30.01]],
+                      [[.5, -.2], [np.nan, 1]]])
+    converted = postprocess.convert_date(array.copy())
+    np.testing.assert_array_equal(converted[0], [[0, 2005], [np.nan, 2000]])
+    np.testing.assert_array_equal(converted[1], array[1])
+
+
+def write_raster(filename, bands):
+    gdal = postprocess.gdal
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filename, bands.shape[2], bands.shape[1], bands.shape[0],
+        gdal.GDT_Float32)
+    dataset.SetGeoTransform((0, 30, 0, 0, 0, -30))
+    for b in range(bands.shape[0]):
+        dataset.GetRasterBand(b + 1).WriteArray(bands[b])
+    dataset.FlushCache()
+
+
+def cdd_output(shape=(40, 50), seed=0):
+    """ 5 band CDD output with changes in a few patches """
+    rng = np.random.RandomState(seed)
+    bands = np.zeros((5,) + shape, dtype=np.float32)
+    changed = np.zeros(shape, dtype=bool)
+    changed[5:15, 10:30] = changed[25:35, 2:8] = True
+    bands[0][changed] = rng.uniform(30, 44, changed.sum())
+    bands[1][changed] = rng.uniform(-3, 3, changed.sum())
+    bands[2:][:, changed] = rng.uniform(-1, 1, (3, changed.sum()))
+    return bands
+
+
+class CheckedDriver(object):
+    """ GTiff driver refusing to delete a file whose dataset is open, as on
+    Windows """
+
+    def __init__(self, driver, created):
+        self.driver = driver
+        self.created = created
+
+    def Create(self, filename, *args):
+        dataset = self.driver.Create(filename, *args)
+        self.created[filename] = weakref.ref(dataset)
+        return dataset
+
+    def Delete(self, filename):
+        assert self.created[filename]() is None, 'deleting an open file'
+        self.driver.Delete(filename)
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+
+@pytest.mark.parametrize('command', postprocess.COMMANDS)
+def test_temporary_released(tmpdir, monkeypatch, command):
+    filename = str(tmpdir.join('cdd.tif'))
+    write_raster(filename, cdd_output())
+    created = {}
+    get_driver = postprocess.gdal.GetDriverByName
+    monkeypatch.setattr(postprocess.gdal, 'GetDriverByName',
+                        lambda name: CheckedDriver(get_driver(name), created))
+    options = postprocess.get_options(
+        {'--sigma': None, '--scale': None, '--seg': None, '--convdate': '1',
+         '--segsize': '100', '--tile': '16', '--processes': '1',
+         '--reducers': None, '--halo': None, 'fz': command == 'fz'})
+    output = str(tmpdir.join('out.tif'))
+    postprocess.run(command, filename, output, options)
+    temporary = [name for name in created if name.endswith('.tmp.tif')]
+    assert len(temporary) == (2 if command == 'sieve' else 1)
+    for name in temporary:
+        assert created[name]() is None
+
+
+def test_band_types():
+    ranges = [(0, 2014), (-2.5, 3), (-1, 1), (0, 0), (-3.2767, 3.2767)]
+    assert postprocess.band_types(ranges, True) == [
+        ('int16', 1), ('int16', .01), ('int16', 1e-4), ('int16', 1e-4),
+        ('int16', 1e-4)]
+    for band, out_of_range in ((0, (-40000, 0)), (1, (0, 400)),
+                               (4, (-3.3, 1))):
+        ranges_out = list(ranges)
+        ranges_out[band] = out_of_range
+        assert postprocess.band_types(ranges_out, True) == [
+            ('float32', 1)] * 5
+    assert postprocess.band_types(ranges, False) == [('float32', 1)] * 5
+    assert postprocess.band_types(ranges, True, True) == [('float32', 1)] * 5
+
+
+@pytest.mark.parametrize('command', postprocess.COMMANDS)
+@pytest.mark.parametrize('intercept, dtype', [(1, np.int16), (50, np.float32)])
+def test_convdate_output(tmpdir, command, intercept, dtype):
+    # Int16 when the values of every band fit, Float32 otherwise
+    bands = cdd_output()
+    bands[3] *= intercept
+    filename = str(tmpdir.join('cdd.tif'))
+    write_raster(filename, bands)
+    options = postprocess.get_options(
+        {'--sigma': None, '--scale': None, '--seg': None, '--convdate': '1',
+         '--segsize': '100', '--tile': '16', '--processes': '1',
+         '--reducers': None, '--halo': None, 'fz': command == 'fz'})
+    output = postprocess.run(command, filename, str(tmpdir.join('out.tif')),
+                             options)
+    expected = postprocess.run(command, filename, None, options)
+    if command == 'sieve':
+        output, expected = output[1], expected[1]
+    scales = [1, .01, 1e-4, 1e-4, 1e-4] if dtype == np.int16 else [1] * 5
+    for b in range(5):
+        written = output.GetRasterBand(b + 1).ReadAsArray()
+        assert written.dtype == dtype
+        np.testing.assert_allclose(
+            written * scales[b], expected.GetRasterBand(b + 1).ReadAsArray(),
+            atol=scales[b] / 2 + 1e-6, rtol=1e-6)
+    assert (expected.GetRasterBand(1).ReadAsArray() > 2000).any()
@@ -0,0 +1,79 @@
+""" The tiled sieve against gdal.SieveFilter (threshold 4, 8-connected) on
+rasters less than 4 pixels wide or high, where a small polygon can span
+the raster. Expected outputs are those of SieveFilter. Also, the workers
+of the sieve stop when a tile fails. """
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+pytest.importorskip('skimage')
+import postprocess
+
+NARROW = [
+    ([[0, 0, 1, 0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 1, 0, 0, 1, 0, 1, 1, 1, 0, 1]],
+     [[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 1, 0, 1, 1, 1, 0, 1]]),
+    ([[1, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 1, 1]],
+     [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]),
+    ([[1, 0, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0],
+      [0, 0, 1, 1, 1, 1, 0, 1, 1, 0, 1, 1, 0, 1, 1]],
+     [[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+      [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]]),
+    ([[0, 0, 0, 1, 0, 1, 0, 0, 0, 1, 1, 0],
+      [1, 1, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0],
+      [0, 1, 0, 1, 1, 0, 0, 1, 1, 0, 0, 0]],
+     [[0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0],
+      [0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0],
+      [0, 0, 0, 1, 1, 0, 0, 1, 1, 0, 0, 0]]),
+]
+
+
+def write_raster(filename, band):
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filename, band.shape[1], band.shape[0], 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform((0, 30, 0, 0, 0, -30))
+    dataset.GetRasterBand(1).WriteArray(band)
+    dataset.FlushCache()
+
+
+@pytest.mark.parametrize('changed, expected', NARROW)
+@pytest.mark.parametrize('transpose', [False, True])
+def test_sieve_filter_narrow(changed, expected, transpose):
+    changed = np.array(changed, dtype=bool)
+    expected = np.array(expected, dtype=bool)
+    if transpose:
+        changed, expected = changed.T, expected.T
+    assert np.array_equal(postprocess.sieve_filter(changed), expected)
+
+
+@pytest.mark.parametrize('changed, expected', NARROW)
+@pytest.mark.parametrize('transpose', [False, True])
+@pytest.mark.parametrize('tile', [1, 5, 64])
+def test_sieve_narrow(tmpdir, changed, expected, transpose, tile):
+    changed = np.array(changed, dtype=np.float32)
+    expected = np.array(expected, dtype=bool)
+    if transpose:
+        changed, expected = changed.T, expected.T
+    filename = str(tmpdir.join('cdd_{0}.tif'.format(tile)))
+    write_raster(filename, changed * 30.5)
+    mask, full = postprocess.sieve(filename, None, False, tile=tile,
+                                   processes=1)
+    assert np.array_equal(mask.GetRasterBand(1).ReadAsArray() > 0, expected)
+    assert np.array_equal(full.GetRasterBand(1).ReadAsArray(),
+                          np.where(expected, changed * 30.5, 0))
+
+
+def fail_tile(task):
+    raise RuntimeError('tile failed')
+
+
+@pytest.mark.parametrize('stage', ['sieve_polygons', 'sieve_tile'])
+def test_sieve_failure_stops_workers(tmpdir, monkeypatch, stage):
+    filename = str(tmpdir.join('cdd.tif'))
+    write_raster(filename, np.arange(100, dtype=np.float32).reshape(10, 10) % 3)
+    monkeypatch.setattr(postprocess, stage, fail_tile)
+    with pytest.raises(RuntimeError):
+        postprocess.sieve(filename, None, False, tile=4, processes=2)
+    assert not multiprocessing.active_children()